@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import collections
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import timeit
+from os.path import dirname, join
+
+# local
+from ..parlai.models.gpt3 import GPT3Agent, INSTRUCTIONS, STOP
+from ..parlai.teachers.tscc import TSCCTeacher
+from ..parlai.teachers.uptake import UptakeTeacher
+from ..stan import bradley_terry
+from ..utils import gpt3, synthetic
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+BASELINES = join(dirname(__file__), 'baselines.json')
+
+MICRO = 'micro'
+MACRO = 'macro'
+
+# registry of benchmarks: name -> (suite, setup)
+# a setup function prepares synthetic data in a temporary directory
+# and returns the callable that will be timed
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, suite=MICRO):
+    def decorator(setup):
+        BENCHMARKS[name] = (suite, setup)
+        return setup
+    return decorator
+
+
+def _bare_teacher(cls, **opt):
+    # only setup_data is measured, not the ParlAI episode machinery
+    teacher = cls.__new__(cls)
+    teacher.opt = opt
+    return teacher
+
+
+def _consume(iterable):
+    # exhaust a generator, silencing progress messages
+    with contextlib.redirect_stdout(io.StringIO()):
+        collections.deque(iterable, maxlen=0)
+
+
+def _register_micro():
+    observation = synthetic.make_history(1)[0]
+
+    for n in (10, 100, 1000):
+
+        @benchmark(f'make_prompt[history={n}]')
+        def setup(tmpdir, n=n):
+            history = synthetic.make_history(n, seed=n)
+            return lambda: GPT3Agent.make_prompt(
+                observation, history, max_completion_len=500)
+
+        @benchmark(f'restrict_history[history={n}]')
+        def setup(tmpdir, n=n):
+            history = synthetic.make_history(n, seed=n)
+            return lambda: list(GPT3Agent.restrict_history(
+                INSTRUCTIONS, history, observation['text'],
+                max_completion_len=500))
+
+        @benchmark(f'count_prompt_tokens[history={n}]')
+        def setup(tmpdir, n=n):
+            history = synthetic.make_history(n, seed=n)
+            prompt = GPT3Agent.make_prompt(observation, history)
+            return lambda: gpt3.count_prompt_tokens(prompt, STOP)
+
+    for n in (1000, 10000):
+
+        @benchmark(f'TSCCTeacher.setup_data[turns={n}]')
+        def setup(tmpdir, n=n):
+            datafiles = []
+            for k in range(10):
+                datafile = join(tmpdir, f'teacherstudentchat{k:05d}.tsv')
+                synthetic.write_tscc_tsv(datafile, n // 10, seed=k)
+                datafiles.append(datafile)
+            teacher = _bare_teacher(TSCCTeacher)
+            return lambda: _consume(teacher.setup_data(datafiles))
+
+    for n in (10000, 100000):
+
+        @benchmark(f'UptakeTeacher.setup_data[pairs={n}]')
+        def setup(tmpdir, n=n):
+            datafile = join(tmpdir, 'uptake_data.csv')
+            synthetic.write_uptake_csv(datafile, n)
+            teacher = _bare_teacher(UptakeTeacher)
+            return lambda: _consume(teacher.setup_data(datafile))
+
+
+def _register_macro():
+    task = 'comparisons'
+
+    for n in (1, 5):
+
+        @benchmark(f'compute_per_item[items={n}]', suite=MACRO)
+        def setup(tmpdir, n=n):
+            items = synthetic.make_items(n, seed=n)
+            players = list(sorted(synthetic.PLAYERS))
+            return lambda: bradley_terry.compute_per_item(
+                task, players, items)
+
+
+_register_micro()
+_register_macro()
+
+
+def run_benchmarks(names, repeat=5, number=1):
+    results = collections.OrderedDict()
+    for name in names:
+        suite, setup = BENCHMARKS[name]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            func = setup(tmpdir)
+            # stan writes its progress to stderr
+            with contextlib.redirect_stderr(io.StringIO()):
+                timings = timeit.repeat(func, repeat=repeat, number=number)
+        timings = [t / number for t in timings]
+        results[name] = dict(suite=suite,
+                             median=statistics.median(timings),
+                             min=min(timings),
+                             repeat=repeat)
+        sys.stderr.write(
+            f"{name:<45} {results[name]['median']:>12.6f} s\n")
+    return results
+
+
+def compare(results, baselines, threshold):
+    # (benchmarks without a baseline are recorded, not compared)
+    regressions, missing = [], []
+    for name, result in results.items():
+        if name not in baselines:
+            missing.append(name)
+            continue
+        ratio = result['median'] / baselines[name]['median']
+        result['baseline'] = baselines[name]['median']
+        result['ratio'] = ratio
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions, missing
+
+
+def save_baselines(path, baselines, results, names):
+    baselines.update({name: dict(median=results[name]['median'],
+                                 min=results[name]['min'])
+                      for name in names})
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(baselines, fh, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def main(args):
+    names = [name for name, (suite, __) in BENCHMARKS.items()
+             if args.suite in (suite, 'all')
+             and (not args.select or any(s in name for s in args.select))]
+
+    results = run_benchmarks(names, repeat=args.repeat, number=args.number)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as fh:
+            baselines = json.load(fh)
+
+    regressions, missing = compare(results, baselines, args.threshold)
+
+    for name, result in results.items():
+        if 'ratio' in result:
+            flag = 'REGRESSION' if name in regressions else 'ok'
+            sys.stdout.write(f"{name:<45} {result['ratio']:>6.2f}x {flag}\n")
+        else:
+            sys.stdout.write(f"{name:<45} {'-':>7} recorded\n")
+
+    if args.output_file:
+        with open(args.output_file, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.save_baseline:
+        # (replace the baselines of all benchmarks that were run)
+        save_baselines(args.baselines, baselines, results, list(results))
+    else:
+        # the first run of a benchmark records its baseline
+        if missing:
+            save_baselines(args.baselines, baselines, results, missing)
+            sys.stderr.write(f"[Done] recorded {len(missing)} baselines "
+                             f"in {args.baselines}\n")
+        if regressions:
+            sys.exit(1)
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('--suite', choices=[MICRO, MACRO, 'all'],
+                        default=MICRO)
+    parser.add_argument('-k', '--select', nargs='+',
+                        help="only run benchmarks whose name "
+                             "contains one of these strings")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-n', '--number', type=int, default=1)
+    parser.add_argument('-b', '--baselines', default=BASELINES)
+    parser.add_argument('-t', '--threshold', type=float, default=.25,
+                        help="maximum relative slowdown "
+                             "against the baseline (median)")
+    parser.add_argument('-o', '--output-file')
+    parser.add_argument('--save-baseline', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -16,6 +16,16 @@ __email__ = "atack@cs.stanford.edu"
 
 DATA_DIR = abspath(join(dirname(__file__), '..', 'data'))
 
+DATASETS_DIR = join(DATA_DIR, '0_datasets')
 GENERATIONS_DIR = join(DATA_DIR, '1_generations')
 COMPARISONS_DIR = join(DATA_DIR, '2_comparisons')
 ABILITIES_DIR = join(DATA_DIR, '3_abilities')
+
+# columnar (memory-mappable) copy of the data above
+COLUMNAR_DIR = join(DATA_DIR, 'columnar')
+
+# on-disk cache of posterior fits
+FIT_CACHE_DIR = join(DATA_DIR, 'fit_cache')
+
+# fingerprints of the stages run by the pipeline
+PIPELINE_STATE = join(DATA_DIR, '.pipeline.json')
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 # standard
+import difflib
 import json
+import math
 import sys
 import time
 
@@ -41,6 +43,56 @@ TOKENS_ERROR = "This model's maximum context length is "\
                "Please reduce your prompt or completion length."
 
 
+# length penalty of the length-normalized score (Wu et al., 2016)
+LENGTH_ALPHA = 0.6
+
+# rerankers of candidate completions
+# (functions of the candidates and the prompt, returning one score per
+# candidate; candidates are dicts with their text and token logprobs)
+RERANKERS = {}
+
+
+def register_reranker(name, logprobs=False):
+    """Add a reranker (that needs the token logprobs or not)."""
+    def wrap(func):
+        func.logprobs = logprobs
+        RERANKERS[name] = func
+        return func
+    return wrap
+
+
+@register_reranker('first')
+def first(candidates, prompt):
+    # the order of the response (as without reranking)
+    return [-n for n in range(len(candidates))]
+
+
+@register_reranker('mean_logprob', logprobs=True)
+def mean_logprob(candidates, prompt):
+    return [sum(c['logprobs']) / len(c['logprobs']) if c['logprobs']
+            else float('-inf') for c in candidates]
+
+
+@register_reranker('length_normalized', logprobs=True)
+def length_normalized(candidates, prompt):
+    return [sum(c['logprobs']) / ((5 + len(c['logprobs'])) / 6) **
+            LENGTH_ALPHA if c['logprobs'] else float('-inf')
+            for c in candidates]
+
+
+@register_reranker('no_artifacts')
+def no_artifacts(candidates, prompt):
+    # penalize empty texts, role prefixes (stop sequences that leaked into
+    # the text) and texts that repeat the last turn of the student
+    last_turn = prompt.rsplit('\n', 2)[-2] if '\n' in prompt else ''
+    last_turn = last_turn.split(STUDENT_PREFIX, 1)[-1].strip()
+    return [-float(not c['text'].strip()
+                   or any(p in c['text'] for p in STOP[1:]))
+            - difflib.SequenceMatcher(None, c['text'].lower(),
+                                      last_turn.lower()).ratio()
+            for c in candidates]
+
+
 class GPT3Agent(Agent):
 
     def __init__(self, opt):
@@ -103,6 +155,36 @@ class GPT3Agent(Agent):
 
         )
 
+        # --- transport (shared by all agents, see gpt3.Transport)
+
+        self.config_http = dict(
+
+            # seconds to establish a connection / to wait for the response
+            connect_timeout=opt.get('gpt3_connect_timeout',
+                                    gpt3.CONNECT_TIMEOUT),
+            read_timeout=opt.get('gpt3_read_timeout', gpt3.READ_TIMEOUT),
+
+            # number of connections kept alive
+            pool_size=opt.get('gpt3_pool_size', gpt3.POOL_SIZE),
+
+        )
+        if self.config_http != dict(
+                connect_timeout=gpt3.transport.timeout[0],
+                read_timeout=gpt3.transport.timeout[1],
+                pool_size=gpt3.transport.pool_size):
+            gpt3.configure(**self.config_http)
+
+        # --- candidates (n completions in one request, see RERANKERS)
+
+        self.reranker = RERANKERS[opt.get('gpt3_reranker', 'first')]
+        if self.config_gpt3['n'] > 1:
+            # (the API returns the n best of best_of completions)
+            self.config_gpt3['best_of'] = max(self.config_gpt3['best_of'],
+                                              self.config_gpt3['n'])
+            if self.reranker.logprobs and \
+                    self.config_gpt3['logprobs'] is None:
+                self.config_gpt3['logprobs'] = 0
+
         self.history = []
 
         self._exit = False
@@ -193,6 +275,29 @@ class GPT3Agent(Agent):
 
         return prompt
 
+    @staticmethod
+    def extract_text(choice):
+        # extract the last text (= completion)
+        # from the entire prompt echoed back
+        full_text = choice['text']
+        full_text = full_text.rsplit('\n', 1)[-1]
+        parsed_text = parse(f'{TEACHER_PREFIX} ' + '{text}', full_text)
+        return parsed_text['text'] if parsed_text else ''
+
+    def rerank(self, response, prompt):
+        """The candidate texts (best first) and their scores."""
+        candidates = [dict(text=self.extract_text(choice),
+                           logprobs=[lp for __, lp in gpt3.span_logprobs(
+                               choice, len(prompt)) if lp is not None]
+                           if choice.get('logprobs') else [])
+                      for choice in response['choices']]
+        scores = self.reranker(candidates, prompt)
+        ranked = sorted(zip(scores, range(len(candidates))),
+                        key=lambda x: (-x[0], x[1]))
+        return ([candidates[n]['text'] for __, n in ranked],
+                [score if math.isfinite(score) else None
+                 for score, __ in ranked])
+
     def act(self):
 
         skip = False
@@ -252,19 +357,27 @@ class GPT3Agent(Agent):
         exit = False
         minute_elapsed = False
         retry_elapsed = False
+        reconnect_elapsed = False
+        timing = {}
         while not skip and not done and not exit:
             try:
                 if self.opt['dry_run']:
                     sys.stdout.write(json.dumps(kwargs) + '\n')
                     response = dict(choices=[dict(text='')])
                 else:
-                    response = gpt3.request_completion(**kwargs)
+                    response, timing = gpt3.request_completion(**kwargs)
             except openai.error.RateLimitError as e:
                 if minute_elapsed:
                     sys.stderr.write(str(e) + "\n")
                     exit = True
                 time.sleep(60)
                 minute_elapsed = True
+            except openai.error.APIConnectionError as e:
+                # (timeout or broken connection: try once more)
+                if reconnect_elapsed:
+                    sys.stderr.write(str(e) + "\n")
+                    exit = True
+                reconnect_elapsed = True
             except openai.error.InvalidRequestError as e:
                 if retry_elapsed:
                     sys.stderr.write(str(e) + "\n")
@@ -295,16 +408,22 @@ class GPT3Agent(Agent):
         # if there was no problem with GPT-3
         # save the results
         if done:
-            # extract the last text (= completion)
-            # from the entire prompt echoed back
-            full_text = response['choices'][0]['text']
-            full_text = full_text.rsplit('\n', 1)[-1]
-            parsed_text = parse(f'{TEACHER_PREFIX} ' + '{text}', full_text)
-            text = parsed_text['text'] if parsed_text else ''
+            if len(response['choices']) > 1:
+                # keep all candidates, best first
+                candidates, scores = self.rerank(response, prompt)
+                text = candidates[0]
+            else:
+                text = self.extract_text(response['choices'][0])
 
             sys.stderr.write(
-                "[Done] " + json.dumps(self.observation['wherefrom']) + '\n')
-
+                "[Done] " + json.dumps(self.observation['wherefrom']) +
+                ''.join(f" {k}={v:.3f}s" for k, v in timing.items()) + '\n')
+
+            if len(response['choices']) > 1:
+                return dict(id=self.id, text=text,
+                            text_candidates=candidates,
+                            candidate_scores=scores,
+                            openai_response=response)
             return dict(id=self.id, text=text, openai_response=response)
         # fallback: return an empty dictionary
         # to make sure there will be no error raised
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import inspect
+import itertools
+import json
+import os
+
+# third
+import numpy as np
+import torch
+from parlai.agents.transformer.transformer import TransformerGeneratorAgent
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# weights of a converted model (see src.parlai.scripts.convert_models):
+# one flat binary file with all tensors (aligned) and a JSON index,
+# memory-mapped on load: pages are read lazily, when the tensor is first
+# used, and shared by all processes that load the same model
+
+INDEX_EXT = '.index.json'
+ALIGN = 64
+
+# the agent of the converted models
+AGENT = 'src.parlai.models.mmap:MmapGeneratorAgent'
+
+# numpy has no bfloat16 (stored as raw 16-bit integers)
+_BFLOAT16 = 'bfloat16'
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def write_weights(state_dict, path, dtype=None, **meta):
+    """Write a state dict as one flat, memory-mappable file."""
+    index = {}
+    offset = 0
+    with open(path + '.tmp', 'wb') as fh:
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu().contiguous()
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            if tensor.dtype == torch.bfloat16:
+                array = tensor.view(torch.int16).numpy()
+            else:
+                array = tensor.numpy()
+            padding = -offset % ALIGN
+            fh.write(b'\0' * padding)
+            offset += padding
+            fh.write(array.tobytes())
+            index[name] = dict(dtype=_dtype_name(tensor.dtype),
+                               shape=list(tensor.shape),
+                               offset=offset,
+                               nbytes=array.nbytes)
+            offset += array.nbytes
+    with open(path + INDEX_EXT + '.tmp', 'w') as fh:
+        json.dump(dict(meta, tensors=index), fh)
+    os.replace(path + '.tmp', path)
+    os.replace(path + INDEX_EXT + '.tmp', path + INDEX_EXT)
+    return index
+
+
+def read_index(path):
+    with open(path + INDEX_EXT) as fh:
+        return json.load(fh)
+
+
+def read_weights(path):
+    """State dict of tensors backed by a memory map of the file.
+
+    The map is copy-on-write: pages are shared between processes
+    until a tensor is modified in place.
+    """
+    index = read_index(path)['tensors']
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, entry in index.items():
+        raw = buffer[entry['offset']:entry['offset'] + entry['nbytes']]
+        if entry['dtype'] == _BFLOAT16:
+            tensor = torch.from_numpy(raw.view(np.int16)).view(
+                torch.bfloat16)
+        else:
+            tensor = torch.from_numpy(raw.view(entry['dtype']))
+        state_dict[name] = tensor.reshape(entry['shape'])
+    return state_dict
+
+
+def is_fresh(path, source):
+    # the conversion of `source` is complete and up to date
+    if not (os.path.isfile(path) and os.path.isfile(path + INDEX_EXT)):
+        return False
+    # (or the only copy, if the download was removed)
+    if not os.path.isfile(source):
+        return True
+    stat = os.stat(source)
+    meta = read_index(path)
+    return meta.get('source_size') == stat.st_size and \
+        meta.get('source_mtime_ns') == stat.st_mtime_ns
+
+
+class MmapGeneratorAgent(TransformerGeneratorAgent):
+    """Transformer generator (e.g., Blender) with memory-mapped weights.
+
+    The model is built on the meta device (without allocating or
+    initializing its weights), which are then the mapped tensors.
+    Requires torch >= 2.1 (load_state_dict with assign).
+    """
+
+    def build_model(self, states=None):
+        init_model, __ = self._get_init_model(self.opt, None)
+        if init_model is None:
+            return super().build_model(states)
+        if 'assign' not in inspect.signature(
+                torch.nn.Module.load_state_dict).parameters:
+            raise Exception(f"Memory-mapped weights require torch >= 2.1 "
+                            f"(found {torch.__version__}, "
+                            f"run with --no-mmap)")
+        with torch.device('meta'):
+            return super().build_model(states)
+
+    def load(self, path):
+        states = {'model': read_weights(path)}
+        self.load_state_dict(states['model'])
+        return states
+
+    def load_state_dict(self, state_dict):
+        # use the mapped tensors as parameters (instead of copying them)
+        self.model.load_state_dict(state_dict, assign=True)
+        missing = [name for name, tensor in itertools.chain(
+            self.model.named_parameters(), self.model.named_buffers())
+            if tensor.is_meta]
+        if missing:
+            raise Exception(f"Missing weights in {len(missing)} tensors "
+                            f"(e.g., {missing[0]})")
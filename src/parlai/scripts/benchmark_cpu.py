@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import json
+import os
+import sys
+from os.path import join
+
+# third
+import parlai.scripts.eval_model
+
+# local
+from ...constants import COMPARISONS_DIR
+from ...utils import cpu
+from ..teachers import tscc  # <-- this adds new parlai teachers
+from ..scripts.eval_model import EvalModel
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# fp32 against int8 (--cpu-optimize) on a held-out slice of TSCC:
+# generated tokens per second and the change in the eval metrics
+
+ITEMS_FILE = join(COMPARISONS_DIR, 'items.jsonl')
+
+
+def held_out(datapath, items_file=ITEMS_FILE, n_files=2):
+    """Selection of whole chats that were not used in the comparisons."""
+    used = set()
+    if os.path.exists(items_file):
+        with open(items_file) as fh:
+            used = {json.loads(line)['filename'] for line in fh}
+    selection = {}
+    for filename in sorted(os.listdir(datapath)):
+        if not filename.endswith('.tsv') or filename in used:
+            continue
+        with open(join(datapath, filename)) as fh:
+            n_lines = sum(1 for __ in fh)
+        selection[filename] = list(range(n_lines + 1))
+        if len(selection) == n_files:
+            break
+    return selection
+
+
+def evaluate(args, selection, int8):
+    kwargs = {}
+    if args.init_opt:
+        kwargs['init_opt'] = args.init_opt
+        kwargs['allow_missing_init_opts'] = True
+    if args.models_dir:
+        kwargs['model_file'] = f"{args.models_dir}/{args.model_name}/model"
+    else:
+        kwargs['model'] = args.model_name
+
+    meter = cpu.Throughput()
+    with cpu.optimized_agents(parlai.scripts.eval_model, meter=meter,
+                              int8=int8):
+        report = EvalModel.main(task=tscc.TASK,
+                                datapath=args.datapath,
+                                selection=json.dumps(selection),
+                                **kwargs)
+    return dict(report, cpu=meter.report())
+
+
+def compare(fp32, int8):
+    # change of every metric that both runs report
+    return {k: int8[k] - fp32[k] for k in sorted(fp32)
+            if k in int8 and isinstance(fp32[k], (int, float))
+            and isinstance(int8[k], (int, float))}
+
+
+def main(args):
+    settings = cpu.setup(threads=args.threads,
+                         interop_threads=args.interop_threads,
+                         allocator=args.allocator,
+                         numa_node=args.numa_node)
+    selection = args.selection or held_out(args.datapath,
+                                           n_files=args.n_files)
+
+    reports = {name: evaluate(args, selection, int8=int8)
+               for name, int8 in (('fp32', False), ('int8', True))}
+    fp32, int8 = (reports['fp32']['cpu']['tokens_per_second'],
+                  reports['int8']['cpu']['tokens_per_second'])
+    out = dict(model=args.model_name,
+               settings=settings,
+               selection=selection,
+               reports=reports,
+               speedup=int8 / fp32 if fp32 and int8 else None,
+               change=compare(reports['fp32'], reports['int8']))
+
+    if args.output_file:
+        with open(args.output_file, 'w') as fh:
+            json.dump(out, fh, indent=2)
+    sys.stderr.write(f"[Done] {fp32} tokens/s (fp32), "
+                     f"{int8} tokens/s (int8)\n")
+    for metric, change in out['change'].items():
+        sys.stderr.write(f"{metric}: {change:+.4f}\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-d', '--datapath', required=True)
+    parser.add_argument('-m', '--model-name', required=True)
+    parser.add_argument('-M', '--models-dir')
+    parser.add_argument('-o', '--init-opt')
+    parser.add_argument('-O', '--output-file')
+    parser.add_argument('--selection', type=json.loads, default=r'{}')
+    parser.add_argument('--n-files', type=int, default=2,
+                        help="number of held-out chats")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--interop-threads', type=int, default=None)
+    parser.add_argument('--allocator', choices=list(cpu.ALLOCATORS),
+                        default=None)
+    parser.add_argument('--numa-node', type=int, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
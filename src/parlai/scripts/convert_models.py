@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import os
+import sys
+from os.path import dirname, join
+
+# third
+import torch
+from parlai.core.agents import load_agent_module
+from parlai.core.opt import Opt
+
+# local
+from ..models import mmap
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# one-time conversion of the downloaded models (see download_models)
+# into memory-mappable weights with a pre-built dictionary
+# e.g. downloads/models/blender/blender_3B/model
+# --> downloads/models/blender/blender_3B/mmap/model
+
+MMAP_DIR = 'mmap'
+
+# the agents whose models can be converted
+AGENTS = ['transformer/generator']
+
+DTYPES = dict(float32=torch.float32, float16=torch.float16,
+              bfloat16=torch.bfloat16)
+
+
+def converted_file(models_dir, model_name):
+    return join(models_dir, model_name, MMAP_DIR, 'model')
+
+
+def convert(model_file, output_file, dtype=torch.float32):
+    opt = Opt.load(model_file + '.opt')
+    if opt['model'] not in AGENTS:
+        raise Exception(f"Cannot convert {opt['model']} models "
+                        f"(only {', '.join(AGENTS)})")
+    os.makedirs(dirname(output_file), exist_ok=True)
+
+    # the weights, in the dtype the model runs in
+    # (such that they are used as they are mapped)
+    states = torch.load(model_file, map_location='cpu')
+    stat = os.stat(model_file)
+    index = mmap.write_weights(states['model'], output_file, dtype=dtype,
+                               source=os.path.abspath(model_file),
+                               source_size=stat.st_size,
+                               source_mtime_ns=stat.st_mtime_ns)
+    del states
+
+    # build the dictionary (and tokenizer) once, next to the weights
+    new_opt = Opt(opt)
+    new_opt['model'] = mmap.AGENT
+    new_opt['model_file'] = output_file
+    new_opt['dict_file'] = output_file + '.dict'
+    dictionary = load_agent_module(opt['model']).dictionary_class()(
+        Opt(opt, dict_file=opt.get('dict_file') or model_file + '.dict'))
+    dictionary.save(new_opt['dict_file'], sort=False)
+    new_opt.save(output_file + '.opt')
+    return index
+
+
+def main(args):
+    for model_name in args.models:
+        model_file = join(args.models_dir, model_name, 'model')
+        output_file = converted_file(args.models_dir, model_name)
+        if not args.force and mmap.is_fresh(output_file, model_file):
+            sys.stderr.write(f"[Skip] {model_name}\n")
+            continue
+        index = convert(model_file, output_file, dtype=DTYPES[args.dtype])
+        sys.stderr.write(f"[Done] {model_name}: {len(index)} tensors "
+                         f"in {output_file}\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('models_dir', type=str,
+                        help="absolute path to directory "
+                             "where the models were saved")
+    parser.add_argument('models', type=str, nargs='+', metavar='model')
+    parser.add_argument('--dtype', choices=list(DTYPES), default='float32',
+                        help="dtype of the weights "
+                             "(the dtype the model runs in)")
+    parser.add_argument('--force', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -5,8 +5,12 @@
 import json
 
 # third
+import parlai.scripts.eval_model
 from parlai.scripts.eval_model import EvalModel
 
+# local
+from ...utils import cpu
+
 
 __author__ = "Anaïs Tack"
 __credits__ = ["Anaïs Tack", "Chris Piech"]
@@ -33,5 +37,21 @@ class EvalModel(EvalModel):
             '--resume-after',
             type=json.loads,
             default=r'{}')
+        parser.add_argument(
+            '--cpu-optimize',
+            type='bool',
+            default=False,
+            help="quantize the linear layers to int8 "
+                 "and report the generated tokens per second")
 
         return parser
+
+    def run(self):
+        if not self.opt.get('cpu_optimize'):
+            return super().run()
+        # the agent is created inside parlai's eval_model
+        meter = cpu.Throughput()
+        with cpu.optimized_agents(parlai.scripts.eval_model, meter=meter):
+            report = super().run()
+        report = dict(report, cpu=meter.report())
+        return report
@@ -5,10 +5,14 @@
 import argparse as ap
 import json
 import re
+import sys
 from datetime import datetime
 
 # local
+from ...utils import cpu
+from ..models import mmap
 from ..teachers import tscc, uptake  # <-- this adds new parlai teachers
+from ..scripts import convert_models
 from ..scripts.eval_model import EvalModel
 
 
@@ -23,6 +27,15 @@ __email__ = "atack@cs.stanford.edu"
 
 def main(args):
 
+    if args.cpu_optimize:
+        # before the model is loaded
+        # (restarts the process if the environment has to change)
+        settings = cpu.setup(threads=args.threads,
+                             interop_threads=args.interop_threads,
+                             allocator=args.allocator,
+                             numa_node=args.numa_node)
+        sys.stderr.write(f"[CPU] {settings}\n")
+
     model_short = re.split(r'[/:]', args.model_name)[-1]
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     filename = f"{timestamp}_{args.task}_{model_short}"
@@ -35,8 +48,13 @@ def main(args):
         kwargs['allow_missing_init_opts'] = True
 
     # model is stored locally
+    # (memory-mapped if it was converted, see convert_models)
     if args.models_dir:
         model_file = f"{args.models_dir}/{args.model_name}/model"
+        mmap_file = convert_models.converted_file(args.models_dir,
+                                                  args.model_name)
+        if not args.no_mmap and mmap.is_fresh(mmap_file, model_file):
+            model_file = mmap_file
         kwargs['model_file'] = model_file
     else:
         kwargs['model'] = args.model_name
@@ -48,6 +66,9 @@ def main(args):
         world_logs = f"{args.output_dir}/world_logs/{filename}.jsonl"
         kwargs['world_logs'] = world_logs
 
+    if args.cpu_optimize:
+        kwargs['cpu_optimize'] = True
+
     out = EvalModel.main(
         task=args.task,
         datapath=args.datapath,
@@ -56,6 +77,9 @@ def main(args):
         resume_after=json.dumps(args.resume_after),
         **kwargs)
 
+    if args.cpu_optimize:
+        sys.stderr.write(f"[CPU] {out['cpu']}\n")
+
     # do not generate results on dry run
     if not args.dry_run:
         with open(f'{args.output_dir}/eval_out/{filename}.json', 'w') as fh:
@@ -71,8 +95,23 @@ def args_parser():
     parser.add_argument('-M', '--models-dir')
     parser.add_argument('-o', '--init-opt')
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--no-mmap', action='store_true',
+                        help="load the downloaded checkpoint even if "
+                             "a converted one exists")
     parser.add_argument('--selection', type=json.loads, default=r'{}')
     parser.add_argument('--resume-after', type=json.loads, default=r'{}')
+    parser.add_argument('--cpu-optimize', action='store_true',
+                        help="int8 dynamic quantization of the linear "
+                             "layers and CPU thread settings")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="intra-op threads (default: available cores)")
+    parser.add_argument('--interop-threads', type=int, default=None)
+    parser.add_argument('--allocator', choices=list(cpu.ALLOCATORS),
+                        default=None,
+                        help="preload a faster memory allocator")
+    parser.add_argument('--numa-node', type=int, default=None,
+                        help="run on the cores of one NUMA node "
+                             "(start one process per node)")
     return parser
 
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import json
+import math
+import os
+import re
+import sys
+import time
+from glob import glob
+from os.path import isdir, join
+
+# third
+import openai
+
+# local
+from ...utils import gpt3
+from ..models.gpt3 import GPT3Agent, INSTRUCTIONS
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# likelihood of the human teacher replies (eval_labels) under a model,
+# given the same prompt as GPT3Agent (instructions and dialogue history)
+# e.g. results/world_logs/TSCC_blender_9B.jsonl
+# --> results/world_logs/TSCC_blender_9B.davinci.scores.json (JSON lines)
+#
+# with GPT-3, the prompts and replies are echoed back with their logprobs
+# (max_tokens=0: nothing is generated), many per request;
+# with a local model, a batch is scored in one forward pass
+
+# (not .jsonl, which is what the world logs are globbed by)
+EXT = '.scores.json'
+
+# prompts per request (OpenAI) or per forward pass (local)
+BATCH_SIZE = 20
+
+
+def scores_file(world_log, model_name):
+    root, __ = os.path.splitext(world_log)
+    model_short = re.split(r'[/:]', model_name.rstrip('/'))[-1]
+    return f'{root}.{model_short}{EXT}'
+
+
+def iter_replies(world_log, instructions=INSTRUCTIONS, max_history_len=None):
+    """(wherefrom, prompt, reply) of every teacher reply in a world log."""
+    with open(world_log) as fh:
+        for line in fh:
+            history = []
+            for exchange in json.loads(line)['dialog']:
+                observation = exchange[0]
+                reply = (observation.get('eval_labels') or
+                         observation.get('labels') or [''])[0]
+                if reply:
+                    prompt = GPT3Agent.make_prompt(
+                        observation, history,
+                        instructions=instructions,
+                        max_history_len=max_history_len,
+                        max_completion_len=len(gpt3.tokenize(reply)) + 1)
+                    yield observation['wherefrom'], prompt, f' {reply}'
+                # (same history as the agent)
+                if not observation.get('episode_done'):
+                    history.insert(0, observation)
+                else:
+                    history = []
+
+
+def perplexity(logprobs):
+    return math.exp(-sum(logprobs) / len(logprobs)) if logprobs else None
+
+
+def batches(iterable, size):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class GPT3Scorer(object):
+
+    def __init__(self, engine, dry_run=False) -> None:
+        super().__init__()
+        self.engine = engine
+        self.dry_run = dry_run
+        self.tokens = 0
+
+    def request(self, texts):
+        # (wait once if the rate limit is reached)
+        try:
+            return gpt3.request_logprobs(texts, self.engine)
+        except openai.error.RateLimitError as e:
+            sys.stderr.write(str(e) + "\n")
+            time.sleep(60)
+            return gpt3.request_logprobs(texts, self.engine)
+
+    def score(self, prompts, replies):
+        texts = [p + r for p, r in zip(prompts, replies)]
+        self.tokens += sum(len(gpt3.tokenize(t)) for t in texts)
+        if self.dry_run:
+            sys.stdout.write(json.dumps(dict(prompt=texts,
+                                             engine=self.engine)) + '\n')
+            return [[] for __ in texts]
+        return [gpt3.span_logprobs(choice, len(prompt))
+                for choice, prompt in zip(self.request(texts), prompts)]
+
+    @property
+    def price(self):
+        return gpt3.PRICING[self.engine] * self.tokens
+
+
+def score_world_log(world_log, scorer, model_name, batch_size=BATCH_SIZE,
+                    **kwargs):
+    output_file = scores_file(world_log, model_name)
+    n_replies = 0
+    with open(output_file + '.tmp', 'w') as fh:
+        for batch in batches(iter_replies(world_log, **kwargs), batch_size):
+            wherefrom, prompts, replies = zip(*batch)
+            for where, scored in zip(wherefrom,
+                                     scorer.score(prompts, replies)):
+                tokens, logprobs = zip(*scored) if scored else ((), ())
+                fh.write(json.dumps(dict(
+                    wherefrom=where,
+                    model=model_name,
+                    tokens=tokens,
+                    logprobs=logprobs,
+                    n_tokens=len(tokens),
+                    logprob=sum(logprobs),
+                    perplexity=perplexity(logprobs))) + '\n')
+                n_replies += 1
+    os.replace(output_file + '.tmp', output_file)
+    return output_file, n_replies
+
+
+def main(args):
+    if args.model_name in gpt3.ENGINES:
+        scorer = GPT3Scorer(args.model_name, dry_run=args.dry_run)
+    else:
+        from ...utils.lm import LocalLM
+        scorer = LocalLM(args.model_name, device=args.device,
+                         dtype=args.dtype)
+
+    init_opt = {}
+    if args.init_opt:
+        with open(args.init_opt) as fh:
+            init_opt = json.load(fh)
+
+    for path in args.world_logs:
+        world_logs = sorted(glob(join(path, '*.jsonl'))) if isdir(path) \
+            else [path]
+        for world_log in world_logs:
+            output_file, n_replies = score_world_log(
+                world_log, scorer, args.model_name,
+                batch_size=args.batch_size,
+                instructions=init_opt.get('gpt3_instructions', INSTRUCTIONS),
+                max_history_len=init_opt.get('gpt3_max_history_len'))
+            sys.stderr.write(f"[Done] {n_replies} replies "
+                             f"in {output_file}\n")
+
+    if isinstance(scorer, GPT3Scorer):
+        sys.stderr.write(f"[Price] ${scorer.price:.2f} "
+                         f"({scorer.tokens} tokens)\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('world_logs', nargs='+',
+                        help="world logs (or directories of world logs)")
+    parser.add_argument('-m', '--model-name', required=True,
+                        help="GPT-3 engine (e.g., davinci) or the name "
+                             "or path of a local Hugging Face model "
+                             "(e.g., gpt2)")
+    parser.add_argument('-o', '--init-opt',
+                        help="options of the GPT-3 agent "
+                             "(instructions and history length)")
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--dtype', default='float32',
+                        choices=['float32', 'float16', 'bfloat16'])
+    parser.add_argument('--dry-run', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
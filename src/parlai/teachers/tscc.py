@@ -125,6 +125,63 @@ class Turn(object):
         return turn_new
 
 
+def iter_messages(datafile):
+    filename = os.path.basename(datafile)
+    tscc_chat = Chat.from_tsv(datafile)
+
+    # consider one turn as a change of role
+    # group consecutive turns with the same role
+    turns_by_role = itertools.groupby(
+        tscc_chat.turns, key=lambda t: t.role)
+    # make sure list of turns can be iterated several times
+    turns_by_role = ((role, list(turns_grp))
+                     for role, turns_grp in turns_by_role)
+
+    # group turns by dialogic pairs with the same counter
+    # the counter starts from 1
+    # - if the chat does not start with role_first
+    # - (e.g. student starts conversation)
+    # the counter starts from 0
+    # - if the chat does not start with role_first
+    # - (e.g. teacher starts conversation)
+    pair_func = _make_dialogic_pairs(role_first=ROLE_STUDENT)
+    turns_by_pair = itertools.groupby(
+        turns_by_role, key=lambda rt_pair: pair_func(rt_pair[0]))
+
+    for i, (__, grouper) in enumerate(turns_by_pair):
+        new = True if i == 0 else False  # is this a new episode?
+        roles, turns = zip(*grouper)
+        turns = tuple(turns)
+        # base case: dialogic pair (student, teacher)
+        if len(turns) == 2:
+            msg = dict(text=_concat_turns(turns[0]),
+                       labels=[_concat_turns(turns[1])],)
+        # special case:
+        # the chat does not start with student or end with teacher
+        # (a) the call is empty, but not the response
+        # --> teacher is the first person who speaks
+        # (b) the call is empty, but no response
+        # --> student is the last person who speaks
+        elif len(turns) == 1:
+            if roles[0] == ROLE_TEACHER:
+                msg = dict(labels=[_concat_turns(turns[0])])
+            else:
+                msg = dict(text=_concat_turns(turns[0]))
+        else:
+            raise Exception(
+                "Number of turns in dialogic pair should be 2 (or 1), "
+                "not {}".format(len(turns)))
+
+        # save reference to filename and lines
+        msg['wherefrom'] = dict(
+            filename=filename,
+            line_idx=[turn.line_idx
+                      for speaker in turns
+                      for turn in speaker])
+
+        yield msg, new
+
+
 @register_teacher(TASK)
 class TSCCTeacher(DialogTeacher):
 
@@ -146,57 +203,8 @@ class TSCCTeacher(DialogTeacher):
 
             # Datafile tells us where to load from.
             print(f" ~~ Loading from {datafile} ~~ ")
-            tscc_chat = Chat.from_tsv(datafile)
-
-            # consider one turn as a change of role
-            # group consecutive turns with the same role
-            turns_by_role = itertools.groupby(
-                tscc_chat.turns, key=lambda t: t.role)
-            # make sure list of turns can be iterated several times
-            turns_by_role = ((role, list(turns_grp))
-                             for role, turns_grp in turns_by_role)
-
-            # group turns by dialogic pairs with the same counter
-            # the counter starts from 1
-            # - if the chat does not start with role_first
-            # - (e.g. student starts conversation)
-            # the counter starts from 0
-            # - if the chat does not start with role_first
-            # - (e.g. teacher starts conversation)
-            pair_func = _make_dialogic_pairs(role_first=ROLE_STUDENT)
-            turns_by_pair = itertools.groupby(
-                turns_by_role, key=lambda rt_pair: pair_func(rt_pair[0]))
-
-            for i, (__, grouper) in enumerate(turns_by_pair):
-                new = True if i == 0 else False  # is this a new episode?
-                roles, turns = zip(*grouper)
-                turns = tuple(turns)
-                # base case: dialogic pair (student, teacher)
-                if len(turns) == 2:
-                    msg = dict(text=_concat_turns(turns[0]),
-                               labels=[_concat_turns(turns[1])],)
-                # special case:
-                # the chat does not start with student or end with teacher
-                # (a) the call is empty, but not the response
-                # --> teacher is the first person who speaks
-                # (b) the call is empty, but no response
-                # --> student is the last person who speaks
-                elif len(turns) == 1:
-                    if roles[0] == ROLE_TEACHER:
-                        msg = dict(labels=[_concat_turns(turns[0])])
-                    else:
-                        msg = dict(text=_concat_turns(turns[0]))
-                else:
-                    raise Exception(
-                        "Number of turns in dialogic pair should be 2 (or 1), "
-                        "not {}".format(len(turns)))
-
-                # save reference to filename and lines
-                msg['wherefrom'] = dict(
-                    filename=filename,
-                    line_idx=[turn.line_idx
-                              for speaker in turns
-                              for turn in speaker])
+
+            for msg, new in iter_messages(datafile):
 
                 # select only relevant messages
                 if self.opt.get('selection'):
@@ -92,6 +92,22 @@ class Pair(object):
             line_idx, *map(lambda x: None if x == cls.NA_VAL else x, cols))
 
 
+def iter_messages(datafile):
+    filename = os.path.basename(datafile)
+    uptake_chat = Chat.from_csv(datafile)
+
+    for pair in uptake_chat.pairs:
+        new = True  # is this a new episode?
+        msg = dict(text=pair.student_text, label=pair.teacher_text)
+
+        # save reference to filename and lines
+        msg['wherefrom'] = dict(
+            filename=filename,
+            line_idx=pair.line_idx)
+
+        yield msg, new
+
+
 @register_teacher(TASK)
 class UptakeTeacher(DialogTeacher):
 
@@ -104,17 +120,5 @@ class UptakeTeacher(DialogTeacher):
         return False
 
     def setup_data(self, datafile):
-        filename = os.path.basename(datafile)
         # print(f" ~~ Loading from {datafile} ~~ ")
-        uptake_chat = Chat.from_csv(datafile)
-
-        for pair in uptake_chat.pairs:
-            new = True  # is this a new episode?
-            msg = dict(text=pair.student_text, label=pair.teacher_text)
-
-            # save reference to filename and lines
-            msg['wherefrom'] = dict(
-                filename=filename,
-                line_idx=pair.line_idx)
-
-            yield msg, new
+        yield from iter_messages(datafile)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import fnmatch
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+from os.path import dirname, isdir, join
+
+# third
+import yaml
+
+# local
+from .constants import (ABILITIES_DIR, COLUMNAR_DIR, COMPARISONS_DIR,
+                        DATASETS_DIR, GENERATIONS_DIR, PIPELINE_STATE)
+from .stan import bradley_terry, comparisons
+from .stan.cache import FitCache
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# the stages of the data, from 0_datasets to 3_abilities, as a DAG
+#
+#   repopulate (0_datasets -> 1_generations, 3_abilities/*.jsonl)
+#   generate:<task>:<model> (0_datasets -> results/, optional)
+#   comparisons (2_comparisons/items.jsonl -> comparisons table)
+#   abilities:<attribute> (comparisons table, outliers -> 3_abilities/*.csv)
+#   contrasts (3_abilities/*.csv -> ∆ abilities against the teacher)
+#   columnar (1_generations, 2_comparisons, 3_abilities -> columnar store)
+#     (with the abilities recomputed from the comparisons, if any)
+#
+# a stage is run again only if the fingerprint of its inputs (contents),
+# code (source files) and options changed, or if its outputs changed
+# since it last ran; stages that do not depend on each other run in parallel
+
+DATASETS = {
+    'TSCC': join(DATASETS_DIR, 'tscc'),
+    'EduUptake': join(DATASETS_DIR, 'uptake'),
+}
+
+ITEMS_FILE = join(COMPARISONS_DIR, 'items.jsonl')
+OUTLIERS_FILE = join(COMPARISONS_DIR, 'outliers.yaml')
+CONTRASTS_FILE = join(ABILITIES_DIR, 'contrasts.csv')
+RESULTS_DIR = 'results'
+
+CHUNK_SIZE = 1 << 20
+
+
+def slug(text):
+    return re.sub(r'[^A-Za-z0-9]+', '_', text).strip('_')
+
+
+# stages
+# (module-level functions, such that they can run in worker processes)
+
+def run_repopulate(tasks):
+    from .utils import repopulate
+    for task, datapath in tasks.items():
+        repopulate.main(repopulate.args_parser().parse_args(
+            ['-t', task, '-d', datapath]))
+
+
+def run_generate(task, datapath, model_name, output_dir, models_dir=None,
+                 init_opt=None):
+    from .parlai.scripts import run
+    for subdir in ('reports', 'world_logs', 'eval_out'):
+        os.makedirs(join(output_dir, subdir), exist_ok=True)
+    argv = ['-t', task, '-d', datapath, '-m', model_name, '-O', output_dir]
+    if models_dir:
+        argv += ['-M', models_dir]
+    if init_opt:
+        argv += ['-o', init_opt]
+    run.main(run.args_parser().parse_args(argv))
+
+
+def run_comparisons(items_file):
+    comparisons.load(items_file)
+
+
+def run_abilities(items_file, attribute, output_file, outliers_file=None,
+                  method=bradley_terry.NUTS, jobs=None, num_chains=None):
+    table = comparisons.load(items_file)
+    players = list(table['player_a'].cat.categories)
+    outliers = None
+    if outliers_file:
+        with open(outliers_file) as fh:
+            outliers = yaml.safe_load(fh)
+    kwargs = {}
+    if method != bradley_terry.FAST:
+        kwargs = dict(jobs=jobs, num_chains=num_chains, cache=FitCache())
+    df = bradley_terry.compute_per_item(
+        comparisons.TASK, players, table[table['attribute'] == attribute],
+        outliers=outliers, method=method, **kwargs)
+    df.to_csv(output_file + '.tmp', index=False)
+    os.replace(output_file + '.tmp', output_file)
+
+
+def run_contrasts(abilities_files, output_file):
+    from .stan import contrasts
+    keys, values = contrasts.deltas(
+        contrasts.load_summaries(abilities_files))
+    df = contrasts.aggregate(keys, values, by=contrasts.GROUPS)
+    df.to_csv(output_file + '.tmp', index=False)
+    os.replace(output_file + '.tmp', output_file)
+
+
+def run_columnar(store_dir, abilities_files=()):
+    from .utils import columnar
+    columnar.convert(store_dir=store_dir, estimates_files=abilities_files)
+
+
+class Stage(object):
+    """A step of the pipeline.
+
+    Inputs and outputs are paths or glob patterns (directories stand for
+    all the files in them). Code is the modules whose source files
+    define what the stage computes.
+    """
+
+    def __init__(self, name, func, kwargs=None, inputs=(), outputs=(),
+                 code=(), deps=()) -> None:
+        super().__init__()
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = [__name__] + list(code)
+        self.deps = list(deps)
+
+    def __repr__(self) -> str:
+        return f"Stage({self.name})"
+
+
+def stages(args):
+    """The DAG of the pipeline (in topological order)."""
+    dag = []
+
+    datasets = {task: path for task, path in DATASETS.items()
+                if isdir(path) and any(
+                    not f.endswith('README.rst') for f in os.listdir(path))}
+    if datasets:
+        dag.append(Stage('repopulate', run_repopulate,
+                         dict(tasks=datasets),
+                         inputs=list(datasets.values()),
+                         outputs=[join(GENERATIONS_DIR, '*.jsonl'),
+                                  join(ABILITIES_DIR, '*.jsonl')],
+                         code=['src.utils.repopulate',
+                               'src.utils.text_index']))
+
+    for spec in args.generate or []:
+        task, __, model_name = spec.partition(':')
+        output_dir = join(args.results_dir,
+                          f"{task}_{slug(model_name)}")
+        dag.append(Stage(f'generate:{task}:{model_name}', run_generate,
+                         dict(task=task, datapath=DATASETS[task],
+                              model_name=model_name, output_dir=output_dir,
+                              models_dir=args.models_dir,
+                              init_opt=args.init_opt),
+                         inputs=[DATASETS[task]] + (
+                             [args.init_opt] if args.init_opt else []),
+                         outputs=[join(output_dir, 'world_logs')],
+                         code=['src.parlai.scripts.run',
+                               'src.parlai.scripts.eval_model',
+                               'src.parlai.models.gpt3',
+                               'src.parlai.teachers.tscc'
+                               if task == 'TSCC'
+                               else 'src.parlai.teachers.uptake']))
+
+    abilities_files = []
+    if os.path.exists(args.items_file):
+        table_file = comparisons.default_path(args.items_file)
+        dag.append(Stage('comparisons', run_comparisons,
+                         dict(items_file=args.items_file),
+                         inputs=[args.items_file],
+                         outputs=[table_file],
+                         code=['src.stan.comparisons']))
+
+        outliers = [args.outliers] if args.outliers else []
+        for attribute in comparisons.attributes(args.items_file):
+            output_file = join(ABILITIES_DIR,
+                               f'abilities.{slug(attribute)}.csv')
+            abilities_files.append(output_file)
+            dag.append(Stage(
+                f'abilities:{attribute}', run_abilities,
+                dict(items_file=args.items_file, attribute=attribute,
+                     output_file=output_file, outliers_file=args.outliers,
+                     method=args.method, jobs=args.fit_jobs,
+                     num_chains=args.chains),
+                inputs=[table_file] + outliers,
+                outputs=[output_file],
+                code=['src.stan.bradley_terry', 'src.stan.adaptive',
+                      'src.stan.fast', 'src.stan.summary',
+                      'src.stan.comparisons', 'src.stan.cache',
+                      'src.stan.results',
+                      join(dirname(__file__), 'stan',
+                           'bradley-terry-bayesian.stan')],
+                deps=['comparisons']))
+
+        dag.append(Stage('contrasts', run_contrasts,
+                         dict(abilities_files=abilities_files,
+                              output_file=args.contrasts_file),
+                         inputs=abilities_files,
+                         outputs=[args.contrasts_file],
+                         code=['src.stan.contrasts'],
+                         deps=[s.name for s in dag
+                               if s.name.startswith('abilities:')]))
+
+    dag.append(Stage('columnar', run_columnar,
+                     dict(store_dir=args.store_dir,
+                          abilities_files=abilities_files),
+                     inputs=[join(GENERATIONS_DIR, '*.jsonl'),
+                             join(COMPARISONS_DIR, '*.jsonl'),
+                             join(ABILITIES_DIR, '*.jsonl')]
+                     + abilities_files,
+                     outputs=[args.store_dir],
+                     code=['src.utils.columnar', 'src.stan.comparisons',
+                           'src.stan.contrasts'],
+                     deps=(['repopulate'] if datasets else [])
+                     + [s.name for s in dag
+                        if s.name.startswith('abilities:')]))
+    return dag
+
+
+class Fingerprints(object):
+    """Content hashes of files and the last run of every stage.
+
+    File hashes are cached by size and modification time,
+    such that unchanged files are not read again.
+    """
+
+    def __init__(self, state_file=PIPELINE_STATE) -> None:
+        super().__init__()
+        self.state_file = state_file
+        self.state = dict(files={}, stages={})
+        if os.path.exists(state_file):
+            with open(state_file) as fh:
+                self.state = json.load(fh)
+
+    def file(self, path):
+        stat = os.stat(path)
+        cached = self.state['files'].get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.state['files'][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def files(self, patterns):
+        # {path: hash} of all files matching the patterns
+        paths = set()
+        for pattern in patterns:
+            for path in glob(pattern):
+                if isdir(path):
+                    paths.update(p for p in glob(join(path, '**', '*'),
+                                                 recursive=True)
+                                 if not isdir(p))
+                else:
+                    paths.add(path)
+        return {path: self.file(path) for path in sorted(paths)
+                if not path.endswith(('.tmp', '.bak'))}
+
+    def code(self, modules):
+        # hash of the source files of the modules (without importing them)
+        digests = {}
+        for module in modules:
+            path = module if os.path.exists(module) else \
+                importlib.util.find_spec(module).origin
+            digests[module] = self.file(path)
+        return digests
+
+    def stage(self, stage):
+        payload = json.dumps(dict(kwargs=stage.kwargs,
+                                  inputs=self.files(stage.inputs),
+                                  code=self.code(stage.code)),
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_fresh(self, stage):
+        last = self.state['stages'].get(stage.name)
+        if last is None or last['fingerprint'] != self.stage(stage):
+            return False
+        outputs = self.files(stage.outputs)
+        return bool(outputs) and outputs == last['outputs']
+
+    def record(self, stage):
+        self.state['stages'][stage.name] = dict(
+            fingerprint=self.stage(stage),
+            outputs=self.files(stage.outputs))
+        self.save()
+
+    def save(self):
+        os.makedirs(dirname(self.state_file), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname(self.state_file))
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(self.state, fh)
+        os.replace(tmp, self.state_file)
+
+
+def run(dag, fingerprints, jobs=None, force=(), select=None, dry_run=False):
+    """Run the stale stages, independent ones in parallel.
+
+    A stage is checked once all stages it depends on are done
+    (their new outputs are then part of its fingerprint).
+    Returns the names of the stages that ran.
+    """
+    by_name = {stage.name: stage for stage in dag}
+    deps = {stage.name: {d for d in stage.deps if d in by_name}
+            for stage in dag}
+    selected = {stage.name for stage in dag
+                if not select or any(fnmatch.fnmatch(stage.name, pattern)
+                                     for pattern in select)}
+    done, pending, ran, running = set(), set(), [], {}
+
+    def ready():
+        return [name for name in by_name
+                if name not in done and name not in running.values()
+                and deps[name] <= done]
+
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        while len(done) < len(by_name):
+            for name in ready():
+                stage = by_name[name]
+                # (in a dry run, the dependents of stale stages are stale)
+                stale = name in selected and (
+                    any(fnmatch.fnmatch(name, f) for f in force)
+                    or bool(deps[name] & pending)
+                    or not fingerprints.is_fresh(stage))
+                if not stale:
+                    status = "Fresh" if name in selected else "Skipped"
+                    sys.stderr.write(f"[{status}] {name}\n")
+                    done.add(name)
+                elif dry_run:
+                    sys.stderr.write(f"[Stale] {name}\n")
+                    done.add(name)
+                    pending.add(name)
+                else:
+                    sys.stderr.write(f"[Run] {name}\n")
+                    running[executor.submit(stage.func,
+                                            **stage.kwargs)] = name
+            if not running:
+                continue
+            finished, __ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                fingerprints.record(by_name[name])
+                sys.stderr.write(f"[Done] {name}\n")
+                done.add(name)
+                ran.append(name)
+    return ran
+
+
+def main(args):
+    dag = stages(args)
+    if args.list:
+        for stage in dag:
+            deps = f" <- {', '.join(stage.deps)}" if stage.deps else ""
+            sys.stdout.write(f"{stage.name}{deps}\n")
+        return
+    fingerprints = Fingerprints(args.state_file)
+    ran = run(dag, fingerprints, jobs=args.jobs, force=args.force or (),
+              select=args.stages, dry_run=args.dry_run)
+    fingerprints.save()
+    sys.stderr.write(f"[Done] {len(ran)} of {len(dag)} stages ran\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('stages', nargs='*',
+                        help="only these stages (glob patterns, "
+                             "e.g. 'abilities:*')")
+    parser.add_argument('--list', action='store_true',
+                        help="list the stages and their dependencies")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="only report which stages are stale")
+    parser.add_argument('-f', '--force', nargs='+',
+                        help="run these stages even if they are fresh")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of stages in parallel")
+    parser.add_argument('--state-file', default=PIPELINE_STATE)
+    parser.add_argument('--items-file', default=ITEMS_FILE)
+    parser.add_argument('--outliers', default=OUTLIERS_FILE)
+    parser.add_argument('--method', choices=bradley_terry.METHODS,
+                        default=bradley_terry.NUTS)
+    parser.add_argument('--fit-jobs', type=int, default=None,
+                        help="fits in flight per abilities stage")
+    parser.add_argument('--chains', type=int,
+                        default=bradley_terry.NUM_CHAINS)
+    parser.add_argument('--contrasts-file', default=CONTRASTS_FILE)
+    parser.add_argument('--store-dir', default=COLUMNAR_DIR)
+    parser.add_argument('--generate', nargs='+', metavar='TASK:MODEL',
+                        help="also generate responses, "
+                             "e.g. TSCC:blender/blender_9B")
+    parser.add_argument('-M', '--models-dir')
+    parser.add_argument('-o', '--init-opt')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import copy
+import itertools
+import json
+import math
+import random
+import sys
+
+# third
+import pandas as pd
+
+# local
+from . import comparisons, online
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# active comparative judgment: which pair of responses to show next
+# a survey task is one item and one pair of players,
+# judged on all attributes (as in the comparisons we collected)
+# beliefs are the normal beliefs of src.stan.online,
+# either kept by the online updates or taken from bradley_terry estimates
+
+# expected information gain on the abilities or widest ∆-ability interval
+GAIN = 'gain'
+WIDTH = 'width'
+CRITERIA = [GAIN, WIDTH]
+
+# width of the 95% interval of a difference in abilities
+Z = 1.96
+
+# slack on the interval width reached with all judgments of an item
+# (the updates slightly depend on the order of the judgments)
+TOLERANCE = .01
+
+
+def _var(belief, player):
+    return belief['var'].get(player, online.PRIOR_VAR)
+
+
+def _posterior_var(var, c, z, r):
+    return var * (1 - var * r * (r + z) / c ** 2)
+
+
+def width(belief, player_a, player_b):
+    # 95% interval width of alpha_a - alpha_b
+    return 2 * Z * math.sqrt(_var(belief, player_a) + _var(belief, player_b))
+
+
+def max_width(beliefs, players):
+    return max(width(belief, a, b)
+               for belief in beliefs.values()
+               for a, b in itertools.combinations(players, 2))
+
+
+def expected_gain(belief, player_a, player_b):
+    """Expected information gain of judging a against b (in nats).
+
+    The reduction in entropy of the beliefs about both abilities,
+    averaged over the predictive probability of either outcome.
+    """
+    p = online.probability(belief, player_a, player_b)
+    gain = 0.
+    for a_gt_b, weight in ((True, p), (False, 1 - p)):
+        c, z, r = online.factors(belief, player_a, player_b, a_gt_b)
+        for player in (player_a, player_b):
+            var = _var(belief, player)
+            gain += weight * .5 * math.log(
+                var / _posterior_var(var, c, z, r))
+    return gain
+
+
+def score(beliefs, player_a, player_b, criterion=GAIN):
+    # the value of showing a pair for all attributes of an item
+    if criterion == GAIN:
+        return sum(expected_gain(belief, player_a, player_b)
+                   for belief in beliefs.values())
+    return max(width(belief, player_a, player_b)
+               for belief in beliefs.values())
+
+
+def best_pair(beliefs, pairs, criterion=GAIN):
+    # (score, pair) of the most valuable pair
+    return max(((score(beliefs, a, b, criterion), (a, b)) for a, b in pairs),
+               key=lambda scored: scored[0], default=(None, None))
+
+
+def expect(belief, player_a, player_b):
+    """Shrink the variances by the expected update (in place).
+
+    Used to spread a batch over items and pairs before any of its
+    judgments comes back (the means stay as they are).
+    """
+    p = online.probability(belief, player_a, player_b)
+    updated = {}
+    for a_gt_b, weight in ((True, p), (False, 1 - p)):
+        c, z, r = online.factors(belief, player_a, player_b, a_gt_b)
+        for player in (player_a, player_b):
+            updated[player] = updated.get(player, 0.) + weight \
+                * _posterior_var(_var(belief, player), c, z, r)
+        updated['__0'] = updated.get('__0', 0.) + weight \
+            * _posterior_var(belief['var_0'], c, z, r)
+    belief['var_0'] = updated.pop('__0')
+    belief['var'].update(updated)
+    return belief
+
+
+def by_item(beliefs):
+    # {(task, filename, line_idx): {attribute: belief}}
+    items = {}
+    for (task, filename, line_idx, attr), belief in beliefs.items():
+        items.setdefault((task, filename, line_idx), {})[attr] = belief
+    return items
+
+
+def from_abilities(df):
+    # normal beliefs from the estimates of bradley_terry (CSV)
+    beliefs = {}
+    for row in df.itertuples(index=False):
+        key = (row.task, row.filename, str(row.line_idx), row.attribute)
+        belief = beliefs.setdefault(key, online.new_belief())
+        belief['mean'][row.model] = row.alpha_mean
+        belief['var'][row.model] = row.alpha_sd ** 2
+        belief['mean_0'] = row.alpha_0_mean
+        belief['var_0'] = row.alpha_0_sd ** 2
+        belief['anchor'][row.model] = row.alpha_mean
+        belief['source'] = online.STAN
+    return beliefs
+
+
+def item_players(attrs, players=None):
+    # the players with a response to the item: those in its judgments
+    # (online beliefs, whose stan fits cover all players) or else those
+    # in its estimates (bradley_terry only reports the players present)
+    # (among the given players, if any)
+    present = {player for belief in attrs.values()
+               for game in belief['games'] for player in game[:2]} or \
+        {player for belief in attrs.values() for player in belief['mean']}
+    return sorted(present if players is None else present & set(players))
+
+
+def next_batch(beliefs, size, players=None, criterion=GAIN, target=None,
+               max_per_item=None, seed=0):
+    """The next `size` survey tasks (item and pair of players).
+
+    Pairs are chosen greedily across items, among the players that
+    responded to the item (those in its beliefs, restricted to `players`
+    if given). After every choice, the beliefs of the item are shrunk by
+    the expected update, so that the batch does not ask the same question
+    over and over. Items whose ∆-ability intervals are all narrower than
+    `target` are not asked again. The order of the pair is random.
+    """
+    rng = random.Random(seed)
+    items = {key: copy.deepcopy(attrs)
+             for key, attrs in by_item(beliefs).items()}
+    present = {key: item_players(attrs, players)
+               for key, attrs in items.items()}
+    pairs = {key: list(itertools.combinations(present[key], 2))
+             for key in items}
+    counts = dict.fromkeys(items, 0)
+
+    def best(key):
+        if max_per_item is not None and counts[key] >= max_per_item:
+            return None, None
+        if not pairs[key]:
+            return None, None
+        if target is not None and \
+                max_width(items[key], present[key]) <= target:
+            return None, None
+        return best_pair(items[key], pairs[key], criterion)
+
+    scores = {key: best(key) for key in items}
+    tasks = []
+    while len(tasks) < size:
+        candidates = [(value, key) for key, (value, __) in scores.items()
+                      if value is not None]
+        if not candidates:
+            break
+        value, key = max(candidates, key=lambda candidate: candidate[0])
+        player_a, player_b = scores[key][1]
+        if rng.random() < .5:
+            player_a, player_b = player_b, player_a
+        task, filename, line_idx = key
+        tasks.append(dict(task=task,
+                          filename=filename,
+                          line_idx=json.loads(line_idx),
+                          player_a=player_a,
+                          player_b=player_b,
+                          attributes=sorted(items[key]),
+                          criterion=criterion,
+                          score=value))
+        for belief in items[key].values():
+            expect(belief, player_a, player_b)
+        counts[key] += 1
+        scores[key] = best(key)
+    return tasks
+
+
+def judgments(table):
+    """The judgments of every item, in the order they were collected.
+
+    Returns {(task, filename, line_idx): [(player_a, player_b, outcomes)]}
+    with one judgment per rater, where outcomes maps every attribute
+    to a_gt_b (None for ties).
+    """
+    items = {}
+    outcome = table['y'].astype(bool).where(~table['is_tie'], None)
+    for __, df in table.assign(outcome=outcome).groupby(
+            ['item', 'rater'], sort=False, observed=True):
+        row = df.iloc[0]
+        key = (row['task'], row['filename'], row['line_idx'])
+        items.setdefault(key, []).append(
+            (row['player_a'], row['player_b'],
+             dict(zip(df['attribute'], df['outcome']))))
+    return items
+
+
+def _beliefs(players, attributes):
+    beliefs = {attr: online.new_belief() for attr in attributes}
+    for belief in beliefs.values():
+        for player in players:
+            belief['mean'][player] = online.PRIOR_MEAN
+            belief['var'][player] = online.PRIOR_VAR
+    return beliefs
+
+
+def _apply(beliefs, judgment):
+    player_a, player_b, outcomes = judgment
+    for attr, a_gt_b in outcomes.items():
+        online.update(beliefs[attr], player_a, player_b, a_gt_b)
+
+
+def replay(judgments_, players, attributes, target, order=None,
+           criterion=None):
+    """Number of judgments until all ∆-ability intervals reach `target`.
+
+    Judgments are taken in the given order or, with a criterion,
+    the next judgment is the one whose pair is the most valuable
+    under the current beliefs (among the judgments that are left).
+    Returns (number of judgments, whether the target was reached).
+    """
+    beliefs = _beliefs(players, attributes)
+    pool = [judgments_[n] for n in (order or range(len(judgments_)))]
+    n = 0
+    while pool:
+        if max_width(beliefs, players) <= target:
+            return n, True
+        if criterion is None:
+            judgment = pool.pop(0)
+        else:
+            __, pair = best_pair(beliefs, {j[:2] for j in pool}, criterion)
+            judgment = pool.pop(next(k for k, j in enumerate(pool)
+                                     if j[:2] == pair))
+        _apply(beliefs, judgment)
+        n += 1
+    return n, max_width(beliefs, players) <= target
+
+
+def simulate(table, criterion=GAIN, target=None, repeats=10, seed=0):
+    """Judgments needed by active and random selection, per item.
+
+    The existing judgments of every item are replayed, either in a
+    random order (as if collected without a scheduler) or chosen by the
+    scheduler, until the intervals are as narrow as with all judgments
+    (or `target`).
+    """
+    rng = random.Random(seed)
+    players = list(table['player_a'].cat.categories)
+    records = []
+    for key, judgments_ in judgments(table).items():
+        attributes = sorted({attr for __, __, outcomes in judgments_
+                             for attr in outcomes})
+        beliefs = _beliefs(players, attributes)
+        for judgment in judgments_:
+            _apply(beliefs, judgment)
+        full_width = max_width(beliefs, players)
+        item_target = target or full_width * (1 + TOLERANCE)
+
+        n_active, reached = replay(judgments_, players, attributes,
+                                   item_target, criterion=criterion)
+        n_random = []
+        for __ in range(repeats):
+            order = list(range(len(judgments_)))
+            rng.shuffle(order)
+            n, __ = replay(judgments_, players, attributes, item_target,
+                           order=order)
+            n_random.append(n)
+
+        task, filename, line_idx = key
+        records.append(dict(task=task,
+                            filename=filename,
+                            line_idx=line_idx,
+                            n_judgments=len(judgments_),
+                            width=full_width,
+                            target=item_target,
+                            n_active=n_active,
+                            n_random=sum(n_random) / repeats,
+                            reached=reached))
+    return pd.DataFrame.from_records(records)
+
+
+def main(args):
+    if args.command == 'simulate':
+        table = comparisons.load(args.items_jsonl)
+        df = simulate(table, criterion=args.criterion, target=args.width,
+                      repeats=args.repeats, seed=args.seed)
+        if args.output_file:
+            df.to_csv(args.output_file, index=False)
+        n_random, n_active = df['n_random'].sum(), df['n_active'].sum()
+        sys.stderr.write(
+            f"[Done] {df['n_judgments'].sum()} judgments collected, "
+            f"{n_random:.0f} needed in random order, "
+            f"{n_active} with {args.criterion} "
+            f"({1 - n_active / n_random:.1%} saved)\n")
+        return
+
+    if args.abilities:
+        beliefs = from_abilities(pd.read_csv(args.abilities))
+    else:
+        abilities = online.OnlineAbilities(args.events_file,
+                                           state_file=args.state_file)
+        abilities.consume()
+        beliefs = abilities.beliefs
+    tasks = next_batch(beliefs, args.batch_size,
+                       criterion=args.criterion, target=args.width,
+                       max_per_item=args.max_per_item, seed=args.seed)
+    lines = ''.join(json.dumps(task) + '\n' for task in tasks)
+    if args.output_file:
+        with open(args.output_file, 'w') as fh:
+            fh.write(lines)
+    else:
+        sys.stdout.write(lines)
+    sys.stderr.write(f"[Done] {len(tasks)} survey tasks\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-o', '--output-file')
+    parser.add_argument('--criterion', choices=CRITERIA, default=GAIN,
+                        help="expected information gain on the abilities "
+                             "(gain) or the widest ∆-ability interval "
+                             "(width)")
+    parser.add_argument('--width', type=float, default=None,
+                        help="stop asking about an item once all its "
+                             "∆-ability intervals are this narrow")
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    next_ = subparsers.add_parser('next')
+    next_.add_argument('-n', '--batch-size', type=int, default=100)
+    next_.add_argument('--max-per-item', type=int, default=None)
+    next_.add_argument('--abilities',
+                       help="estimates of bradley_terry (CSV), "
+                            "instead of the online beliefs")
+    next_.add_argument('-e', '--events-file', default=online.EVENTS_FILE)
+    next_.add_argument('-s', '--state-file')
+    simulate_ = subparsers.add_parser('simulate')
+    simulate_.add_argument('items_jsonl')
+    simulate_.add_argument('--repeats', type=int, default=10)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
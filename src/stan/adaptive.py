@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# third
+import numpy as np
+import stan
+
+# local
+from . import summary
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# warmup of the first round (the default of stan)
+NUM_WARMUP = 1000
+# draws per chain of the first round (doubled in every extension)
+NUM_SAMPLES = 250
+# draws per chain after which a fit is no longer extended
+MAX_SAMPLES = 4000
+
+# convergence criteria (on the parameters being checked)
+R_HAT = 1.01
+ESS = 400
+
+
+def get_draws(fit, names=None):
+    """Draws of a PyStan fit as arrays of shape (chain, draw, *dims)."""
+    names = names or fit.param_names
+    draws = {}
+    for name in names:
+        if name.endswith('__'):
+            dims = []
+        else:
+            dims = fit.dims[fit.param_names.index(name)]
+        # the draws of all chains are interleaved (draw after draw)
+        values = np.moveaxis(fit[name].reshape(*dims, -1), -1, 0)
+        draws[name] = np.swapaxes(
+            values.reshape(-1, fit.num_chains, *dims), 0, 1)
+    return draws
+
+
+def converged(draws, var_names, r_hat=R_HAT, ess=ESS):
+    # rank-normalized split R-hat and bulk/tail ESS of every component
+    for name in var_names:
+        values = np.moveaxis(draws[name], (0, 1), (-2, -1))
+        if values.shape[-1] < 4:
+            return False
+        if not (np.all(summary.rhat(values) <= r_hat)
+                and np.all(summary.ess_bulk(values) >= ess)
+                and np.all(summary.ess_tail(values) >= ess)):
+            return False
+    return True
+
+
+def _continuation(draws, params):
+    # continue every chain from its last draw with the adapted step size
+    # (without warmup: the chains of all rounds are continuous)
+    num_chains = draws['stepsize__'].shape[0]
+    stepsize = float(np.median(draws['stepsize__'][:, -1]))
+    init = [{name: draws[name][c, -1].tolist() for name in params}
+            for c in range(num_chains)]
+    return dict(num_warmup=0, stepsize=stepsize, init=init)
+
+
+def sample(program, data, params, check=('alpha',), seed=0, num_chains=4,
+           r_hat=R_HAT, ess=ESS, num_samples=NUM_SAMPLES,
+           max_samples=MAX_SAMPLES):
+    """Sample until the parameters in `check` have converged.
+
+    The first round runs the usual warmup with few draws per chain.
+    If R-hat or ESS fail the criteria, every chain is continued from its
+    last draw (in `params`) with the adapted step size and no warmup,
+    doubling its length, until they pass or reach `max_samples` draws per
+    chain. The draws of a chain across rounds form one continuous chain,
+    on which R-hat and ESS are computed.
+
+    The mass matrix is not reused (httpstan does not accept one): the
+    continued chains run with a unit metric, from the median adapted step
+    size (which stan rescales once when a chain starts).
+
+    Returns the draws of all rounds as arrays of shape (chain, draw, *dims)
+    (including the sampler diagnostics, e.g. 'stepsize__').
+    """
+    draws = None
+    kwargs = dict(num_warmup=NUM_WARMUP)
+    round_ = 0
+    while True:
+        # a new seed per round (stan seeds are 31-bit integers)
+        posterior = stan.build(program, data=data,
+                               random_seed=(seed + round_) & 0x7fffffff)
+        fit = posterior.sample(num_chains=num_chains,
+                               num_samples=num_samples, **kwargs)
+        new = get_draws(fit, list(fit.sample_and_sampler_param_names)
+                        + list(fit.param_names))
+        draws = new if draws is None else {
+            name: np.concatenate([draws[name], new[name]], axis=1)
+            for name in draws}
+
+        total = draws['stepsize__'].shape[1]
+        if converged(draws, check, r_hat=r_hat, ess=ess) \
+                or total >= max_samples:
+            break
+        kwargs = _continuation(draws, params)
+        num_samples = min(total, max_samples - total)
+        round_ += 1
+    return draws
@@ -3,19 +3,29 @@
 
 # standard
 import argparse as ap
-import collections
+import hashlib
 import json
+import multiprocessing
+import multiprocessing.util
+import os
 import random
-from os.path import dirname, join
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import dirname, exists, join
 
 # third
-import arviz
 import numpy as np
 import pandas as pd
 import stan
 import yaml
 from tqdm import tqdm
 
+# local
+from ..constants import FIT_CACHE_DIR
+from . import adaptive, comparisons, fast, summary
+from .cache import MAX_SIZE as CACHE_SIZE, FitCache
+from .results import ROW_GROUP_SIZE, ResultWriter
+
 
 __author__ = "Anaïs Tack"
 __credits__ = ["Anaïs Tack", "Chris Piech"]
@@ -26,44 +36,156 @@ __maintainer__ = "Anaïs Tack"
 __email__ = "atack@cs.stanford.edu"
 
 
+NUTS = 'nuts'
+ADAPTIVE = 'adaptive'
+FAST = 'fast'
+METHODS = [NUTS, ADAPTIVE, FAST]
+
+# default number of chains per fit
+NUM_CHAINS = 4
+
+# sidecar file with the fingerprint of a chunk of raters
+FINGERPRINT_EXT = '.json'
+
+
 with open(join(dirname(__file__), 'bradley-terry-bayesian.stan')) as fh:
     bradley_terry_bayesian = fh.read()
 
+with open(join(dirname(__file__), 'bradley-terry-hierarchical.stan')) as fh:
+    bradley_terry_hierarchical = fh.read()
+
+
+def settings(method=NUTS, num_chains=NUM_CHAINS):
+    # sampler settings that determine the draws (besides data and seed)
+    settings = dict(method=method, num_chains=num_chains)
+    if method == ADAPTIVE:
+        settings.update(num_warmup=adaptive.NUM_WARMUP,
+                        continuation=True,
+                        num_samples=adaptive.NUM_SAMPLES,
+                        max_samples=adaptive.MAX_SAMPLES,
+                        r_hat=adaptive.R_HAT,
+                        ess=adaptive.ESS)
+    return settings
 
-def bradley_terry(df):
+
+def _values(stats, indices, params, params_0, index=()):
+    # statistics per player (0-based), as f'{param}_{stat}'
+    values = {n: {f'{param}_'+k: float(v[index + (n,)])
+                  for param in params
+                  for k, v in stats[param].items()}
+              for n in indices}
+    for param in params_0:
+        for n in indices:
+            for k, v in stats[param].items():
+                values[n][f'{param}_'+k] = float(v[index])
+    return values
+
+
+def bradley_terry(df, K, seed=0, num_chains=NUM_CHAINS, method=NUTS,
+                  cache=None, return_draws=False):
+    # K is the number of players (1-based player codes up to K)
+    # players that are not compared keep their prior, and are left out
+    # of the rankings, probabilities and results (as in the fast method)
+    present = np.zeros(K, dtype=int)
+    present[df['player_i'].values - 1] = 1
+    present[df['player_j'].values - 1] = 1
     data = {
-        'K': len(np.unique(df[['player_i', 'player_j']].values)),
+        'K': K,
         'N': len(df),
         'i': list(df['player_i'].values),
         'j': list(df['player_j'].values),
         'y': list(df['i_gt_j'].values),
+        'present': present.tolist(),
     }
 
     params_0 = ["alpha_0"]
     params = ["alpha", "ranking", "probability"]
 
-    posterior = stan.build(bradley_terry_bayesian, data=data, random_seed=0)
-    fit = posterior.sample()
+    # reuse the fit if nothing it depends on has changed
+    if cache is not None:
+        key = cache.key(bradley_terry_bayesian, data, seed,
+                        settings(method, num_chains))
+        values = cache.get(key)
+        if values is not None:
+            values = tuple((n, v) for n, v in values)
+            if return_draws:
+                return values, cache.get_draws(key)
+            return values
+
+    if method == ADAPTIVE:
+        # shorter chains, continued until alpha has converged
+        draws = adaptive.sample(bradley_terry_bayesian, data,
+                                params_0 + ['alpha'],
+                                seed=seed, num_chains=num_chains)
+    else:
+        posterior = stan.build(bradley_terry_bayesian, data=data,
+                               random_seed=seed)
+        fit = posterior.sample(num_chains=num_chains)
+        draws = adaptive.get_draws(fit, params_0 + params)
+    draws = {name: draws[name] for name in params_0 + params}
 
     # compute summary statistics (mean, credible interval)
-    summary = arviz.summary(fit, hdi_prob=.95, var_names=params_0 + params)
+    stats = {param: summary.round_stats(summary.summarize(draws[param]))
+             for param in params_0 + params}
 
     # extract statistics for alphas and rankings
     # go back to 0-based index
-    indices = sorted(map(lambda i: i-1, set(data['i'] + data['j'])))
-    values = {n: {f'{param}_'+k: v
-                  for param in params
-                  for k, v in summary.loc[f'{param}[{n}]'].to_dict().items()}
-              for n in indices}
-    for param in params_0:
-        for n in indices:
-            for k, v in summary.loc[param].to_dict().items():
-                values[n][f'{param}_'+k] = v
+    indices = np.flatnonzero(present)
+    values = _values(stats, indices, params, params_0)
+
+    if cache is not None:
+        cache.put(key, list(values.items()), draws)
 
+    if return_draws:
+        return tuple(values.items()), draws
     return tuple(values.items())
 
 
-def load_data(players, games):
+def bradley_terry_joint(df, K, G, pooling=False):
+    # one fit for all groups (item x attribute)
+    # group indices and player indices are 1-based
+    present = np.zeros((G, K), dtype=int)
+    present[df['group'].values - 1, df['player_i'].values - 1] = 1
+    present[df['group'].values - 1, df['player_j'].values - 1] = 1
+
+    data = {
+        'K': K,
+        'G': G,
+        'N': len(df),
+        'g': list(df['group'].values),
+        'i': list(df['player_i'].values),
+        'j': list(df['player_j'].values),
+        'y': list(df['i_gt_j'].values),
+        'present': present.tolist(),
+        'pooling': int(pooling),
+    }
+
+    params_0 = ["alpha_0"]
+    params = ["alpha", "ranking", "probability"]
+
+    posterior = stan.build(bradley_terry_hierarchical, data=data,
+                           random_seed=0)
+    fit = posterior.sample()
+    draws = adaptive.get_draws(fit, params_0 + params)
+
+    # compute summary statistics (mean, credible interval)
+    # (all groups at once)
+    stats = {param: summary.round_stats(summary.summarize(draws[param]))
+             for param in params_0 + params}
+
+    # extract statistics for alphas and rankings per group
+    # go back to 0-based index
+    groups = {}
+    for g in range(G):
+        indices = np.flatnonzero(present[g])
+        values = _values(stats, indices, params, params_0, index=(g,))
+        groups[g] = tuple(values.items())
+
+    return groups
+
+
+def load_data(players, games, seed=None):
+    rng = random.Random(seed)
     data = []
     for game in games:
         player_a, player_b, a_gt_b = game
@@ -76,7 +198,7 @@ def load_data(players, games):
             i_gt_j = int(a_gt_b)
             data.append((player_i, player_j, i_gt_j))
         else:
-            i_gt_j = int(random.choice([True, False]))
+            i_gt_j = int(rng.choice([True, False]))
             data.append((player_i, player_j, i_gt_j))
     df = pd.DataFrame.from_records(
         data, columns=('player_i', 'player_j', 'i_gt_j'))
@@ -90,83 +212,378 @@ def iter(games_list):
         yield params
 
 
-def compute_bradley_terry(players, games):
-    data = load_data(players, games)
-    params = bradley_terry(data)
+def fit_data(players, data, seed=0, num_chains=NUM_CHAINS, method=NUTS,
+             cache=None, store=None, key=None):
+    # one fit of comparisons (as returned by load_data)
+    if store is None:
+        return bradley_terry(data, len(players), seed=seed,
+                             num_chains=num_chains, method=method,
+                             cache=cache)
+    # keep the draws (e.g., for contrasts between players)
+    params, draws = bradley_terry(data, len(players), seed=seed,
+                                  num_chains=num_chains, method=method,
+                                  cache=cache, return_draws=True)
+    store.put(key, draws, players=players, K=int(draws['alpha'].shape[-1]),
+              present=[int(n) for n, __ in params])
     return params
 
 
-def compute_per_item(task, players, items, outliers=None):
-    outliers = outliers if outliers else {}
+def compute_bradley_terry(players, games, seed=0, **kwargs):
+    data = load_data(players, games, seed=seed)
+    params = fit_data(players, data, seed=seed, **kwargs)
+    return params
 
-    def filter_out(dict_):
-        return filter(lambda kv: kv[0] not in outliers,
-                      dict_.items())
+
+def fit_seed(key):
+    # the seed of a fit only depends on what is fitted
+    # (not on the order in which the fits are scheduled)
+    # stan seeds are 31-bit integers
+    return zlib.crc32(json.dumps(key).encode('utf-8')) & 0x7fffffff
+
+
+def plan(n_fits, jobs=None, num_chains=None):
+    # stan runs the chains of a fit in parallel
+    # so run as many fits in flight as there are cores left
+    num_chains = num_chains or NUM_CHAINS
+    jobs = jobs or max(1, (os.cpu_count() or 1) // num_chains)
+    return max(1, min(jobs, n_fits)), num_chains
+
+
+def _terminate_children():
+    for process in multiprocessing.active_children():
+        process.terminate()
+
+
+def _init_worker():
+    # httpstan samples in a (forked) pool of its own, which never exits
+    # by itself in a worker: stop it once the worker has no more fits
+    multiprocessing.util.Finalize(None, _terminate_children, exitpriority=0)
+
+
+def make_executor(jobs):
+    # a process pool for fits
+    # (stan starts its own processes, which requires fresh workers)
+    return ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker)
+
+
+def compute_bradley_terry_all(players, games_list, keys, **kwargs):
+    # fit many sets of games, identified by their keys
+    keys = list(keys)
+    return fit_all(players,
+                   [load_data(players, games, seed=fit_seed(key))
+                    for key, games in zip(keys, games_list)],
+                   keys, **kwargs)
+
+
+def fit_all(players, data_list, keys, **kwargs):
+    # fit many sets of comparisons, identified by their keys
+    # (results in the order of the keys)
+    data_list = list(data_list)
+    results = [None] * len(data_list)
+    for n, estimates in iter_fits(players, data_list, keys, **kwargs):
+        results[n] = estimates
+    return results
+
+
+def iter_fits(players, data_list, keys, method=NUTS, jobs=None,
+              num_chains=None, cache=None, store=None, **kwargs):
+    # yield (index, estimates) of every fit as soon as it is done
+    # (with method 'fast', all fits are vectorized in one batch)
+    data_list = list(data_list)
+    keys = list(keys)
+    if method == FAST:
+        if data_list:
+            yield from enumerate(fast.bradley_terry_fast(
+                data_list, len(players), seeds=map(fit_seed, keys),
+                **kwargs))
+        return
+
+    jobs, num_chains = plan(len(data_list), jobs, num_chains)
+    progress = tqdm(total=len(data_list), ascii=True)
+    if jobs == 1:
+        for n, (key, data) in enumerate(zip(keys, data_list)):
+            estimates = fit_data(
+                players, data, seed=fit_seed(key), num_chains=num_chains,
+                method=method, cache=cache, store=store, key=key)
+            progress.update()
+            yield n, estimates
+    else:
+        # fits are independent: spread them across a process pool
+        with make_executor(jobs) as executor:
+            futures = {executor.submit(fit_data,
+                                       players, data,
+                                       seed=fit_seed(key),
+                                       num_chains=num_chains,
+                                       method=method,
+                                       cache=cache,
+                                       store=store,
+                                       key=key): n
+                       for n, (key, data) in enumerate(
+                           zip(keys, data_list))}
+            for future in as_completed(futures):
+                progress.update()
+                yield futures[future], future.result()
+    progress.close()
+
+
+def _compute(players, fits, make_rows, writer=None, **kwargs):
+    # rows of all fits, as a data frame or streamed to the writer
+    # (skipping the fits it already has)
+    if writer is not None:
+        fits = [(key, data) for key, data in fits if key not in writer]
+    results = iter_fits(players,
+                        (data for __, data in fits),
+                        (key for key, __ in fits),
+                        **kwargs)
+    if writer is None:
+        estimates = dict(results)
+        return pd.DataFrame.from_records(
+            [row for n, (key, __) in enumerate(fits)
+             for row in make_rows(key, estimates[n])])
+    for n, estimates in results:
+        writer.write(fits[n][0], make_rows(fits[n][0], estimates))
+    writer.close()
+    return writer
+
+
+def _table(task, items):
+    # the comparisons table of the items (or the table itself)
+    if isinstance(items, pd.DataFrame):
+        return items
+    return comparisons.from_items(items, task=task)
+
+
+def compute_per_item(task, players, items, outliers=None, method=NUTS,
+                     writer=None, **kwargs):
+    table = comparisons.drop_raters(_table(task, items), outliers)
+    fits = list(comparisons.frames(
+        table, by=['item', 'attribute'],
+        key=['task', 'filename', 'line_idx', 'attribute'], players=players))
 
     # compute ability parameters
-    ability = [dict(task=i['task'],
-                    filename=i['filename'],
-                    line_idx=str(i['line_idx']),
+    def make_rows(key, estimates):
+        task_, filename, line_idx, attr = key
+        return [dict(task=task_, filename=filename, line_idx=line_idx,
+                     model=players[n], attribute=attr, **params)
+                for n, params in estimates]
+
+    return _compute(players, fits, make_rows, writer=writer, method=method,
+                    **kwargs)
+
+
+def compute_joint(task, players, items, outliers=None, pooling=False):
+    table = comparisons.drop_raters(_table(task, items), outliers)
+
+    # stack the comparisons of all items and attributes
+    # such that all abilities are sampled in one run
+    groups = []
+    data = []
+    for g, (key, df) in enumerate(comparisons.frames(
+            table, by=['item', 'attribute'],
+            key=['task', 'filename', 'line_idx', 'attribute'],
+            players=players)):
+        df['group'] = g + 1
+        groups.append(key)
+        data.append(df)
+    data = pd.concat(data, ignore_index=True)
+
+    estimates = bradley_terry_joint(
+        data, len(players), len(groups), pooling=pooling)
+
+    ability = [dict(task=task_,
+                    filename=filename,
+                    line_idx=line_idx,
                     model=players[n], attribute=attr, **params)
-               for i in filter(lambda i: task in i, items)
-               for attr, responses in i[task]['attributes'].items()
-               for n, params in compute_bradley_terry(
-                   players,
-                   map(lambda kv: kv[1],
-                       filter_out(responses)))]
+               for g, (task_, filename, line_idx, attr) in enumerate(groups)
+               for n, params in estimates[g]]
 
     return pd.DataFrame.from_records(ability)
 
 
-def compute_per_rater(task, players, items):
+def compute_per_rater(task, players, items, raters=None, method=NUTS,
+                      writer=None, **kwargs):
     # reverse the usual computation
-    # compute ability per rater
-    raters = collections.defaultdict(
-        lambda: collections.defaultdict(
-            lambda: collections.defaultdict(
-                lambda: collections.defaultdict(list))))
-    for item in filter(lambda i: task in i, items):
-        for attr, responses in item[task]['attributes'].items():
-            for rater, response in responses.items():
-                raters[rater][task]['attributes'][attr].append(response)
-
-    ability = [dict(rater=rater, model=players[n], attribute=attr, **params)
-               for rater in tqdm(sorted(raters)[60:], ascii=True)
-               for attr, responses in raters[rater][task]['attributes'].items()
-               for n, params in compute_bradley_terry(players, responses)]
-
-    return pd.DataFrame.from_records(ability)
+    # compute ability per rater (all raters or the given ones)
+    table = _table(task, items)
+    if raters is not None:
+        table = table[table['rater'].isin(list(raters))]
+    fits = list(comparisons.frames(
+        table.sort_values('rater', kind='stable'),
+        by=['rater', 'attribute'], players=players))
+
+    def make_rows(key, estimates):
+        rater, attr = key
+        return [dict(rater=rater, model=players[n], attribute=attr, **params)
+                for n, params in estimates]
+
+    return _compute(players, fits, make_rows, writer=writer, method=method,
+                    **kwargs)
+
+
+def chunk_fingerprint(players, table, raters, method=NUTS,
+                      num_chains=None, interval=None, **kwargs):
+    # what the results of a chunk of raters depend on:
+    # its raters and their comparisons, the players and the settings
+    rows = table[table['rater'].isin(raters)].sort_values(
+        ['rater', 'attribute', 'item'], kind='stable')
+    data = pd.util.hash_pandas_object(
+        rows[['item', 'attribute', 'rater', 'player_a', 'player_b', 'y']]
+        .astype(str), index=False).values
+    return dict(raters=list(raters),
+                players=list(players),
+                data=hashlib.sha256(data.tobytes()).hexdigest(),
+                settings=settings(method, num_chains or NUM_CHAINS),
+                interval=interval)
+
+
+def _read_fingerprint(chunk_file):
+    if not exists(chunk_file) or not exists(chunk_file + FINGERPRINT_EXT):
+        return None
+    with open(chunk_file + FINGERPRINT_EXT) as fh:
+        return json.load(fh)
+
+
+def compute_per_rater_chunked(task, players, items, output_file, chunk_size,
+                              **kwargs):
+    # resumable computation per rater
+    # each chunk of raters is saved to its own file as soon as it is done
+    # (with the fingerprint of its raters, data and settings)
+    # chunks that were saved in a previous run are not computed again,
+    # unless their fingerprint has changed
+    table = _table(task, items)
+    raters = sorted(set(table['rater']))
+    chunk_files = []
+    for k, start in enumerate(range(0, len(raters), chunk_size)):
+        chunk_file = f'{output_file}.chunk{k:04d}.csv'
+        chunk = raters[start:start + chunk_size]
+        fingerprint = chunk_fingerprint(players, table, chunk, **kwargs)
+        if _read_fingerprint(chunk_file) != fingerprint:
+            df = compute_per_rater(task, players, table, raters=chunk,
+                                   **kwargs)
+            df.to_csv(chunk_file + '.tmp', index=False)
+            os.replace(chunk_file + '.tmp', chunk_file)
+            with open(chunk_file + FINGERPRINT_EXT + '.tmp', 'w') as fh:
+                json.dump(fingerprint, fh)
+            os.replace(chunk_file + FINGERPRINT_EXT + '.tmp',
+                       chunk_file + FINGERPRINT_EXT)
+        chunk_files.append(chunk_file)
+    return pd.concat(map(pd.read_csv, chunk_files), ignore_index=True)
 
 
 def main(args):
-    task = 'comparisons'
-    items = [json.loads(line)
-             for line in map(str.strip,  args.responses_jsonl)]
+    task = comparisons.TASK
+    # all comparisons in one (cached) table
+    items = comparisons.load(args.responses_jsonl, task=task)
 
     outliers = yaml.safe_load(args.outliers) if args.outliers else None
 
     # players are the list of models
-    players = {i[task]['attributes'][attr][rater][n]
-               for i in items
-               if task in i
-               for attr in i[task]['attributes']
-               for rater in i[task]['attributes'][attr]
-               for n in range(2)}
-    players = list(sorted(players))
-
-    if args.per_rater:
-        df = compute_per_rater(task, players, items)
+    players = list(items['player_a'].cat.categories)
+
+    if args.method == FAST:
+        kwargs = dict(interval=args.interval)
+    else:
+        kwargs = dict(jobs=args.jobs, num_chains=args.chains)
+        if not args.no_cache:
+            kwargs['cache'] = FitCache(args.cache_dir,
+                                       max_size=args.cache_size)
+        if args.draws_dir:
+            kwargs['store'] = summary.DrawStore(args.draws_dir)
+
+    if args.stream:
+        # results are written as the fits finish (and skipped on restart,
+        # as long as the settings of the run are the same)
+        run = dict(per_rater=args.per_rater, method=args.method,
+                   num_chains=None if args.method == FAST else args.chains,
+                   interval=args.interval if args.method == FAST else None,
+                   outliers=None)
+        if outliers and not args.per_rater:
+            run['outliers'] = hashlib.sha256(json.dumps(
+                outliers, sort_keys=True, default=str).encode('utf-8')
+            ).hexdigest()
+        kwargs['writer'] = ResultWriter(args.output_file, settings=run,
+                                        row_group_size=args.row_group_size,
+                                        force=args.force)
+        if args.per_rater:
+            compute_per_rater(task, players, items, method=args.method,
+                              **kwargs)
+        else:
+            compute_per_item(task, players, items, outliers=outliers,
+                             method=args.method, **kwargs)
+        return
+
+    if args.per_rater and args.chunk_size:
+        df = compute_per_rater_chunked(task, players, items,
+                                       args.output_file, args.chunk_size,
+                                       method=args.method, **kwargs)
+    elif args.per_rater:
+        df = compute_per_rater(task, players, items,
+                               method=args.method, **kwargs)
+    elif args.joint:
+        df = compute_joint(task, players, items, outliers=outliers,
+                           pooling=args.pooling)
     else:
-        df = compute_per_item(task, players, items, outliers=outliers)
+        df = compute_per_item(task, players, items, outliers=outliers,
+                              method=args.method, **kwargs)
 
     df.to_csv(args.output_file, index=False)
 
 
 if __name__ == "__main__":
     parser = ap.ArgumentParser()
-    parser.add_argument('responses_jsonl', type=ap.FileType('r'))
+    parser.add_argument('responses_jsonl')
     parser.add_argument('-o', '--output-file')
     parser.add_argument('--per-rater', action='store_true', default=False)
     parser.add_argument('--outliers', type=ap.FileType('r'), default=None)
+    parser.add_argument('--joint', action='store_true', default=False,
+                        help="fit all items and attributes in one run")
+    parser.add_argument('--pooling', action='store_true', default=False,
+                        help="partially pool abilities across items "
+                             "(with --joint)")
+    parser.add_argument('--method', choices=METHODS, default=NUTS,
+                        help="sample with Stan (nuts), sample with "
+                             "shorter chains extended until convergence "
+                             "(adaptive) or estimate with a vectorized "
+                             "MAP solver (fast)")
+    parser.add_argument('--interval', choices=fast.INTERVALS,
+                        default=fast.LAPLACE,
+                        help="credible intervals for --method fast")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of fits in flight "
+                             "(default: number of cores / chains)")
+    parser.add_argument('--chains', type=int, default=NUM_CHAINS,
+                        help="number of chains per fit")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="with --per-rater, save results per chunk "
+                             "of raters and resume from saved chunks")
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help="write results as soon as every fit is done "
+                             "(CSV, or parquet row groups if the output "
+                             "file ends with .parquet) and skip the fits "
+                             "that were written in a previous run")
+    parser.add_argument('--row-group-size', type=int,
+                        default=ROW_GROUP_SIZE,
+                        help="fits per parquet row group (with --stream)")
+    parser.add_argument('--force', action='store_true', default=False,
+                        help="with --stream, start over instead of "
+                             "resuming (e.g., after changing the settings)")
+    parser.add_argument('--cache-dir', default=FIT_CACHE_DIR,
+                        help="reuse fits whose program, data, seed and "
+                             "settings have not changed")
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help="size limit of the cache (in bytes)")
+    parser.add_argument('--no-cache', action='store_true', default=False)
+    parser.add_argument('--draws-dir', default=None,
+                        help="save the draws of every fit "
+                             "(compressed, one file per fit)")
     args = parser.parse_args()
+    if args.method == FAST and args.draws_dir:
+        parser.error("--draws-dir requires sampling "
+                     "(--method nuts or adaptive)")
+    if args.stream and (args.joint or args.chunk_size):
+        parser.error("--stream cannot be combined with --joint "
+                     "or --chunk-size")
     main(args)
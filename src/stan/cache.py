@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from os.path import join
+
+# third
+import numpy as np
+import stan
+
+# local
+from ..constants import FIT_CACHE_DIR
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# default size limit of the cache (in bytes)
+MAX_SIZE = 2 << 30
+
+EXT = '.npz'
+SUMMARY = '__summary__'
+
+
+def _encode(obj):
+    # numpy scalars and arrays (e.g., in stan data)
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f"Cannot encode {type(obj)}")
+
+
+class FitCache(object):
+    """On-disk cache of posterior fits (summary and draws).
+
+    Fits are keyed by a hash of everything that determines the draws:
+    the Stan program, the data, the seed and the sampler settings.
+    Entries are compressed npz files, evicted least recently used first
+    when the cache grows beyond `max_size` bytes. The size of the cache
+    is counted once and then kept up to date by every write (the cache
+    directory is only walked again to evict).
+    """
+
+    def __init__(self, cache_dir=FIT_CACHE_DIR, max_size=MAX_SIZE) -> None:
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size = None
+
+    @staticmethod
+    def key(program, data, seed, settings):
+        payload = json.dumps(dict(program=program,
+                                  data=data,
+                                  seed=seed,
+                                  settings=settings,
+                                  stan=stan.__version__),
+                             sort_keys=True, default=_encode)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return join(self.cache_dir, key[:2], key + EXT)
+
+    def _touch(self, path):
+        # the modification time marks the last use of an entry
+        # (access times are not updated on all file systems)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, default=None):
+        """Summary of a cached fit (or `default`)."""
+        path = self.path(key)
+        try:
+            with np.load(path) as npz:
+                summary = json.loads(str(npz[SUMMARY]))
+        except (FileNotFoundError, KeyError, ValueError):
+            return default
+        self._touch(path)
+        return summary
+
+    def get_draws(self, key, default=None):
+        """Draws of a cached fit as a dict of arrays (or `default`)."""
+        path = self.path(key)
+        try:
+            with np.load(path) as npz:
+                draws = {name: npz[name]
+                         for name in npz.files if name != SUMMARY}
+        except (FileNotFoundError, ValueError):
+            return default
+        self._touch(path)
+        return draws
+
+    def put(self, key, summary, draws):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        # write to a temporary file first (entries are always complete)
+        fd, tmp = tempfile.mkstemp(suffix=EXT, dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez_compressed(
+                fh, **{SUMMARY: np.array(json.dumps(summary,
+                                                    default=_encode))},
+                **draws)
+        os.replace(tmp, path)
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(path) - replaced
+        # (other processes may write to the same cache: the count is
+        # corrected by the walk of the cache directory in evict)
+        if self._size > self.max_size:
+            self.evict()
+        return path
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def entries(self):
+        # (path, size, last use) of every entry
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, __, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(EXT):
+                    continue
+                try:
+                    stat = os.stat(join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((join(root, name), stat.st_size,
+                                stat.st_mtime_ns))
+        return entries
+
+    def size(self):
+        return sum(size for __, size, __ in self.entries())
+
+    def __len__(self):
+        return len(self.entries())
+
+    def evict(self, max_size=None):
+        # remove the least recently used entries beyond the size limit
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for __, size, __ in entries)
+        removed = 0
+        for path, size, __ in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._size = total
+        return removed
+
+
+def main(args):
+    cache = FitCache(args.cache_dir)
+    if args.command == 'clear':
+        removed = cache.evict(max_size=0)
+        sys.stderr.write(f"[Done] removed {removed} fits\n")
+    elif args.command == 'evict':
+        removed = cache.evict(max_size=args.max_size)
+        sys.stderr.write(f"[Done] removed {removed} fits\n")
+    sys.stdout.write(f"{len(cache)} fits, {cache.size()} bytes "
+                     f"in {cache.cache_dir}\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-c', '--cache-dir', default=FIT_CACHE_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info')
+    subparsers.add_parser('clear')
+    evict = subparsers.add_parser('evict')
+    evict.add_argument('--max-size', type=int, default=MAX_SIZE)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import hashlib
+import json
+import os
+import sys
+
+# third
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+TASK = 'comparisons'
+
+# seed of the coin flips that resolve ties
+TIE_SEED = 0
+
+# version of the table (cached tables of another version are rebuilt)
+FORMAT = 2
+
+TIMING = dict(first_click='FIRST_CLICK',
+              last_click='LAST_CLICK',
+              page_submit='PAGE_SUBMIT',
+              click_count='CLICK_COUNT')
+
+CATEGORICAL = ['task', 'filename', 'line_idx', 'attribute', 'rater',
+               'player_a', 'player_b']
+
+EXT = '.parquet'
+META_KEY = b'src.stan.comparisons'
+
+
+def iter_rows(items, task=TASK):
+    """One row per comparative judgment (item x attribute x rater)."""
+    for n, item in enumerate(items):
+        if task not in item:
+            continue
+        timing = item[task].get('timing', {})
+        input_text = item[task].get('input', {}).get('text', {})
+        for attr, responses in item[task]['attributes'].items():
+            for rater, (player_a, player_b, a_gt_b) in responses.items():
+                row = dict(item=n,
+                           task=item['task'],
+                           filename=item['filename'],
+                           line_idx=item['line_idx'],
+                           attribute=attr,
+                           rater=rater,
+                           player_a=player_a,
+                           player_b=player_b,
+                           a_gt_b=a_gt_b,
+                           input_text=input_text.get(rater))
+                for column, name in TIMING.items():
+                    row[column] = timing.get(name, {}).get(rater)
+                yield row
+
+
+def from_items(items, task=TASK, seed=TIE_SEED):
+    """Long-format table of the comparisons in `items`.
+
+    Players, raters, attributes and items are categorical.
+    Player codes (player_i, player_j) are 1-based, in sorted order.
+    Ties (a_gt_b is None) are resolved once (y) and flagged (is_tie),
+    with a coin flip drawn from a hash of `seed` and the judgment
+    (item, attribute and rater), such that it does not depend on the
+    other rows of the table.
+    """
+    columns = ['item', 'task', 'filename', 'line_idx', 'attribute', 'rater',
+               'player_a', 'player_b', 'a_gt_b'] + list(TIMING)
+    df = pd.DataFrame.from_records(
+        ({k: row[k] for k in columns} for row in iter_rows(items, task)),
+        columns=columns)
+    # line_idx as in the keys of the fits (e.g. "[95, 96, 97]")
+    df['line_idx'] = df['line_idx'].map(str)
+
+    players = sorted(set(df['player_a']) | set(df['player_b']))
+    for column in CATEGORICAL:
+        categories = players if column.startswith('player_') else None
+        df[column] = pd.Categorical(df[column], categories=categories)
+    df['item'] = df['item'].astype(np.int32)
+    df['player_i'] = (df['player_a'].cat.codes + 1).astype(np.int16)
+    df['player_j'] = (df['player_b'].cat.codes + 1).astype(np.int16)
+
+    df['is_tie'] = df['a_gt_b'].isna()
+    coin = np.zeros(len(df), dtype=bool)
+    ties = np.flatnonzero(df['is_tie'].values)
+    coin[ties] = [tie_coin(seed, *judgment) for judgment in df.iloc[ties][
+        ['task', 'filename', 'line_idx', 'attribute', 'rater']].itertuples(
+            index=False, name=None)]
+    df['y'] = np.where(df['is_tie'], coin,
+                       df['a_gt_b'].isin([True])).astype(np.int8)
+    df = df.drop(columns='a_gt_b')
+    for column in TIMING:
+        df[column] = df[column].astype(float)
+    return df
+
+
+def tie_coin(seed, *judgment):
+    # coin flip of a tie (the same for a judgment, whatever the other rows)
+    digest = hashlib.blake2b(json.dumps([seed, *judgment]).encode('utf-8'),
+                             digest_size=1).digest()
+    return bool(digest[0] & 1)
+
+
+def _source(path, task, seed):
+    stat = os.stat(path)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                task=task, seed=seed, format=FORMAT)
+
+
+def default_path(path, task=TASK):
+    # e.g. data/2_comparisons/items.comparisons.parquet
+    root, __ = os.path.splitext(path)
+    return f'{root}.{task}{EXT}'
+
+
+def load(path, task=TASK, seed=TIE_SEED, table_path=None, rebuild=False):
+    """Table of the comparisons in a JSONL file of items (cached).
+
+    The table is saved as parquet next to the items and rebuilt
+    whenever the items file changes.
+    """
+    table_path = table_path or default_path(path, task)
+    source = _source(path, task, seed)
+    if not rebuild and os.path.exists(table_path):
+        meta = pq.read_schema(table_path).metadata or {}
+        if json.loads(meta.get(META_KEY, b'null')) == source:
+            return pd.read_parquet(table_path)
+
+    with open(path) as fh:
+        df = from_items(map(json.loads, fh), task=task, seed=seed)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}),
+         META_KEY: json.dumps(source).encode('utf-8')})
+    pq.write_table(table, table_path + '.tmp')
+    os.replace(table_path + '.tmp', table_path)
+    return df
+
+
+def attributes(path, task=TASK):
+    """Attributes compared in a JSONL file of items (in sorted order).
+
+    The items are only read: the table is neither built nor cached.
+    """
+    attributes = set()
+    with open(path) as fh:
+        for line in fh:
+            item = json.loads(line)
+            if task in item:
+                attributes.update(item[task]['attributes'])
+    return sorted(attributes)
+
+
+def drop_raters(df, raters):
+    # e.g. the outliers (a dict or list of raters)
+    if not raters:
+        return df
+    return df[~df['rater'].isin(list(raters))]
+
+
+def frames(df, by, key=None, players=None):
+    """Data of every fit, grouped by the given columns.
+
+    Yields (key, data) where the key holds the values of the `key` columns
+    (by default, the `by` columns) and data has the columns of
+    ``load_data`` (with the player codes of `players`, if given).
+    Groups are in order of first appearance, with rows in the table order.
+    """
+    key = key or by
+    if len(df) == 0:
+        return
+    if players is not None and list(players) != list(
+            df['player_a'].cat.categories):
+        player_i = pd.Categorical(df['player_a'], categories=players).codes
+        player_j = pd.Categorical(df['player_b'], categories=players).codes
+        if (player_i < 0).any() or (player_j < 0).any():
+            unknown = (set(df['player_a'][player_i < 0]) |
+                       set(df['player_b'][player_j < 0]))
+            raise Exception(f"Unknown players: {sorted(unknown)}")
+        df = df.assign(player_i=player_i + 1, player_j=player_j + 1)
+    data = df[['player_i', 'player_j', 'y']].rename(
+        columns={'y': 'i_gt_j'})
+    groups = df.groupby(by, sort=False, observed=True).ngroup().values
+    order = np.argsort(groups, kind='stable')
+    starts = np.r_[0, np.flatnonzero(np.diff(groups[order])) + 1]
+    ends = np.r_[starts[1:], len(order)]
+    keys = df[key].iloc[order[starts]].itertuples(index=False, name=None)
+    for k, start, end in zip(keys, starts, ends):
+        yield k, data.iloc[order[start:end]].reset_index(drop=True)
+
+
+def main(args):
+    df = load(args.items_jsonl, seed=args.seed, table_path=args.output_file,
+              rebuild=args.rebuild)
+    sys.stderr.write(f"[Done] {len(df)} comparisons, "
+                     f"{df['is_tie'].sum()} ties, "
+                     f"{df['rater'].nunique()} raters\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('items_jsonl')
+    parser.add_argument('-o', '--output-file')
+    parser.add_argument('--seed', type=int, default=TIE_SEED)
+    parser.add_argument('--rebuild', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import glob
+import json
+import sys
+from os.path import join
+
+# third
+import numpy as np
+import pandas as pd
+
+# local
+from ..constants import ABILITIES_DIR
+from . import summary
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# ∆ ability of every model against the real teacher
+# (alpha of the model minus alpha of the teacher, per item and attribute)
+# averaged over the items of a model, attribute and/or task
+
+REFERENCE = 'Teacher'
+
+KEY = ['task', 'filename', 'line_idx', 'attribute']
+GROUPS = ['model', 'attribute', 'task']
+
+# attributes as asked in the comparisons (items.jsonl)
+# and as named in the abilities (data/3_abilities)
+ATTRIBUTES = {'more likely said by a teacher': 'likely said by a teacher',
+              'understanding the student more': 'understanding the student',
+              'helping the student more': 'helping the student'}
+
+# width of a 95% interval in standard deviations (2 x 1.96)
+CI_WIDTH_SD = 3.92
+
+N_DRAWS = 4000
+
+
+def normalize_attribute(attribute):
+    # (one vocabulary for the fits of both sources)
+    return ATTRIBUTES.get(attribute, attribute)
+
+
+def from_jsonl(path):
+    # summaries as in data/3_abilities (alpha and alpha_ci)
+    records = []
+    with open(path) as fh:
+        for line in fh:
+            row = json.loads(line)
+            low, high = row['alpha_ci']
+            records.append(dict(task=row['wherefrom']['task'],
+                                filename=row['wherefrom']['filename'],
+                                line_idx=str(row['wherefrom']['line_idx']),
+                                attribute=row['attribute'],
+                                model=row['id'],
+                                alpha_mean=row['alpha'],
+                                alpha_sd=(high - low) / CI_WIDTH_SD))
+    return pd.DataFrame.from_records(records)
+
+
+def from_csv(path):
+    # estimates of bradley_terry (alpha_mean and alpha_sd)
+    df = pd.read_csv(path)
+    df['line_idx'] = df['line_idx'].map(str)
+    return df[KEY + ['model', 'alpha_mean', 'alpha_sd']]
+
+
+def load_summaries(paths):
+    df = pd.concat([from_csv(path) if path.endswith('.csv')
+                    else from_jsonl(path) for path in paths],
+                   ignore_index=True)
+    df['attribute'] = df['attribute'].map(normalize_attribute)
+    # (the same fit in many files: the first one is kept)
+    return df.drop_duplicates(KEY + ['model'], ignore_index=True)
+
+
+def _thin(draws, n_draws):
+    # evenly spaced draws (fits may have different numbers of draws)
+    idx = np.linspace(0, len(draws) - 1, n_draws).round().astype(int)
+    return draws[idx]
+
+
+def deltas(summaries=None, store=None, reference=REFERENCE,
+           n_draws=N_DRAWS, seed=0):
+    """Draws of ∆ ability against the reference, per item and attribute.
+
+    Fits with posterior draws in the store use their draws (which keeps
+    the correlation between the abilities of a fit). The other fits are
+    approximated by independent normal abilities with the means and
+    standard deviations of their summaries (sd = 95% interval / 3.92).
+    Fits are matched on their key, with the attributes of both sources
+    normalized (see ``ATTRIBUTES``). Fits per rater are ignored.
+    Returns the keys (a data frame with one row per fit and model) and
+    an array of draws of shape (row, draw).
+    """
+    rng = np.random.default_rng(seed)
+    keys, values = [], []
+    covered = set()
+
+    for key, draws, meta in (store or []):
+        if len(key) != len(KEY):
+            # (e.g., fits per rater: rater, attribute)
+            continue
+        key = tuple(key[:-1]) + (normalize_attribute(key[-1]),)
+        if key in covered:
+            continue
+        # (alpha has K columns: the first K players)
+        K = meta.get('K', len(meta['players']))
+        players = meta['players'][:K]
+        if reference not in players:
+            continue
+        alpha = draws['alpha'].reshape(-1, K)
+        if len(alpha) >= n_draws:
+            alpha = _thin(alpha, n_draws)
+        else:
+            alpha = alpha[rng.integers(len(alpha), size=n_draws)]
+        # (players that were not compared only have prior draws)
+        present = meta.get('present', range(K))
+        ref = players.index(reference)
+        if ref not in present:
+            continue
+        covered.add(key)
+        for m, model in enumerate(players):
+            if m != ref and m in present:
+                keys.append(dict(zip(KEY, key), model=model, source='draws'))
+                values.append(alpha[:, m] - alpha[:, ref])
+
+    if summaries is not None and len(summaries):
+        df = summaries.set_index(KEY + ['model'])
+        df = df[~df.index.droplevel('model').isin(covered)]
+        mean = df['alpha_mean'].unstack('model')
+        sd = df['alpha_sd'].unstack('model')
+        if reference in mean:
+            # all fits at once: (fit, model, draw)
+            models = [m for m in mean.columns if m != reference]
+            mu = mean[models].sub(mean[reference], axis=0)
+            sigma = np.sqrt((sd[models] ** 2).add(sd[reference] ** 2,
+                                                  axis=0))
+            noise = rng.standard_normal(mu.shape + (n_draws,))
+            draws = mu.values[..., None] + sigma.values[..., None] * noise
+            for f, key in enumerate(mu.index):
+                for m, model in enumerate(models):
+                    if not np.isnan(mu.values[f, m]):
+                        keys.append(dict(zip(KEY, key), model=model,
+                                         source='summary'))
+                        values.append(draws[f, m])
+
+    keys = pd.DataFrame.from_records(keys, columns=KEY + ['model', 'source'])
+    values = np.array(values).reshape(len(keys), n_draws)
+    return keys, values
+
+
+def aggregate(keys, values, by=('model', 'attribute'),
+              hdi_prob=summary.HDI_PROB):
+    """Mean ∆ ability over the items of every group (with intervals).
+
+    The draws of all groups are averaged with one matrix product
+    and summarized at once.
+    """
+    by = list(by)
+    groups = keys.groupby(by, sort=True)
+    codes = groups.ngroup().values
+    weights = np.zeros((groups.ngroups, len(keys)))
+    weights[codes, np.arange(len(keys))] = 1
+    n_items = weights.sum(axis=1)
+    means = (weights / n_items[:, None]) @ values
+
+    low, high = summary.hdi(means, hdi_prob=hdi_prob)
+    __, first = np.unique(codes, return_index=True)
+    df = keys.iloc[first][by].reset_index(drop=True)
+    df['n_items'] = n_items.astype(int)
+    df['delta_mean'] = means.mean(axis=-1)
+    df['delta_sd'] = means.std(axis=-1, ddof=1)
+    df['delta_ci_low'] = low
+    df['delta_ci_high'] = high
+    # posterior probability that the model is worse than the reference
+    df['p_below'] = (means < 0).mean(axis=-1)
+    df['draws_share'] = weights @ (keys['source'] == 'draws').values \
+        / n_items
+    return df
+
+
+def select(keys, values, **filters):
+    # e.g. model=['blender_9B'], attribute=None (all)
+    mask = np.ones(len(keys), dtype=bool)
+    for column, allowed in filters.items():
+        if allowed:
+            mask &= keys[column].isin(allowed).values
+    return keys[mask].reset_index(drop=True), values[mask]
+
+
+def main(args):
+    paths = args.summaries or sorted(
+        glob.glob(join(ABILITIES_DIR, '*.jsonl')))
+    summaries = load_summaries(paths) if paths else None
+    store = summary.DrawStore(args.draws_dir) if args.draws_dir else None
+
+    keys, values = deltas(summaries, store, reference=args.reference,
+                          n_draws=args.draws, seed=args.seed)
+    attributes = args.attribute and list(map(normalize_attribute,
+                                             args.attribute))
+    keys, values = select(keys, values, model=args.model,
+                          attribute=attributes, task=args.task)
+    df = aggregate(keys, values, by=args.by)
+
+    if args.output_file:
+        df.to_csv(args.output_file, index=False)
+    else:
+        sys.stdout.write(df.round(3).to_string(index=False) + '\n')
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('summaries', nargs='*',
+                        help="abilities as in data/3_abilities (JSONL) "
+                             "or estimated by bradley_terry (CSV) "
+                             "(default: data/3_abilities/*.jsonl)")
+    parser.add_argument('-d', '--draws-dir',
+                        help="posterior draws (from --draws-dir "
+                             "of bradley_terry), used where available")
+    parser.add_argument('-o', '--output-file')
+    parser.add_argument('--reference', default=REFERENCE)
+    parser.add_argument('--by', nargs='+', choices=GROUPS,
+                        default=['model', 'attribute'])
+    parser.add_argument('--model', nargs='+')
+    parser.add_argument('--attribute', nargs='+')
+    parser.add_argument('--task', nargs='+')
+    parser.add_argument('--draws', type=int, default=N_DRAWS)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# third
+import numpy as np
+
+# local
+from .summary import round_stats, summarize_iid
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# the same model as bradley-terry-bayesian.stan
+# alpha_0 ~ normal(0, 1)
+# alpha ~ normal(0, 1)
+# y ~ bernoulli_logit(alpha_0 + alpha[i] - alpha[j])
+# fitted with a vectorized MAP solver (Newton) over a batch of fits
+
+LAPLACE = 'laplace'
+BOOTSTRAP = 'bootstrap'
+INTERVALS = [LAPLACE, BOOTSTRAP]
+
+# number of bootstrap replicates fitted at once
+# (the replicates of a fit are never split across chunks)
+CHUNK_SIZE = 50000
+
+
+def _design(i, j, mask, K):
+    # X[b, n] = e_0 + e_i - e_j (with alpha_0 at index 0)
+    B, N = i.shape
+    X = np.zeros((B, N, K + 1))
+    X[..., 0] = 1
+    b, n = np.indices((B, N))
+    X[b, n, i + 1] += 1
+    X[b, n, j + 1] -= 1
+    return X * mask[..., None]
+
+
+def fit_map(X, y, mask, n_iter=100, tol=1e-10):
+    """Batched MAP estimate of (alpha_0, alpha) with Newton's method.
+
+    Returns the MAP estimates (B, K+1) and the negative Hessian
+    of the log posterior at the estimates (B, K+1, K+1).
+    """
+    B, __, P = X.shape
+    theta = np.zeros((B, P))
+    eye = np.eye(P)
+    for __ in range(n_iter):
+        p = 1 / (1 + np.exp(-np.einsum('bnk,bk->bn', X, theta)))
+        grad = np.einsum('bnk,bn->bk', X, (y - p) * mask) - theta
+        hess = np.einsum('bnk,bn,bnl->bkl', X, p * (1 - p) * mask, X) + eye
+        step = np.linalg.solve(hess, grad[..., None])[..., 0]
+        theta = theta + step
+        if np.abs(step).max() < tol:
+            break
+    p = 1 / (1 + np.exp(-np.einsum('bnk,bk->bn', X, theta)))
+    hess = np.einsum('bnk,bn,bnl->bkl', X, p * (1 - p) * mask, X) + eye
+    return theta, hess
+
+
+def _rankings(alpha, present):
+    # rank of player ability among the players compared in the fit
+    # (1 is the best, absent players have rank 0)
+    masked = np.where(present, alpha, -np.inf)
+    order = np.argsort(-masked, axis=-1, kind='stable')
+    ranking = np.empty_like(order)
+    np.put_along_axis(ranking, order,
+                      np.arange(1, alpha.shape[-1] + 1), axis=-1)
+    return np.where(present, ranking, 0)
+
+
+def _probabilities(alpha, present):
+    masked = np.where(present, alpha, -np.inf)
+    masked = masked - masked.max(axis=-1, keepdims=True)
+    exp = np.exp(masked)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def bradley_terry_fast(dfs,
+                       K,
+                       interval=LAPLACE,
+                       n_draws=4000,
+                       hdi_prob=.95,
+                       seed=0,
+                       seeds=None,
+                       chunk_size=CHUNK_SIZE):
+    """Fit a batch of Bradley-Terry models at once.
+
+    Each data frame has the columns of ``load_data`` (1-based players).
+    Returns the same tuples of (player, statistics) as ``bradley_terry``.
+    The draws of every fit come from a generator of its own (one of
+    `seeds`, e.g. ``fit_seed(key)``, or spawned from `seed`), such that
+    they do not depend on the other fits of the batch.
+    """
+    B, N = len(dfs), max(map(len, dfs))
+    if seeds is None:
+        seeds = np.random.SeedSequence(seed).spawn(B)
+    rngs = [np.random.default_rng(s) for s in seeds]
+
+    # pad comparisons (padded comparisons are masked out)
+    i = np.zeros((B, N), dtype=int)
+    j = np.zeros((B, N), dtype=int)
+    y = np.zeros((B, N))
+    mask = np.zeros((B, N))
+    present = np.zeros((B, K), dtype=bool)
+    for b, df in enumerate(dfs):
+        n = len(df)
+        i[b, :n] = df['player_i'].values - 1
+        j[b, :n] = df['player_j'].values - 1
+        y[b, :n] = df['i_gt_j'].values
+        mask[b, :n] = 1
+        present[b, i[b, :n]] = True
+        present[b, j[b, :n]] = True
+
+    if interval == LAPLACE:
+        # draws from the normal approximation at the MAP
+        theta, hess = fit_map(_design(i, j, mask, K), y, mask)
+        cov = np.linalg.inv(hess)
+        chol = np.linalg.cholesky((cov + np.swapaxes(cov, -1, -2)) / 2)
+        z = np.stack([rng.standard_normal((n_draws, K + 1))
+                      for rng in rngs])
+        draws = theta[:, None, :] + np.einsum('bkl,bsl->bsk', chol, z)
+    elif interval == BOOTSTRAP:
+        # MAP estimates over resampled comparisons
+        # (the replicates of many fits are fitted at once, in chunks,
+        # and resampled chunk by chunk)
+        n_obs = mask.sum(axis=1).astype(int)
+        fits = max(1, chunk_size // n_draws)
+        draws = []
+        for start in range(0, B, fits):
+            bs = range(start, min(start + fits, B))
+            # (padded comparisons are resampled as 0 and masked out)
+            idx = np.zeros((len(bs), n_draws, N), dtype=int)
+            for c, b in enumerate(bs):
+                idx[c, :, :n_obs[b]] = rngs[b].integers(
+                    n_obs[b], size=(n_draws, n_obs[b]))
+            rows = np.array(bs)[:, None, None]
+            shape = (len(bs) * n_draws, N)
+            mask_boot = np.repeat(mask[bs.start:bs.stop], n_draws, axis=0)
+            draws.append(fit_map(
+                _design(i[rows, idx].reshape(shape),
+                        j[rows, idx].reshape(shape), mask_boot, K),
+                y[rows, idx].reshape(shape), mask_boot)[0])
+        draws = np.concatenate(draws).reshape(B, n_draws, K + 1)
+    else:
+        raise Exception(f"Unknown interval: {interval}")
+
+    alpha_0 = draws[..., 0]
+    alpha = draws[..., 1:]
+    ranking = _rankings(alpha, present[:, None, :])
+    probability = _probabilities(alpha, present[:, None, :])
+
+    # summary statistics, rounded as in arviz.summary
+    summaries = dict(
+        alpha=summarize_iid(np.moveaxis(alpha, 1, -1), hdi_prob=hdi_prob),
+        ranking=summarize_iid(np.moveaxis(ranking, 1, -1),
+                              hdi_prob=hdi_prob),
+        probability=summarize_iid(np.moveaxis(probability, 1, -1),
+                                  hdi_prob=hdi_prob))
+    summaries = {param: round_stats(stats)
+                 for param, stats in summaries.items()}
+    summary_0 = dict(alpha_0=round_stats(
+        summarize_iid(alpha_0, hdi_prob=hdi_prob)))
+
+    results = []
+    for b in range(B):
+        values = {n: {f'{param}_'+k: float(v[b, n])
+                      for param, stats in summaries.items()
+                      for k, v in stats.items()}
+                  for n in np.flatnonzero(present[b])}
+        for param, stats in summary_0.items():
+            for n in values:
+                for k, v in stats.items():
+                    values[n][f'{param}_'+k] = float(v[b])
+        results.append(tuple(values.items()))
+    return results
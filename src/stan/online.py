@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import json
+import math
+import os
+import sys
+import time
+from os.path import join
+
+# third
+import pandas as pd
+
+# local
+from ..constants import COMPARISONS_DIR
+from ..utils.offsets import iter_lines
+from . import comparisons
+from .bradley_terry import compute_bradley_terry, fit_seed, make_executor
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# the same model as bradley-terry-bayesian.stan
+# alpha_0 ~ normal(0, 1), alpha ~ normal(0, 1)
+# y ~ bernoulli_logit(alpha_0 + alpha[i] - alpha[j])
+# with independent normal beliefs per item and attribute, updated
+# judgment after judgment by assumed-density filtering (moment matching),
+# approximating the logistic with a probit: logit^-1(x) ~ Phi(KAPPA * x)
+KAPPA = math.sqrt(math.pi / 8)
+
+PRIOR_MEAN = 0.
+PRIOR_VAR = 1.
+
+# largest change of an ability mean since the last Stan fit
+# after which the item is fitted again (in the background)
+DRIFT = .25
+
+EVENTS_FILE = join(COMPARISONS_DIR, 'events.jsonl')
+
+ONLINE = 'online'
+STAN = 'stan'
+
+
+def new_belief():
+    return dict(mean={}, var={}, mean_0=PRIOR_MEAN, var_0=PRIOR_VAR,
+                anchor={}, games=[], raters=[], n_fitted=0, source=ONLINE)
+
+
+def _normal_ratio(z):
+    # pdf(z) / cdf(z), stable for very negative z
+    cdf = .5 * math.erfc(-z / math.sqrt(2))
+    pdf = math.exp(-z * z / 2) / math.sqrt(2 * math.pi)
+    return pdf / cdf if cdf > 1e-300 else -z
+
+
+def factors(belief, player_a, player_b, a_gt_b):
+    # scale (c), standardized margin (z) and pdf/cdf ratio (r) of a judgment
+    mean, var = belief['mean'], belief['var']
+    m = belief['mean_0'] + mean.get(player_a, PRIOR_MEAN) \
+        - mean.get(player_b, PRIOR_MEAN)
+    v = belief['var_0'] + var.get(player_a, PRIOR_VAR) \
+        + var.get(player_b, PRIOR_VAR)
+    c = math.sqrt(1 / KAPPA ** 2 + v)
+    z = (1. if a_gt_b else -1.) * m / c
+    return c, z, _normal_ratio(z)
+
+
+def probability(belief, player_a, player_b):
+    # predictive probability that a is judged better than b
+    __, z, __ = factors(belief, player_a, player_b, True)
+    return .5 * math.erfc(-z / math.sqrt(2))
+
+
+def update(belief, player_a, player_b, a_gt_b):
+    """Update the belief with one judgment (in place).
+
+    Ties carry no information about who is better and only count
+    in the Stan fits (where they are resolved by a coin flip).
+    """
+    for player in (player_a, player_b):
+        belief['mean'].setdefault(player, PRIOR_MEAN)
+        belief['var'].setdefault(player, PRIOR_VAR)
+    if a_gt_b is None:
+        return belief
+
+    mean, var = belief['mean'], belief['var']
+    c, z, r = factors(belief, player_a, player_b, a_gt_b)
+    s = 1. if a_gt_b else -1.
+
+    # alpha_0 and alpha_a push the outcome up, alpha_b pulls it down
+    v_0 = belief['var_0']
+    belief['mean_0'] += s * v_0 * r / c
+    belief['var_0'] *= 1 - v_0 * r * (r + z) / c ** 2
+    for player, sign in ((player_a, 1.), (player_b, -1.)):
+        v_k = var[player]
+        mean[player] += sign * s * v_k * r / c
+        var[player] *= 1 - v_k * r * (r + z) / c ** 2
+    return belief
+
+
+def drift(belief):
+    # largest change of an ability mean since the last Stan fit
+    return max((abs(m - belief['anchor'].get(player, PRIOR_MEAN))
+                for player, m in belief['mean'].items()), default=0.)
+
+
+def _key(event):
+    return (event['task'], event['filename'], str(event['line_idx']),
+            event['attribute'])
+
+
+class OnlineAbilities(object):
+    """Abilities per item and attribute, kept current as judgments arrive.
+
+    Judgments are appended to an event log (JSONL) and applied to the
+    beliefs right away. Items whose abilities drifted too far from their
+    last Stan fit are fitted again in a background process pool,
+    after which the judgments that arrived in the meantime are replayed.
+    The beliefs and the position in the log are saved in a state file.
+    """
+
+    def __init__(self, events_file=EVENTS_FILE, state_file=None,
+                 threshold=DRIFT, jobs=1, **kwargs) -> None:
+        super().__init__()
+        self.events_file = events_file
+        self.state_file = state_file or \
+            os.path.splitext(events_file)[0] + '.state.json'
+        self.threshold = threshold
+        self.jobs = jobs
+        # arguments of compute_bradley_terry (e.g. num_chains)
+        self.kwargs = kwargs
+        self.beliefs = {}
+        self.offset = 0
+        self.pending = {}
+        self.executor = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as fh:
+                state = json.load(fh)
+            self.offset = state['offset']
+            self.beliefs = {tuple(json.loads(key)): belief
+                            for key, belief in state['beliefs'].items()}
+
+    def append(self, items):
+        """Append the judgments of new items (as in items.jsonl)."""
+        now = time.time()
+        with open(self.events_file, 'a') as fh:
+            for row in comparisons.iter_rows(items):
+                event = {k: row[k] for k in (
+                    'task', 'filename', 'line_idx', 'attribute', 'rater',
+                    'player_a', 'player_b', 'a_gt_b')}
+                event['time'] = now
+                fh.write(json.dumps(event) + '\n')
+        return self.consume()
+
+    def consume(self):
+        """Apply the judgments appended to the log since the last call."""
+        if not os.path.exists(self.events_file):
+            return 0
+        n = 0
+        for offset, length, line in iter_lines(self.events_file,
+                                               start=self.offset):
+            event = json.loads(line)
+            belief = self.beliefs.setdefault(_key(event), new_belief())
+            # a rater judges an item (and attribute) only once
+            if event['rater'] not in belief['raters']:
+                belief['raters'].append(event['rater'])
+                game = [event['player_a'], event['player_b'],
+                        event['a_gt_b']]
+                belief['games'].append(game)
+                update(belief, *game)
+                n += 1
+            self.offset = offset + length
+        return n
+
+    def due(self):
+        return [key for key, belief in self.beliefs.items()
+                if key not in self.pending
+                and drift(belief) > self.threshold]
+
+    def refit(self, players, keys=None):
+        # fit the drifted items with Stan in the background
+        keys = self.due() if keys is None else keys
+        if keys and self.executor is None:
+            self.executor = make_executor(self.jobs)
+        for key in keys:
+            games = list(self.beliefs[key]['games'])
+            future = self.executor.submit(compute_bradley_terry,
+                                          players, games,
+                                          seed=fit_seed(key),
+                                          **self.kwargs)
+            self.pending[key] = (future, players, len(games))
+        return keys
+
+    def collect(self, wait=False):
+        """Apply the Stan fits that are done (or all, if `wait`)."""
+        done = []
+        for key, (future, players, n_fitted) in list(self.pending.items()):
+            if not (wait or future.done()):
+                continue
+            estimates = future.result()
+            del self.pending[key]
+            belief = self.beliefs[key]
+            belief['mean'] = {players[n]: params['alpha_mean']
+                              for n, params in estimates}
+            belief['var'] = {players[n]: params['alpha_sd'] ** 2
+                             for n, params in estimates}
+            __, params = estimates[0]
+            belief['mean_0'] = params['alpha_0_mean']
+            belief['var_0'] = params['alpha_0_sd'] ** 2
+            belief['anchor'] = dict(belief['mean'])
+            belief['n_fitted'] = n_fitted
+            belief['source'] = STAN
+            # replay the judgments that arrived during the fit
+            for game in belief['games'][n_fitted:]:
+                update(belief, *game)
+            done.append(key)
+        return done
+
+    def close(self, wait=True):
+        if wait:
+            self.collect(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=not wait)
+            self.executor = None
+            self.pending = {}
+
+    def save(self):
+        state = dict(offset=self.offset,
+                     beliefs={json.dumps(list(key)): belief
+                              for key, belief in self.beliefs.items()})
+        with open(self.state_file + '.tmp', 'w') as fh:
+            json.dump(state, fh)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def snapshot(self):
+        # current estimates, with 95% intervals of the normal beliefs
+        records = []
+        for (task, filename, line_idx, attr), belief in self.beliefs.items():
+            for player, mean in belief['mean'].items():
+                sd = math.sqrt(belief['var'][player])
+                records.append({'task': task,
+                                'filename': filename,
+                                'line_idx': line_idx,
+                                'model': player,
+                                'attribute': attr,
+                                'alpha_mean': mean,
+                                'alpha_sd': sd,
+                                'alpha_ci_low': mean - 1.96 * sd,
+                                'alpha_ci_high': mean + 1.96 * sd,
+                                'alpha_0_mean': belief['mean_0'],
+                                'n_comparisons': len(belief['games']),
+                                'n_fitted': belief['n_fitted'],
+                                'drift': drift(belief),
+                                'source': belief['source']})
+        return pd.DataFrame.from_records(records)
+
+    def write_snapshot(self, output_file):
+        df = self.snapshot()
+        df.to_csv(output_file + '.tmp', index=False)
+        os.replace(output_file + '.tmp', output_file)
+        return df
+
+
+def _players(online, players=None):
+    # all players seen so far (sorted, as in bradley_terry)
+    seen = {p for belief in online.beliefs.values() for p in belief['mean']}
+    return sorted(seen | set(players or []))
+
+
+def main(args):
+    online = OnlineAbilities(args.events_file, state_file=args.state_file,
+                             threshold=args.drift, jobs=args.jobs,
+                             num_chains=args.chains)
+
+    if args.command == 'append':
+        with open(args.items_jsonl) as fh:
+            n = online.append(map(json.loads, fh))
+        sys.stderr.write(f"[Done] {n} judgments\n")
+    else:
+        online.consume()
+
+    if args.command in ('append', 'refit') and not args.no_refit:
+        keys = online.refit(_players(online))
+        sys.stderr.write(f"[Refit] {len(keys)} items\n")
+        online.close(wait=True)
+
+    elif args.command == 'watch':
+        # follow the log: update, refit in the background, snapshot
+        try:
+            while True:
+                n = online.consume()
+                done = online.collect()
+                online.refit(_players(online))
+                if n or done:
+                    online.save()
+                    if args.output_file:
+                        online.write_snapshot(args.output_file)
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            online.close(wait=False)
+
+    online.save()
+    if args.output_file:
+        online.write_snapshot(args.output_file)
+    elif args.command == 'snapshot':
+        online.snapshot().to_csv(sys.stdout, index=False)
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-e', '--events-file', default=EVENTS_FILE)
+    parser.add_argument('-s', '--state-file')
+    parser.add_argument('-o', '--output-file',
+                        help="write a snapshot of the estimates (CSV)")
+    parser.add_argument('--drift', type=float, default=DRIFT,
+                        help="refit an item with Stan once an ability "
+                             "moved this far from its last fit")
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--chains', type=int, default=4)
+    parser.add_argument('--no-refit', action='store_true', default=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    append = subparsers.add_parser('append')
+    append.add_argument('items_jsonl')
+    subparsers.add_parser('refit')
+    subparsers.add_parser('snapshot')
+    watch = subparsers.add_parser('watch')
+    watch.add_argument('--interval', type=float, default=5.)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
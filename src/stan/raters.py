@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import sys
+
+# third
+import numpy as np
+import pandas as pd
+import yaml
+
+# local
+from . import comparisons
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# quality of the human raters, computed on the comparisons table
+# (all raters, items and attributes at once)
+# - agreement with the consensus of the other raters on the same pair
+# - split-half reliability of the consensus (random halves of raters)
+# - timing anomalies (pages submitted much faster than by other raters)
+
+# a rater is flagged in an attribute if their agreement lies this many
+# standard errors below the agreement of all raters
+AGREEMENT_Z = 2.
+
+# robust z-score (on log seconds, per item) of a judgment made too fast
+# (Iglewicz and Hoaglin, 1993)
+TIMING_Z = 3.5
+# share of too fast judgments after which a rater is flagged
+TIMING_SHARE = .25
+TIMING_COLUMN = 'page_submit'
+
+SPLITS = 1000
+
+
+def _signs(table):
+    # +1 if the first player (in sorted order) was judged better,
+    # -1 if the second one was, and 0 for ties
+    i = table['player_i'].values
+    j = table['player_j'].values
+    y = 2 * table['y'].values.astype(int) - 1
+    signs = np.where(i < j, y, -y)
+    return np.where(table['is_tie'].values, 0, signs)
+
+
+def _groups(table):
+    # codes of (item, attribute, unordered pair of players)
+    i = table['player_i'].values
+    j = table['player_j'].values
+    return table.groupby(
+        [table['item'].values, table['attribute'].cat.codes.values,
+         np.minimum(i, j), np.maximum(i, j)], sort=False).ngroup().values
+
+
+def agreement(table):
+    """Agreement of every rater with the leave-one-out consensus.
+
+    The consensus on a pair of players (per item and attribute) is the
+    majority of the other raters who judged the same pair. Judgments
+    without a consensus (a tie or no other rater) are not counted.
+    Returns one row per rater and attribute with the number of judgments
+    (n), the number in agreement (k), the agreement (k / n) and a z-score
+    against the agreement of all raters in the attribute.
+    """
+    signs = _signs(table)
+    groups = _groups(table)
+    judged = (signs != 0).astype(float)
+    totals = np.bincount(groups, weights=signs)
+    counts = np.bincount(groups, weights=judged)
+    others = totals[groups] - signs
+    counted = (signs != 0) & (counts[groups] - judged > 0) & (others != 0)
+    agrees = counted & (signs * others > 0)
+
+    raters = table['rater'].cat.codes.values.astype(np.int64)
+    attrs = table['attribute'].cat.codes.values.astype(np.int64)
+    n_attrs = len(table['attribute'].cat.categories)
+    cells = raters * n_attrs + attrs
+    size = len(table['rater'].cat.categories) * n_attrs
+    n = np.bincount(cells, weights=counted, minlength=size)
+    k = np.bincount(cells, weights=agrees, minlength=size)
+    n, k = n.reshape(-1, n_attrs), k.reshape(-1, n_attrs)
+
+    p = k.sum(axis=0) / n.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (k - n * p) / np.sqrt(n * p * (1 - p))
+        rate = k / n
+
+    index = pd.MultiIndex.from_product(
+        [table['rater'].cat.categories, table['attribute'].cat.categories],
+        names=['rater', 'attribute'])
+    df = pd.DataFrame(dict(n=n.ravel(), k=k.ravel(), agreement=rate.ravel(),
+                           agreement_z=z.ravel()), index=index)
+    return df[df['n'] > 0].reset_index()
+
+
+def split_half(table, splits=SPLITS, seed=0):
+    """Split-half reliability of the consensus, per attribute.
+
+    Raters are split at random into two halves, many times at once.
+    For every split, the consensus of either half on every pair (per item)
+    is correlated across pairs and corrected with Spearman-Brown.
+    Returns the mean and 95% interval over the splits per attribute.
+    """
+    signs = _signs(table)
+    groups = _groups(table)
+    raters = table['rater'].cat.codes.values
+    n_groups, n_raters = groups.max() + 1, len(
+        table['rater'].cat.categories)
+
+    # judgments as a (pair x rater) matrix
+    judgments = np.zeros((n_groups, n_raters))
+    judgments[groups, raters] = signs
+    judged = np.zeros((n_groups, n_raters))
+    judged[groups, raters] = signs != 0
+
+    rng = np.random.default_rng(seed)
+    halves = np.tile(np.arange(n_raters) < n_raters // 2, (splits, 1))
+    halves = rng.permuted(halves, axis=1).T.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        first = (judgments @ halves) / (judged @ halves)
+        second = (judgments @ (1 - halves)) / (judged @ (1 - halves))
+
+    attrs = np.zeros(n_groups, dtype=int)
+    attrs[groups] = table['attribute'].cat.codes.values
+    records = []
+    for a, attr in enumerate(table['attribute'].cat.categories):
+        x, y = first[attrs == a], second[attrs == a]
+        mask = ~(np.isnan(x) | np.isnan(y))
+        x, y = np.where(mask, x, 0.), np.where(mask, y, 0.)
+        m = mask.sum(axis=0)
+        # pearson correlation per split (over the pairs in both halves)
+        dx = np.where(mask, x - x.sum(axis=0) / m, 0.)
+        dy = np.where(mask, y - y.sum(axis=0) / m, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r = (dx * dy).sum(axis=0) / np.sqrt(
+                (dx ** 2).sum(axis=0) * (dy ** 2).sum(axis=0))
+            reliability = 2 * r / (1 + r)
+        low, high = np.nanquantile(reliability, [.025, .975])
+        records.append(dict(attribute=attr,
+                            reliability=np.nanmean(reliability),
+                            reliability_ci_low=low,
+                            reliability_ci_high=high,
+                            splits=int((~np.isnan(reliability)).sum())))
+    return pd.DataFrame.from_records(records)
+
+
+def timing(table, column=TIMING_COLUMN, threshold=TIMING_Z):
+    """Share of judgments every rater made too fast.
+
+    Times are compared per item (one page per item and rater)
+    with robust z-scores of the log seconds.
+    """
+    pages = table.drop_duplicates(['item', 'rater'])
+    seconds = np.log(pages[column].astype(float))
+    by_item = seconds.groupby(pages['item'].values)
+    median = by_item.transform('median')
+    mad = (seconds - median).abs().groupby(
+        pages['item'].values).transform('median')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (seconds - median) / (1.4826 * mad)
+    df = pd.DataFrame(dict(rater=pages['rater'].values,
+                           timing_z=z.values,
+                           fast=(z < -threshold).values,
+                           seconds=pages[column].values))
+    return df.groupby('rater', observed=True).agg(
+        pages=('fast', 'size'),
+        median_seconds=('seconds', 'median'),
+        median_timing_z=('timing_z', 'median'),
+        fast_share=('fast', 'mean')).reset_index()
+
+
+def score(table, agreement_z=AGREEMENT_Z, timing_z=TIMING_Z,
+          timing_share=TIMING_SHARE):
+    """Flags of every rater, ranked from the most to the least suspect.
+
+    A rater gets a flag for every attribute in which they agree
+    significantly less with the consensus than the other raters,
+    and one more flag if too many of their pages were submitted too fast.
+    """
+    agree = agreement(table)
+    agree['flag'] = agree['agreement_z'] < -agreement_z
+    df = agree.groupby('rater', observed=True).agg(
+        n=('n', 'sum'), k=('k', 'sum'),
+        min_agreement_z=('agreement_z', 'min'),
+        agreement_flags=('flag', 'sum')).reset_index()
+    df['agreement'] = df['k'] / df['n']
+    df = df.merge(timing(table, threshold=timing_z), on='rater', how='outer')
+    df['timing_flag'] = df['fast_share'] >= timing_share
+    df['n_flags'] = df['agreement_flags'].fillna(0).astype(int) \
+        + df['timing_flag'].astype(int)
+    return df.sort_values(['n_flags', 'min_agreement_z'],
+                          ascending=[False, True]).reset_index(drop=True)
+
+
+def outliers(scores, min_flags=1):
+    # {rater: n_flags} as in outliers.yaml (most flags first)
+    flagged = scores[scores['n_flags'] >= min_flags]
+    return {str(rater): int(n)
+            for rater, n in zip(flagged['rater'], flagged['n_flags'])}
+
+
+def main(args):
+    table = comparisons.load(args.items_jsonl)
+    scores = score(table, agreement_z=args.agreement_z,
+                   timing_z=args.timing_z, timing_share=args.timing_share)
+    flagged = outliers(scores, min_flags=args.min_flags)
+    if args.report:
+        scores.to_csv(args.report, index=False)
+
+    if args.splits:
+        before = split_half(table, splits=args.splits, seed=args.seed)
+        after = split_half(comparisons.drop_raters(table, flagged),
+                           splits=args.splits, seed=args.seed)
+        for (__, b), (__, a) in zip(before.iterrows(), after.iterrows()):
+            sys.stderr.write(
+                f"{b['attribute']}: split-half reliability "
+                f"{b['reliability']:.3f} "
+                f"[{b['reliability_ci_low']:.3f}, "
+                f"{b['reliability_ci_high']:.3f}], "
+                f"{a['reliability']:.3f} without outliers\n")
+
+    if args.output_file:
+        with open(args.output_file, 'w') as fh:
+            yaml.safe_dump(flagged, fh, sort_keys=False)
+    else:
+        yaml.safe_dump(flagged, sys.stdout, sort_keys=False)
+    sys.stderr.write(f"[Done] {len(flagged)} outliers "
+                     f"out of {len(scores)} raters\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('items_jsonl')
+    parser.add_argument('-o', '--output-file',
+                        help="outliers (YAML), e.g. outliers.yaml")
+    parser.add_argument('-r', '--report',
+                        help="scores of all raters (CSV)")
+    parser.add_argument('--agreement-z', type=float, default=AGREEMENT_Z)
+    parser.add_argument('--timing-z', type=float, default=TIMING_Z)
+    parser.add_argument('--timing-share', type=float, default=TIMING_SHARE)
+    parser.add_argument('--min-flags', type=int, default=1)
+    parser.add_argument('--splits', type=int, default=SPLITS,
+                        help="random splits for the split-half reliability "
+                             "(0 to skip)")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import contextlib
+import io
+import itertools
+import sys
+import time
+
+# third
+import numpy as np
+import pandas as pd
+
+# local
+from ..utils import synthetic
+from . import bradley_terry, comparisons
+from .summary import stat_names
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# parameter recovery: fit synthetic comparisons with known abilities
+# and measure how close the estimates are, per configuration of the data
+# (comparisons per item, tie rate, players) and of the estimator
+# (method, chains), along with the time it takes
+#
+# true abilities are drawn from the prior of the model (normal(0, 1)),
+# such that 95% intervals should cover them 95% of the time
+
+ATTRIBUTE = 'synthetic'
+
+HDI_LOW, HDI_HIGH = stat_names()[2:4]
+
+
+def make_abilities(n_items, n_players, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 1, size=(n_items, n_players))
+
+
+def simulate(n_items, n_raters, n_players, tie_rate, seed=0):
+    """Synthetic items (as in ``items.jsonl``) and their true abilities."""
+    players = [f'P{k}' for k in range(n_players)]
+    truth = make_abilities(n_items, n_players, seed=seed)
+    items = synthetic.make_items(
+        n_items, n_raters=n_raters, n_pool=n_raters, players=players,
+        attributes=[ATTRIBUTE],
+        abilities=[{ATTRIBUTE: dict(zip(players, alphas))}
+                   for alphas in truth],
+        tie_rate=tie_rate, seed=seed)
+    return players, items, truth
+
+
+def estimate(players, items, method=bradley_terry.NUTS, jobs=None,
+             num_chains=None):
+    table = comparisons.from_items(items)
+    kwargs = dict(method=method)
+    if method != bradley_terry.FAST:
+        kwargs.update(jobs=jobs, num_chains=num_chains)
+    # (stan writes its progress to stderr)
+    with contextlib.redirect_stderr(io.StringIO()):
+        return bradley_terry.compute_per_item(comparisons.TASK, players,
+                                              table, **kwargs)
+
+
+def metrics(df, truth, players):
+    # estimates of one configuration against the true abilities
+    item = df['filename'].str.extract(r'(\d+)', expand=False).astype(int)
+    player = pd.Categorical(df['model'], categories=players).codes
+    true = truth[item.values, player]
+    error = df['alpha_mean'].values - true
+    covered = (df[f'alpha_{HDI_LOW}'].values <= true) & \
+        (true <= df[f'alpha_{HDI_HIGH}'].values)
+    # (abilities are compared within an item: center them)
+    centered = pd.Series(error).groupby(item.values).transform(
+        lambda x: x - x.mean())
+    return dict(n_estimates=len(df),
+                bias=float(error.mean()),
+                rmse=float(np.sqrt((error ** 2).mean())),
+                rmse_centered=float(np.sqrt((centered ** 2).mean())),
+                coverage=float(covered.mean()),
+                width=float((df[f'alpha_{HDI_HIGH}'] -
+                             df[f'alpha_{HDI_LOW}']).mean()),
+                corr=float(np.corrcoef(df['alpha_mean'].values, true)[0, 1]))
+
+
+def configurations(raters, tie_rates, players, methods, chains):
+    for n_raters, tie_rate, n_players, method in itertools.product(
+            raters, tie_rates, players, methods):
+        # (the fast estimator has no chains)
+        for num_chains in ([None] if method == bradley_terry.FAST
+                           else chains):
+            yield dict(n_raters=n_raters, tie_rate=tie_rate,
+                       n_players=n_players, method=method,
+                       num_chains=num_chains)
+
+
+def run(configs, n_items=100, jobs=None, seed=0):
+    """Coverage, bias and time of every configuration."""
+    records = []
+    warm = set()
+    for config in configs:
+        players, items, truth = simulate(
+            n_items, config['n_raters'], config['n_players'],
+            config['tie_rate'], seed=seed)
+        # (compile the model once before timing)
+        if config['method'] not in warm:
+            estimate(players, items[:1], method=config['method'], jobs=1,
+                     num_chains=config['num_chains'])
+            warm.add(config['method'])
+        start = time.perf_counter()
+        df = estimate(players, items, method=config['method'], jobs=jobs,
+                      num_chains=config['num_chains'])
+        seconds = time.perf_counter() - start
+        records.append(dict(config,
+                            n_items=n_items,
+                            seconds=seconds,
+                            seconds_per_fit=seconds / n_items,
+                            **metrics(df, truth, players)))
+        sys.stderr.write(f"[Done] {config}: {seconds:.1f}s\n")
+    df = pd.DataFrame.from_records(records)
+    df['num_chains'] = df['num_chains'].astype('Int64')
+    return frontier(df)
+
+
+def frontier(df, cost='seconds_per_fit', error='rmse'):
+    # estimators that are not both slower and less accurate than another
+    # one on the same data (the speed-versus-accuracy frontier)
+    data = ['n_raters', 'tie_rate', 'n_players']
+    df = df.copy()
+    df['frontier'] = False
+    for __, group in df.groupby(data, sort=False):
+        for n, row in group.iterrows():
+            dominated = ((group[cost] <= row[cost]) &
+                         (group[error] <= row[error]) &
+                         ((group[cost] < row[cost]) |
+                          (group[error] < row[error]))).any()
+            df.loc[n, 'frontier'] = not dominated
+    return df
+
+
+def main(args):
+    df = run(configurations(args.raters, args.tie_rates, args.players,
+                            args.methods, args.chains),
+             n_items=args.items, jobs=args.jobs, seed=args.seed)
+    if args.output_file:
+        df.to_csv(args.output_file, index=False)
+    else:
+        columns = ['n_raters', 'tie_rate', 'n_players', 'method',
+                   'num_chains', 'seconds_per_fit', 'bias', 'rmse',
+                   'coverage', 'width', 'frontier']
+        sys.stdout.write(df[columns].to_string(index=False) + '\n')
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-n', '--items', type=int, default=100,
+                        help="fits per configuration")
+    parser.add_argument('--raters', type=int, nargs='+', default=[6, 11, 22],
+                        help="comparisons per item")
+    parser.add_argument('--tie-rates', type=float, nargs='+',
+                        default=[0., .05, .2])
+    parser.add_argument('--players', type=int, nargs='+', default=[3])
+    parser.add_argument('--methods', nargs='+',
+                        choices=bradley_terry.METHODS,
+                        default=bradley_terry.METHODS)
+    parser.add_argument('--chains', type=int, nargs='+',
+                        default=[bradley_terry.NUM_CHAINS])
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of fits in flight")
+    parser.add_argument('-o', '--output-file')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
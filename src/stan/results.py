@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import json
+import os
+import shutil
+from glob import glob
+from os.path import basename, exists, isdir, join
+
+# third
+import pandas as pd
+import pyarrow.parquet as pq
+
+# local
+from ..utils.offsets import iter_lines
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# results of many fits, written as soon as every fit is done
+# e.g. abilities.csv
+# --> abilities.csv (rows appended after every fit)
+# --> abilities.csv.manifest.jsonl (settings of the run on the first line,
+#     then the keys of the fits that were written)
+# e.g. abilities.parquet
+# --> abilities.parquet.parts/part-00000.parquet (one row group of fits)
+# --> abilities.parquet.manifest.jsonl
+# --> abilities.parquet (all parts, once the run is complete)
+# a fit is done once its key is in the manifest: restarts skip it
+# (restarts with other settings are refused)
+
+CSV = 'csv'
+PARQUET = 'parquet'
+FORMATS = [CSV, PARQUET]
+
+MANIFEST_EXT = '.manifest.jsonl'
+PARTS_EXT = '.parts'
+
+# fits per row group (parquet)
+ROW_GROUP_SIZE = 100
+
+
+def _key(key):
+    # (keys are tuples of table values, e.g. task, filename, line_idx, ...)
+    return json.dumps([k.item() if hasattr(k, 'item') else k for k in key],
+                      default=str)
+
+
+class ResultWriter(object):
+    """Append-only output of fits with a manifest of the completed keys.
+
+    Rows are only in the output once their keys are in the manifest:
+    after a crash, a CSV is cut back to the size recorded with the last
+    keys, and parquet parts that are not in the manifest are removed.
+    At most `row_group_size` fits are held in memory.
+
+    The `settings` of the run (e.g., method, chains and outliers) head the
+    manifest: a run with other settings, or an output that exists without
+    a manifest, raises an exception unless `force` (start over).
+    """
+
+    def __init__(self, path, settings=None, fmt=None,
+                 row_group_size=ROW_GROUP_SIZE, force=False) -> None:
+        super().__init__()
+        self.path = path
+        # (as read back from the manifest)
+        self.settings = json.loads(json.dumps(settings or {}))
+        self.fmt = fmt or (PARQUET if path.endswith('.parquet') else CSV)
+        self.manifest = path + MANIFEST_EXT
+        self.parts_dir = path + PARTS_EXT
+        self.row_group_size = row_group_size if self.fmt == PARQUET else 1
+        self.done = set()
+        self._size = 0
+        self._parts = []
+        self._keys = []
+        self._rows = []
+        if force:
+            self._clear()
+        self._resume()
+
+    def _clear(self):
+        for path in (self.path, self.manifest):
+            if exists(path):
+                os.remove(path)
+        if isdir(self.parts_dir):
+            shutil.rmtree(self.parts_dir)
+
+    def _read_manifest(self):
+        # settings and entries (None if there is no complete first line)
+        header, entries, size = None, [], 0
+        for offset, length, line in iter_lines(self.manifest):
+            if header is None:
+                header = json.loads(line)
+            else:
+                entries.append(json.loads(line))
+            size = offset + length
+        # (drop a last line that was not written completely)
+        os.truncate(self.manifest, size)
+        return header, entries
+
+    def _resume(self):
+        header, entries = None, []
+        if exists(self.manifest):
+            header, entries = self._read_manifest()
+        if header is None and exists(self.path):
+            raise Exception(f"{self.path} exists without a manifest "
+                            f"(not written with --stream): "
+                            f"remove it or use --force")
+        if header is None:
+            with open(self.manifest, 'w') as fh:
+                fh.write(json.dumps(dict(settings=self.settings)) + '\n')
+        elif header.get('settings') != self.settings:
+            raise Exception(f"{self.path} was written with other settings "
+                            f"({header.get('settings')}, "
+                            f"not {self.settings}): "
+                            f"use another output file or --force")
+        for entry in entries:
+            self.done.update(entry['keys'])
+
+        if self.fmt == CSV:
+            self._size = entries[-1]['size'] if entries else 0
+            if exists(self.path):
+                os.truncate(self.path, self._size)
+        else:
+            self._parts = [entry['part'] for entry in entries]
+            os.makedirs(self.parts_dir, exist_ok=True)
+            for part in glob(join(self.parts_dir, '*')):
+                if basename(part) not in self._parts:
+                    os.remove(part)
+
+    def __contains__(self, key):
+        return _key(key) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def write(self, key, rows):
+        self._keys.append(_key(key))
+        self._rows.extend(rows)
+        if len(self._keys) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._keys:
+            return
+        df = pd.DataFrame.from_records(self._rows)
+        if self.fmt == CSV:
+            with open(self.path, 'ab') as fh:
+                fh.write(df.to_csv(header=self._size == 0,
+                                   index=False).encode('utf-8'))
+                self._size = fh.tell()
+            entry = dict(keys=self._keys, size=self._size)
+        else:
+            part = f'part-{len(self._parts):05d}.parquet'
+            df.to_parquet(join(self.parts_dir, part + '.tmp'), index=False)
+            os.replace(join(self.parts_dir, part + '.tmp'),
+                       join(self.parts_dir, part))
+            self._parts.append(part)
+            entry = dict(keys=self._keys, part=part)
+        with open(self.manifest, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+        self.done.update(self._keys)
+        self._keys, self._rows = [], []
+
+    def close(self):
+        self.flush()
+        if self.fmt == PARQUET and self._parts:
+            # one file with a row group per part (one part in memory)
+            writer = None
+            for part in self._parts:
+                table = pq.read_table(join(self.parts_dir, part))
+                if writer is None:
+                    writer = pq.ParquetWriter(self.path + '.tmp',
+                                              table.schema)
+                writer.write_table(table)
+            writer.close()
+            os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import hashlib
+import json
+import os
+import tempfile
+from os.path import join
+
+# third
+import numpy as np
+from scipy import stats
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# the statistics of arviz.summary (computed on numpy arrays instead)
+# for draws of shape (..., chain, draw), batched over all leading axes
+# (see Vehtari et al., 2021, Rank-normalization, folding, and localization)
+
+HDI_PROB = .95
+
+
+def stat_names(hdi_prob=HDI_PROB):
+    alpha = 1 - hdi_prob
+    return ['mean', 'sd', f'hdi_{100 * alpha / 2:g}%',
+            f'hdi_{100 * (1 - alpha / 2):g}%', 'mcse_mean', 'mcse_sd',
+            'ess_bulk', 'ess_tail', 'r_hat']
+
+
+STATS = stat_names()
+
+# decimals of arviz.summary
+DECIMALS = dict(ess_bulk=0, ess_tail=0, r_hat=2)
+
+
+def round_stats(values, decimals=3):
+    return {k: np.round(v, DECIMALS.get(k, decimals))
+            for k, v in values.items()}
+
+
+def hdi(draws, hdi_prob=HDI_PROB):
+    # highest density interval along the last axis
+    draws = np.sort(draws, axis=-1)
+    n = draws.shape[-1]
+    interval_idx_inc = int(np.floor(hdi_prob * n))
+    n_intervals = n - interval_idx_inc
+    widths = draws[..., interval_idx_inc:] - draws[..., :n_intervals]
+    idx = np.argmin(widths, axis=-1)[..., None]
+    low = np.take_along_axis(draws, idx, axis=-1)
+    high = np.take_along_axis(draws, idx + interval_idx_inc, axis=-1)
+    return low[..., 0], high[..., 0]
+
+
+def split_chains(draws):
+    # the first and second half of every chain as separate chains
+    half = draws.shape[-1] // 2
+    return np.concatenate([draws[..., :half], draws[..., -half:]], axis=-2)
+
+
+def z_scale(draws):
+    # rank-normalized draws (ranks pooled over chains)
+    shape = draws.shape
+    flat = draws.reshape(*shape[:-2], -1)
+    rank = stats.rankdata(flat, method='average', axis=-1)
+    rank = (rank - 3 / 8) / (flat.shape[-1] - 2 * 3 / 8 + 1)
+    return stats.norm.ppf(rank).reshape(shape)
+
+
+def autocov(draws):
+    # autocovariance of every chain for every lag (via FFT)
+    n = draws.shape[-1]
+    centered = draws - draws.mean(axis=-1, keepdims=True)
+    freq = np.fft.rfft(centered, n=2 * n, axis=-1)
+    return np.fft.irfft(freq * np.conjugate(freq), n=2 * n,
+                        axis=-1)[..., :n] / n
+
+
+def ess(draws):
+    """Effective sample size of draws (..., chain, draw).
+
+    Autocorrelations are summed with Geyer's initial positive sequence,
+    made monotone, as in arviz (and Stan).
+    """
+    draws = np.asarray(draws, dtype=float)
+    m, n = draws.shape[-2:]
+    size = m * n
+    acov = autocov(draws)
+    mean_var = acov[..., 0].mean(axis=-1) * n / (n - 1.)
+    var_plus = mean_var * (n - 1.) / n
+    if m > 1:
+        var_plus = var_plus + np.var(draws.mean(axis=-1), axis=-1, ddof=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = 1. - (mean_var[..., None] - acov.mean(axis=-2)) \
+            / var_plus[..., None]
+    rho[..., 0] = 1.
+
+    # sums of consecutive pairs of autocorrelations (0, 1), (2, 3), ...
+    n_pairs = max(1, (n - 3) // 2 + 1)
+    rho = np.concatenate([rho, np.zeros(rho.shape[:-1] + (2,))], axis=-1)
+    even = rho[..., 0:2 * n_pairs:2]
+    pairs = even + rho[..., 1:2 * n_pairs:2]
+
+    # the first pair that is not positive ends the sequence
+    # (or the last pair that is computed)
+    positive = np.concatenate([pairs > 0, np.zeros(pairs.shape[:-1] + (1,),
+                                                   dtype=bool)], axis=-1)
+    last = np.minimum(np.argmin(positive[..., 1:], axis=-1) + 1, n_pairs - 1)
+    last = np.where(positive[..., 0], last, 0)
+    k = np.arange(n_pairs)
+    monotone = np.minimum.accumulate(pairs, axis=-1)
+    tau = -1. + 2. * np.where(k < last[..., None], monotone, 0.).sum(axis=-1)
+    last_even = np.take_along_axis(even, last[..., None], axis=-1)[..., 0]
+    last_pair = np.take_along_axis(pairs, last[..., None], axis=-1)[..., 0]
+    tau += np.where((last_pair >= 0) | (last_even > 0) | (last == 0),
+                    last_even, 0.)
+    tau = np.maximum(tau, 1 / np.log10(size))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = size / tau
+    values = np.where(np.isnan(pairs).any(axis=-1), np.nan, values)
+    # constant draws
+    constant = (draws.max(axis=(-2, -1)) - draws.min(axis=(-2, -1))) \
+        < np.finfo(float).resolution
+    return np.where(constant, float(size), values)
+
+
+def ess_bulk(draws):
+    return ess(z_scale(split_chains(draws)))
+
+
+def ess_tail(draws):
+    # the smallest ESS of the 5% and 95% quantile indicators
+    flat = draws.reshape(*draws.shape[:-2], -1)
+    q05, q95 = np.quantile(flat, [.05, .95], axis=-1)
+    return np.minimum(
+        ess(split_chains((draws <= q05[..., None, None]).astype(float))),
+        ess(split_chains((draws <= q95[..., None, None]).astype(float))))
+
+
+def _rhat(draws):
+    n = draws.shape[-1]
+    between = n * np.var(draws.mean(axis=-1), axis=-1, ddof=1)
+    within = np.var(draws, axis=-1, ddof=1).mean(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt((between / within + n - 1) / n)
+
+
+def rhat(draws):
+    # rank-normalized split R-hat of the bulk and the (folded) tails
+    split = split_chains(draws)
+    flat = draws.reshape(*draws.shape[:-2], -1)
+    folded = np.abs(split - np.median(flat, axis=-1)[..., None, None])
+    bulk = _rhat(z_scale(split))
+    tail = _rhat(z_scale(folded))
+    # (undefined if the bulk is, as in arviz)
+    return np.where(np.isnan(bulk), np.nan, np.fmax(bulk, tail))
+
+
+def summarize(draws, hdi_prob=HDI_PROB):
+    """Statistics of draws of shape (chain, draw, *dims) per component.
+
+    Returns a dict from statistic (as in ``arviz.summary``) to an array
+    of shape dims. Several fits can be summarized at once by stacking
+    their draws along extra dimensions.
+    """
+    draws = np.moveaxis(np.asarray(draws, dtype=float), (0, 1), (-2, -1))
+    m, n = draws.shape[-2:]
+    flat = draws.reshape(*draws.shape[:-2], -1)
+    mean = flat.mean(axis=-1)
+    sd = flat.std(axis=-1, ddof=1)
+    hdi_low, hdi_high = hdi(flat, hdi_prob=hdi_prob)
+    values = dict(zip(stat_names(hdi_prob)[:4], (mean, sd, hdi_low, hdi_high)))
+
+    if n < 4:
+        nan = np.full_like(mean, np.nan)
+        values.update(mcse_mean=nan, mcse_sd=nan, ess_bulk=nan,
+                      ess_tail=nan, r_hat=nan)
+        return values
+
+    sims_c2 = (draws - mean[..., None, None]) ** 2
+    evar = sims_c2.mean(axis=(-2, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values['mcse_mean'] = np.sqrt(sd ** 2 / ess(split_chains(draws)))
+        varvar = ((sims_c2 ** 2).mean(axis=(-2, -1)) - evar ** 2) \
+            / ess(split_chains(sims_c2))
+        values['mcse_sd'] = np.sqrt(varvar / evar / 4)
+    values['ess_bulk'] = ess_bulk(draws)
+    values['ess_tail'] = ess_tail(draws)
+    values['r_hat'] = rhat(draws) if m > 1 else np.full_like(mean, np.nan)
+    return values
+
+
+def summarize_iid(draws, hdi_prob=HDI_PROB):
+    # statistics of independent draws along the last axis
+    n = draws.shape[-1]
+    mean = draws.mean(axis=-1)
+    sd = draws.std(axis=-1, ddof=1)
+    hdi_low, hdi_high = hdi(draws, hdi_prob=hdi_prob)
+    return dict(zip(stat_names(hdi_prob),
+                    (mean, sd, hdi_low, hdi_high,
+                     sd / np.sqrt(n), sd / np.sqrt(2 * (n - 1)),
+                     np.full_like(mean, n), np.full_like(mean, n),
+                     np.full_like(mean, np.nan))))
+
+
+class DrawStore(object):
+    """Directory of compressed draws, one npz file per fit.
+
+    Fits are identified by a JSON-encodable key
+    (e.g., task, filename, line_idx and attribute),
+    stored along with the draws and other metadata (e.g., the players).
+    """
+
+    EXT = '.npz'
+    KEY = '__key__'
+    META = '__meta__'
+
+    def __init__(self, store_dir) -> None:
+        super().__init__()
+        self.store_dir = store_dir
+
+    def path(self, key):
+        digest = hashlib.sha1(
+            json.dumps(key).encode('utf-8')).hexdigest()
+        return join(self.store_dir, digest + self.EXT)
+
+    def put(self, key, draws, **meta):
+        os.makedirs(self.store_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=self.EXT, dir=self.store_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez_compressed(fh,
+                                **{self.KEY: np.array(json.dumps(key)),
+                                   self.META: np.array(json.dumps(meta))},
+                                **draws)
+        os.replace(tmp, self.path(key))
+
+    def _load(self, path):
+        with np.load(path) as npz:
+            key = json.loads(str(npz[self.KEY]))
+            meta = json.loads(str(npz[self.META]))
+            draws = {name: npz[name] for name in npz.files
+                     if name not in (self.KEY, self.META)}
+        return key, draws, meta
+
+    def get(self, key, default=None):
+        """Draws and metadata of a fit (or `default`)."""
+        try:
+            __, draws, meta = self._load(self.path(key))
+        except FileNotFoundError:
+            return default
+        return draws, meta
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def __iter__(self):
+        # (key, draws, meta) of every fit
+        if not os.path.isdir(self.store_dir):
+            return
+        for name in sorted(os.listdir(self.store_dir)):
+            if name.endswith(self.EXT):
+                yield self._load(join(self.store_dir, name))
+
+    def __len__(self):
+        if not os.path.isdir(self.store_dir):
+            return 0
+        return sum(name.endswith(self.EXT)
+                   for name in os.listdir(self.store_dir))
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import json
+import os
+import re
+import sys
+from glob import glob
+from os.path import basename, join
+
+# third
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# local
+from ..constants import (ABILITIES_DIR, COLUMNAR_DIR, COMPARISONS_DIR,
+                         GENERATIONS_DIR)
+from ..stan import comparisons, contrasts, summary
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+GENERATIONS = 'generations'
+COMPARISONS = 'comparisons'
+ABILITIES = 'abilities'
+STAGES = [GENERATIONS, COMPARISONS, ABILITIES]
+
+# number of rows per parquet row group
+BATCH_SIZE = 10000
+
+# every table is keyed by task, filename, line_idx and model
+# (line_idx is a JSON string, e.g. "[95, 96, 97]" for TSCC or "0" for uptake)
+SCHEMAS = {
+    GENERATIONS: pa.schema([
+        ('task', pa.string()),
+        ('filename', pa.string()),
+        ('line_idx', pa.string()),
+        ('model', pa.string()),
+        ('world_log', pa.string()),
+        ('episode', pa.int32()),
+        ('turn', pa.int32()),
+        ('episode_done', pa.bool_()),
+        ('text', pa.string()),
+        ('eval_label', pa.string()),
+        ('response', pa.string()),
+        ('finish_reason', pa.string()),
+        ('f1', pa.float64()),
+        ('bleu_4', pa.float64()),
+        ('ppl', pa.float64()),
+        ('metrics', pa.string()),
+        ('openai_response', pa.string()),
+    ]),
+    COMPARISONS: pa.schema([
+        ('task', pa.string()),
+        ('filename', pa.string()),
+        ('line_idx', pa.string()),
+        ('attribute', pa.string()),
+        ('rater', pa.string()),
+        ('player_a', pa.string()),
+        ('player_b', pa.string()),
+        ('a_gt_b', pa.bool_()),
+        ('first_click', pa.float64()),
+        ('last_click', pa.float64()),
+        ('page_submit', pa.float64()),
+        ('click_count', pa.float64()),
+        ('input_text', pa.string()),
+    ]),
+    ABILITIES: pa.schema([
+        ('task', pa.string()),
+        ('filename', pa.string()),
+        ('line_idx', pa.string()),
+        ('model', pa.string()),
+        ('attribute', pa.string()),
+        ('text', pa.string()),
+        ('alpha', pa.float64()),
+        ('alpha_ci_low', pa.float64()),
+        ('alpha_ci_high', pa.float64()),
+        ('ranking', pa.float64()),
+        ('rank_ci_low', pa.float64()),
+        ('rank_ci_high', pa.float64()),
+        ('probability', pa.float64()),
+        ('probability_ci_low', pa.float64()),
+        ('probability_ci_high', pa.float64()),
+    ]),
+}
+
+
+def _line_idx(line_idx):
+    return json.dumps(list(line_idx)
+                      if isinstance(line_idx, (list, tuple)) else line_idx)
+
+
+def _iter_jsonl(filenames):
+    for filename in filenames:
+        with open(filename) as fh:
+            for n, line in enumerate(fh):
+                yield filename, n, json.loads(line)
+
+
+def iter_generations(filenames):
+    for world_log, episode, line in _iter_jsonl(filenames):
+        for turn, (msg, reply) in enumerate(line['dialog']):
+            # skip turns without a generation (e.g., skipped observations)
+            if not reply.get('id'):
+                continue
+            metrics = reply.get('metrics', {})
+            openai_response = reply.get('openai_response')
+            finish_reason = openai_response['choices'][0].get(
+                'finish_reason') if openai_response else None
+            yield dict(task=msg.get('id'),
+                       filename=msg['wherefrom']['filename'],
+                       line_idx=_line_idx(msg['wherefrom']['line_idx']),
+                       model=reply['id'],
+                       world_log=basename(world_log),
+                       episode=episode,
+                       turn=turn,
+                       episode_done=msg.get('episode_done'),
+                       text=msg.get('text'),
+                       eval_label=(msg.get('eval_labels') or [None])[0],
+                       response=reply.get('text'),
+                       finish_reason=finish_reason,
+                       f1=metrics.get('f1'),
+                       bleu_4=metrics.get('bleu-4'),
+                       ppl=metrics.get('ppl'),
+                       metrics=json.dumps(metrics),
+                       openai_response=json.dumps(openai_response)
+                       if openai_response else None)
+
+
+def iter_comparisons(filenames, task='comparisons'):
+    for filename in filenames:
+        with open(filename) as fh:
+            for row in comparisons.iter_rows(map(json.loads, fh), task=task):
+                yield dict(row, line_idx=_line_idx(row['line_idx']))
+
+
+def iter_abilities(filenames):
+    for __, __, line in _iter_jsonl(filenames):
+        yield dict(task=line['wherefrom']['task'],
+                   filename=line['wherefrom']['filename'],
+                   line_idx=_line_idx(line['wherefrom']['line_idx']),
+                   model=line['id'],
+                   attribute=line['attribute'],
+                   text=line.get('text'),
+                   alpha=line['alpha'],
+                   alpha_ci_low=line['alpha_ci'][0],
+                   alpha_ci_high=line['alpha_ci'][1],
+                   ranking=line['ranking'],
+                   rank_ci_low=line['rank_ci'][0],
+                   rank_ci_high=line['rank_ci'][1],
+                   probability=line['probability'],
+                   probability_ci_low=line['probability_ci'][0],
+                   probability_ci_high=line['probability_ci'][1])
+
+
+def iter_estimates(filenames):
+    # abilities recomputed by bradley_terry (CSV, e.g. by src.pipeline)
+    # (attributes named as in the abilities, see contrasts.ATTRIBUTES)
+    low, high = summary.STATS[2:4]
+    for filename in filenames:
+        for df in pd.read_csv(filename, dtype={'line_idx': str},
+                              chunksize=BATCH_SIZE):
+            for row in df.to_dict('records'):
+                yield dict(
+                    task=row['task'],
+                    filename=row['filename'],
+                    line_idx=row['line_idx'],
+                    model=row['model'],
+                    attribute=contrasts.normalize_attribute(row['attribute']),
+                    text=None,
+                    alpha=row['alpha_mean'],
+                    alpha_ci_low=row[f'alpha_{low}'],
+                    alpha_ci_high=row[f'alpha_{high}'],
+                    ranking=row['ranking_mean'],
+                    rank_ci_low=row[f'ranking_{low}'],
+                    rank_ci_high=row[f'ranking_{high}'],
+                    probability=row['probability_mean'],
+                    probability_ci_low=row[f'probability_{low}'],
+                    probability_ci_high=row[f'probability_{high}'])
+
+
+def _ability_key(record):
+    return tuple(record[k] for k in ('task', 'filename', 'line_idx',
+                                     'attribute', 'model'))
+
+
+def iter_all_abilities(estimates_files, filenames):
+    # the recomputed estimates replace the published abilities
+    # (of the same item, attribute and model, whose text they keep)
+    estimates = {_ability_key(record): record
+                 for record in iter_estimates(estimates_files)}
+    for record in iter_abilities(filenames):
+        estimate = estimates.pop(_ability_key(record), None)
+        yield record if estimate is None else \
+            dict(estimate, text=record['text'])
+    yield from estimates.values()
+
+
+def write_table(records, path, schema, batch_size=BATCH_SIZE):
+    # stream records into row groups (constant memory)
+    tmp = path + '.tmp'
+    with pq.ParquetWriter(tmp, schema) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                writer.write_batch(
+                    pa.RecordBatch.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_batch(
+                pa.RecordBatch.from_pylist(batch, schema=schema))
+    os.replace(tmp, path)
+    return path
+
+
+def convert(store_dir=COLUMNAR_DIR,
+            generations_dir=GENERATIONS_DIR,
+            comparisons_dir=COMPARISONS_DIR,
+            abilities_dir=ABILITIES_DIR,
+            estimates_files=()):
+    os.makedirs(store_dir, exist_ok=True)
+    sources = {
+        GENERATIONS: iter_generations(
+            sorted(glob(join(generations_dir, '*.jsonl')))),
+        COMPARISONS: iter_comparisons(
+            sorted(glob(join(comparisons_dir, '*.jsonl')))),
+        ABILITIES: iter_all_abilities(
+            estimates_files, sorted(glob(join(abilities_dir, '*.jsonl')))),
+    }
+    return {stage: write_table(records,
+                               join(store_dir, f'{stage}.parquet'),
+                               SCHEMAS[stage])
+            for stage, records in sources.items()}
+
+
+def read(stage, columns=None, filters=None, store_dir=COLUMNAR_DIR):
+    """Read the given columns of a stage table (memory-mapped).
+
+    Filters use the pyarrow DNF notation,
+    e.g. ``[('model', '==', 'GPT-3 Davinci')]``.
+    Only the row groups and columns that are needed are read.
+    """
+    return pq.read_table(join(store_dir, f'{stage}.parquet'),
+                         columns=columns,
+                         filters=filters or None,
+                         memory_map=True).to_pandas()
+
+
+def delta_abilities(attribute, reference='Teacher', store_dir=COLUMNAR_DIR):
+    # difference in ability between each model and the reference player
+    keys = ['task', 'filename', 'line_idx']
+    df = read(ABILITIES, columns=keys + ['model', 'alpha'],
+              filters=[('attribute', '==', attribute)], store_dir=store_dir)
+    ref = df[df['model'] == reference].drop(columns='model')
+    df = df[df['model'] != reference].merge(
+        ref, on=keys, suffixes=('', '_ref'))
+    df['delta'] = df['alpha'] - df['alpha_ref']
+    return df[keys + ['model', 'delta']]
+
+
+def responses_by_delta(model,
+                       attribute,
+                       below=0.,
+                       columns=('response',),
+                       store_dir=COLUMNAR_DIR):
+    # e.g. all Davinci responses on items where helpfulness delta < 0
+    keys = ['task', 'filename', 'line_idx', 'model']
+    deltas = delta_abilities(attribute, store_dir=store_dir)
+    deltas = deltas[(deltas['model'] == model) & (deltas['delta'] < below)]
+    generations = read(GENERATIONS, columns=keys + list(columns),
+                       filters=[('model', '==', model)], store_dir=store_dir)
+    return deltas.merge(generations, on=keys)
+
+
+FILTER_RE = re.compile(r'^\s*([\w-]+)\s*(==|!=|<=|>=|<|>|in)\s*(.+?)\s*$')
+
+
+def parse_filter(expr):
+    # e.g. "model == GPT-3 Davinci" or 'line_idx in ["0", "1"]'
+    match = FILTER_RE.match(expr)
+    if not match:
+        raise ap.ArgumentTypeError(f"Invalid filter: {expr}")
+    column, op, value = match.groups()
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return column, op, value
+
+
+def main(args):
+    if args.command == 'convert':
+        for stage, path in convert(
+                store_dir=args.store_dir,
+                estimates_files=args.estimates or ()).items():
+            sys.stderr.write(f"[Done] {stage}: {path}\n")
+        return
+
+    if args.command == 'query':
+        df = read(args.stage, columns=args.columns, filters=args.filters,
+                  store_dir=args.store_dir)
+    elif args.command == 'delta':
+        df = responses_by_delta(args.model, args.attribute,
+                                below=args.below, store_dir=args.store_dir)
+    df.to_csv(args.output_file or sys.stdout, index=False)
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-s', '--store-dir', default=COLUMNAR_DIR)
+    parser.add_argument('-o', '--output-file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_ = subparsers.add_parser('convert')
+    convert_.add_argument('-e', '--estimates', nargs='+',
+                          help="abilities recomputed by bradley_terry "
+                               "(CSV), instead of the published ones")
+    query = subparsers.add_parser('query')
+    query.add_argument('stage', choices=STAGES)
+    query.add_argument('-c', '--columns', nargs='+')
+    query.add_argument('-f', '--filters', nargs='+', type=parse_filter)
+    delta = subparsers.add_parser('delta')
+    delta.add_argument('-m', '--model', required=True)
+    delta.add_argument('-a', '--attribute', required=True)
+    delta.add_argument('--below', type=float, default=0.)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
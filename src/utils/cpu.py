@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import contextlib
+import ctypes.util
+import os
+import sys
+import time
+from os.path import exists, join
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# CPU-only inference of the (Blender) transformer models
+# - dynamic int8 quantization of the linear layers
+# - intra-op and inter-op thread counts
+# - a faster memory allocator (jemalloc or tcmalloc, preloaded)
+# - pinning the process to the cores of one NUMA node
+# torch is imported only once the environment is set
+
+JEMALLOC = 'jemalloc'
+TCMALLOC = 'tcmalloc'
+ALLOCATORS = {
+    JEMALLOC: ['libjemalloc.so.2', 'libjemalloc.so'],
+    TCMALLOC: ['libtcmalloc.so.4', 'libtcmalloc_minimal.so.4',
+               'libtcmalloc.so'],
+}
+LIB_DIRS = ['/usr/lib/x86_64-linux-gnu', '/usr/lib/aarch64-linux-gnu',
+            '/usr/lib64', '/usr/lib', '/usr/local/lib']
+
+# keep freed memory around (generation allocates the same sizes over and over)
+MALLOC_CONF = ('oversize_threshold:1,background_thread:true,'
+               'metadata_thp:auto,dirty_decay_ms:9000000000,'
+               'muzzy_decay_ms:9000000000')
+
+# set once the process was started with the environment below
+RELAUNCHED = 'CPU_OPTIMIZED'
+# read when the process starts (by the loader and the allocator)
+STARTUP = ('LD_PRELOAD', 'MALLOC_CONF')
+
+NODES_DIR = '/sys/devices/system/node'
+
+
+def parse_cpulist(cpulist):
+    # e.g. "0-3,8-11"
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        start, __, end = part.partition('-')
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def numa_nodes():
+    if not exists(NODES_DIR):
+        return [0]
+    return sorted(int(name[4:]) for name in os.listdir(NODES_DIR)
+                  if name.startswith('node') and name[4:].isdigit())
+
+
+def numa_cpus(node):
+    path = join(NODES_DIR, f'node{node}', 'cpulist')
+    if not exists(path):
+        return set(os.sched_getaffinity(0))
+    with open(path) as fh:
+        return parse_cpulist(fh.read())
+
+
+def find_allocator(allocator):
+    for name in ALLOCATORS[allocator]:
+        for lib_dir in LIB_DIRS:
+            if exists(join(lib_dir, name)):
+                return join(lib_dir, name)
+    found = ctypes.util.find_library(allocator)
+    if found is None:
+        raise Exception(f"Cannot find {allocator} "
+                        f"(install it or run without --allocator)")
+    return found
+
+
+def environment(threads, allocator=None):
+    """Variables that must be set before torch (and libc) are loaded."""
+    env = dict(OMP_NUM_THREADS=str(threads),
+               MKL_NUM_THREADS=str(threads),
+               KMP_BLOCKTIME='1',
+               KMP_AFFINITY='granularity=fine,compact,1,0')
+    if allocator:
+        library = find_allocator(allocator)
+        preload = os.environ.get('LD_PRELOAD', '')
+        if library not in preload.split(':'):
+            env['LD_PRELOAD'] = ':'.join(filter(None, [library, preload]))
+        if allocator == JEMALLOC:
+            env['MALLOC_CONF'] = MALLOC_CONF
+    return env
+
+
+def _argv():
+    # the command line of this process (sys.orig_argv is new in Python 3.10)
+    if hasattr(sys, 'orig_argv'):
+        return sys.orig_argv
+    spec = getattr(sys.modules['__main__'], '__spec__', None)
+    if spec is not None:
+        # started with -m (sys.argv[0] is then the path of the module)
+        return [sys.executable, '-m', spec.name] + sys.argv[1:]
+    return [sys.executable] + sys.argv
+
+
+def relaunch(env):
+    """Restart this process with the environment (if needed, once).
+
+    The allocator is only used if it is preloaded at start-up, so a new
+    LD_PRELOAD (or MALLOC_CONF) requires a restart. The OpenMP thread pool
+    reads its settings when torch is imported: they are set in place,
+    unless torch was imported already.
+    """
+    changed = {k: v for k, v in env.items() if os.environ.get(k) != v}
+    restart = any(k in STARTUP for k in changed) or \
+        bool(changed and 'torch' in sys.modules)
+    if not restart or os.environ.get(RELAUNCHED):
+        os.environ.update(changed)
+        return
+    sys.stderr.write(f"[CPU] restarting with {' '.join(sorted(changed))}\n")
+    sys.stderr.flush()
+    os.execve(sys.executable, _argv(),
+              {**os.environ, **env, RELAUNCHED: '1'})
+
+
+def pin(node):
+    # run on the cores of one NUMA node
+    # (memory is then allocated on that node, as it is first touched there)
+    cpus = numa_cpus(node)
+    os.sched_setaffinity(0, cpus)
+    return cpus
+
+
+def setup(threads=None, interop_threads=None, allocator=None,
+          numa_node=None):
+    """Set up the process for CPU inference (before any model is loaded).
+
+    Returns the settings that were applied.
+    """
+    cpus = pin(numa_node) if numa_node is not None \
+        else set(os.sched_getaffinity(0))
+    threads = threads or len(cpus)
+    relaunch(environment(threads, allocator=allocator))
+
+    import torch
+    torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    return dict(threads=torch.get_num_threads(),
+                interop_threads=torch.get_num_interop_threads(),
+                allocator=allocator or 'default',
+                numa_node=numa_node,
+                cpus=len(cpus))
+
+
+def quantize(model):
+    # int8 weights for all linear layers (activations quantized on the fly)
+    import torch
+    return torch.quantization.quantize_dynamic(
+        model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class Throughput(object):
+    """Generated tokens per second of an agent."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.tokens = 0
+        self.seconds = 0.
+        self.calls = 0
+
+    def wrap(self, generate):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            beam_preds_scores, *rest = generate(*args, **kwargs)
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+            self.tokens += sum(len(preds[0]) for preds in beam_preds_scores)
+            return (beam_preds_scores, *rest)
+        return timed
+
+    def report(self):
+        return dict(tokens=self.tokens,
+                    seconds=round(self.seconds, 3),
+                    generations=self.calls,
+                    tokens_per_second=round(self.tokens / self.seconds, 2)
+                    if self.seconds else None)
+
+
+def optimize_agent(agent, meter=None, int8=True):
+    # quantize the model of a (ParlAI) generator agent and time it
+    if int8:
+        agent.model = quantize(agent.model)
+    if meter is not None:
+        agent._generate = meter.wrap(agent._generate)
+    return agent
+
+
+@contextlib.contextmanager
+def optimized_agents(module, meter=None, int8=True):
+    """Optimize every agent created by `module` (e.g., a ParlAI script).
+
+    ParlAI scripts create their agents themselves (with create_agent),
+    so the agent is optimized right after it is created.
+    """
+    create_agent = module.create_agent
+
+    def create_optimized_agent(*args, **kwargs):
+        return optimize_agent(create_agent(*args, **kwargs), meter=meter,
+                              int8=int8)
+
+    module.create_agent = create_optimized_agent
+    try:
+        yield meter
+    finally:
+        module.create_agent = create_agent
@@ -2,12 +2,23 @@
 # -*- coding: utf-8 -*-
 
 # standard
+import json
 import os
 import re
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # third
 import openai
+import requests
+from requests.adapters import HTTPAdapter
 from transformers import GPT2TokenizerFast
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
 
 __author__ = "Anaïs Tack"
@@ -42,19 +53,230 @@ PRICING = {
 }
 
 
+# transport
+# (one pool of keep-alive connections shared by all requests and threads)
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 600
+POOL_SIZE = 16
+# retries of failed connections (requests that were sent are not retried)
+CONNECT_RETRIES = 2
+# TCP keep-alive: seconds idle before the first probe, between probes
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 6
+# timings of the last requests (for the report)
+TIMINGS = 10000
+
+# errors of the API (raised as in the openai library)
+# (TryAgain is not in all versions of the library, e.g. 0.11)
+ERRORS = {
+    400: openai.error.InvalidRequestError,
+    401: openai.error.AuthenticationError,
+    404: openai.error.InvalidRequestError,
+    409: getattr(openai.error, 'TryAgain', openai.error.APIError),
+    429: openai.error.RateLimitError,
+}
+
+
 tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
 
+# time spent connecting (in this thread, for the current request)
+_connect = threading.local()
+
+
+def _timed(connection_cls):
+
+    class TimedConnection(connection_cls):
+
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            _connect.seconds = getattr(_connect, 'seconds', 0.) + \
+                time.perf_counter() - start
+
+    return TimedConnection
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _timed(HTTPConnection)
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _timed(HTTPSConnection)
+
+
+def keepalive_options(idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL,
+                      probes=KEEPALIVE_PROBES):
+    # (the TCP options are not available on all platforms)
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', probes)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return HTTPConnection.default_socket_options + options
+
+
+class PooledAdapter(HTTPAdapter):
+    """Adapter with keep-alive sockets whose connect time is measured."""
+
+    def __init__(self, socket_options=None, **kwargs) -> None:
+        # (set before the pool manager is created by the adapter)
+        self.socket_options = socket_options or keepalive_options()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            http=_TimedHTTPConnectionPool, https=_TimedHTTPSConnectionPool)
+
+
+class Transport(object):
+    """Persistent HTTP session for the OpenAI API.
+
+    Connections are kept alive and reused (by the synchronous agent and
+    by concurrent requests alike), such that the TCP and TLS handshakes
+    are only paid once per connection. Every request returns how long it
+    took to connect (0 if a connection was reused), to receive the first
+    byte of the response (TTFB) and to transfer the response; the timings
+    of the last `history` requests are kept for the report.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE,
+                 connect_retries=CONNECT_RETRIES, keepalive=True,
+                 history=TIMINGS) -> None:
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = PooledAdapter(
+            socket_options=keepalive_options() if keepalive
+            else HTTPConnection.default_socket_options,
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True,
+            max_retries=Retry(total=connect_retries, connect=connect_retries,
+                              read=0, status=0, redirect=0))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = \
+            'keep-alive' if keepalive else 'close'
+        self.timings = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def headers(self):
+        headers = {'Authorization': f'Bearer {openai.api_key}'}
+        if openai.organization:
+            headers['OpenAI-Organization'] = openai.organization
+        return headers
+
+    def post(self, path, params):
+        _connect.seconds = 0.
+        start = time.perf_counter()
+        try:
+            # (stream: return once the headers are received)
+            response = self.session.post(f'{openai.api_base}{path}',
+                                         json=params,
+                                         headers=self.headers(),
+                                         timeout=self.timeout,
+                                         stream=True)
+            first_byte = time.perf_counter()
+            body = response.content
+        except requests.exceptions.RequestException as e:
+            raise openai.error.APIConnectionError(
+                f"Error communicating with OpenAI: {e}")
+        end = time.perf_counter()
+        timing = dict(connect=_connect.seconds,
+                      ttfb=first_byte - start - _connect.seconds,
+                      transfer=end - first_byte,
+                      total=end - start)
+        with self._lock:
+            self.timings.append(timing)
+        return self.interpret(response, body), timing
+
+    @staticmethod
+    def interpret(response, body):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise openai.error.APIError(
+                f"Invalid response from OpenAI: {body[:200]!r}",
+                http_body=body, http_status=response.status_code,
+                headers=response.headers)
+        if response.status_code < 400:
+            return data
+        error = data.get('error', {}) if isinstance(data, dict) else {}
+        cls = ERRORS.get(response.status_code, openai.error.APIError)
+        kwargs = dict(http_body=body, http_status=response.status_code,
+                      json_body=data, headers=response.headers)
+        if cls is openai.error.InvalidRequestError:
+            raise cls(error.get('message'), error.get('param'), **kwargs)
+        raise cls(error.get('message'), **kwargs)
+
+    def report(self):
+        """Median and 95th percentile of every phase (in seconds)."""
+        with self._lock:
+            timings = list(self.timings)
+        out = dict(requests=len(timings),
+                   reused=sum(t['connect'] == 0 for t in timings))
+        for phase in ('connect', 'ttfb', 'transfer', 'total'):
+            values = sorted(t[phase] for t in timings)
+            if values:
+                out[phase] = dict(
+                    median=round(values[len(values) // 2], 4),
+                    p95=round(values[int(.95 * (len(values) - 1))], 4))
+        return out
+
+
+transport = Transport()
+
+
+def configure(**kwargs):
+    """Replace the shared transport (e.g., with other timeouts)."""
+    global transport
+    transport = Transport(**kwargs)
+    return transport
+
 
 def tokenize(prompt):
     return tokenizer.encode(prompt)
 
 
-def request_completion(prompt, *args, **kwargs):
-    response = openai.Completion.create(
-        prompt=prompt,
-        *args, **kwargs
-    )
-    return response
+def request_completion(prompt, engine, **kwargs):
+    # (response, timing of the request)
+    # (streamed completions go through the openai library, without timing)
+    if kwargs.get('stream'):
+        return openai.Completion.create(prompt=prompt, engine=engine,
+                                        **kwargs), {}
+    params = {k: v for k, v in kwargs.items() if v is not None}
+    return transport.post(f'/engines/{engine}/completions',
+                          dict(params, prompt=prompt))
+
+
+def request_completions(batch, max_workers=POOL_SIZE):
+    """Many requests in flight over the shared pool (results in order)."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [response for response, __ in executor.map(
+            lambda kwargs: request_completion(**kwargs), batch)]
+
+
+def request_logprobs(prompts, engine, **kwargs):
+    # echo the prompts back with the logprob of every token
+    # (no completion: nothing is sampled)
+    response, __ = request_completion(prompts,
+                                      engine,
+                                      echo=True,
+                                      max_tokens=0,
+                                      logprobs=0,
+                                      **kwargs)
+    return sorted(response['choices'], key=lambda c: c['index'])
+
+
+def span_logprobs(choice, start):
+    # logprobs of the tokens that start at (or after) character `start`
+    logprobs = choice['logprobs']
+    return [(token, logprob) for token, logprob, offset in zip(
+        logprobs['tokens'], logprobs['token_logprobs'],
+        logprobs['text_offset']) if offset >= start]
 
 
 def count_prompt_tokens(prompt, stop):
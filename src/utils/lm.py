@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# third
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# likelihood of a text under a local (Hugging Face) causal language model,
+# given a prompt: the prompt and the text are encoded separately,
+# such that the tokens of the text are known exactly
+
+DTYPES = dict(float32=torch.float32, float16=torch.float16,
+              bfloat16=torch.bfloat16)
+
+
+class LocalLM(object):
+    """Causal language model that scores batches of (prompt, text) pairs."""
+
+    def __init__(self, model_name, device=None, dtype='float32') -> None:
+        super().__init__()
+        self.device = device or ('cuda' if torch.cuda.is_available()
+                                 else 'cpu')
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name, torch_dtype=DTYPES[dtype]).to(self.device).eval()
+        self.max_len = getattr(self.model.config, 'n_positions', None) or \
+            self.model.config.max_position_embeddings
+        self.pad_id = self.tokenizer.pad_token_id
+        if self.pad_id is None:
+            self.pad_id = self.tokenizer.eos_token_id
+
+    def tokenize(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def encode(self, prompt, text):
+        # (keep the text, cut the oldest tokens of the prompt)
+        prompt_ids, text_ids = self.tokenize(prompt), self.tokenize(text)
+        prompt_ids = prompt_ids[max(0, len(prompt_ids) + len(text_ids)
+                                    - self.max_len):]
+        if not prompt_ids:
+            raise Exception(f"Text too long to score "
+                            f"({len(text_ids)} tokens, "
+                            f"{self.max_len} in the model)")
+        return prompt_ids, text_ids
+
+    @torch.inference_mode()
+    def score(self, prompts, texts):
+        """Tokens and logprobs of every text given its prompt (one pass)."""
+        encoded = [self.encode(p, t) for p, t in zip(prompts, texts)]
+        width = max(len(p) + len(t) for p, t in encoded)
+        input_ids = torch.full((len(encoded), width), self.pad_id,
+                               dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for n, (p, t) in enumerate(encoded):
+            input_ids[n, :len(p) + len(t)] = torch.tensor(p + t)
+            attention_mask[n, :len(p) + len(t)] = 1
+        logits = self.model(input_ids=input_ids.to(self.device),
+                            attention_mask=attention_mask.to(self.device)
+                            ).logits.float()
+        # the logprob of token i is predicted at position i - 1
+        logprobs = torch.log_softmax(logits[:, :-1], dim=-1).gather(
+            -1, input_ids[:, 1:, None].to(self.device))[..., 0].cpu()
+        return [list(zip(self.tokenizer.convert_ids_to_tokens(t),
+                         logprobs[n, len(p) - 1:len(p) - 1 + len(t)].tolist()))
+                for n, (p, t) in enumerate(encoded)]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+MAGIC = b'OFFSETS1'
+
+
+def make_key(filename, line_idx):
+    # line_idx is a list of lines (TSCC) or a single line (EduUptake)
+    if isinstance(line_idx, (list, tuple)):
+        line_idx = list(line_idx)
+    return json.dumps([filename, line_idx])
+
+
+def _hash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return struct.unpack('<Q', digest)[0]
+
+
+def _mmap(path):
+    with open(path, 'rb') as fh:
+        # an empty file cannot be memory-mapped
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class OffsetTable(object):
+    """Memory-mapped table from keys to byte offsets.
+
+    Entries are fixed-width records (key hash, offset, length, extra)
+    sorted by key hash, such that a key is found by binary search
+    without loading the table. Keys are hashed, so callers must check
+    the record they read (hash collisions return several candidates).
+    """
+
+    HEADER = struct.Struct('<8sQ')
+    RECORD = struct.Struct('<QQII')
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        self.path = path
+        self._mm = None
+
+    def __getstate__(self):
+        # memory maps are reopened (and shared) in other processes
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @property
+    def mm(self):
+        if self._mm is None:
+            self._mm = _mmap(self.path)
+            magic, __ = self.HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                raise Exception(f"Not an offset table: {self.path}")
+        return self._mm
+
+    def __len__(self):
+        return self.HEADER.unpack_from(self.mm, 0)[1]
+
+    def _hash_at(self, n):
+        return self.RECORD.unpack_from(
+            self.mm, self.HEADER.size + n * self.RECORD.size)[0]
+
+    def lookup(self, key):
+        hash_ = _hash(key)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < hash_:
+                lo = mid + 1
+            else:
+                hi = mid
+        candidates = []
+        while lo < len(self):
+            record = self.RECORD.unpack_from(
+                self.mm, self.HEADER.size + lo * self.RECORD.size)
+            if record[0] != hash_:
+                break
+            candidates.append(record[1:])
+            lo += 1
+        return candidates
+
+    def __iter__(self):
+        for record in self.records():
+            yield record[1:]
+
+    def records(self):
+        # (key hash, offset, length, extra) of all entries
+        for n in range(len(self)):
+            yield self.RECORD.unpack_from(
+                self.mm, self.HEADER.size + n * self.RECORD.size)
+
+    @classmethod
+    def write(cls, path, entries):
+        # entries are (key, offset, length, extra) tuples
+        return cls._write(path, ((_hash(key), offset, length, extra)
+                                 for key, offset, length, extra in entries))
+
+    @classmethod
+    def extend(cls, path, entries):
+        # add entries to an existing table (rewritten, still sorted)
+        table = cls(path)
+        records = list(table.records())
+        table.close()
+        return cls._write(path, records + [
+            (_hash(key), offset, length, extra)
+            for key, offset, length, extra in entries])
+
+    @classmethod
+    def _write(cls, path, records):
+        records = sorted(records)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(cls.HEADER.pack(MAGIC, len(records)))
+            for record in records:
+                fh.write(cls.RECORD.pack(*record))
+        os.replace(tmp, path)
+        return cls(path)
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._mm = None
+
+
+class JsonlReader(object):
+    """Random access to the lines of a JSONL file by byte offset."""
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        self.path = path
+        self._mm = None
+
+    def __getstate__(self):
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @property
+    def mm(self):
+        if self._mm is None:
+            self._mm = _mmap(self.path)
+        return self._mm
+
+    def read(self, offset, length):
+        return json.loads(self.mm[offset:offset + length])
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._mm = None
+
+
+def iter_lines(path, start=0):
+    # yield (offset, length, line) for each line, in one streaming pass
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        offset = start
+        for line in fh:
+            # do not index an incomplete line (still being appended)
+            if not line.endswith(b'\n'):
+                break
+            yield offset, len(line), line
+            offset += len(line)
@@ -3,18 +3,19 @@
 
 # standard
 import argparse as ap
+import hashlib
 import json
 import os
-from collections import defaultdict
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
-from os.path import join
-
-# third
-from parlai.core import teachers
+from os.path import dirname, join
 
 # local
-from ..parlai.teachers import tscc, uptake  # <-- this adds new parlai teachers
 from ..constants import ABILITIES_DIR, GENERATIONS_DIR
+from .text_index import TextIndex
 
 
 __author__ = "Anaïs Tack"
@@ -26,6 +27,15 @@ __maintainer__ = "Anaïs Tack"
 __email__ = "atack@cs.stanford.edu"
 
 
+# sidecar file with the content fingerprint of a repopulated file (per task)
+FINGERPRINT_EXT = '.fingerprint'
+
+CHUNK_SIZE = 1 << 20
+
+# dataset shared with the worker processes
+_dataset = None
+
+
 def _get_wherefrom(dict_):
     filename = dict_['wherefrom']['filename']
     line_idx = dict_['wherefrom']['line_idx']
@@ -38,88 +48,138 @@ def _add_prompt(openai_response):
     return text
 
 
+def _fill_generation(line, dataset):
+    # add missing text
+    for i in range(len(line['dialog'])):
+        # find where in the dataset this utterance is from
+        wherefrom = _get_wherefrom(line['dialog'][i][0])
+        # only consider dialogs that come from the current dataset
+        item = dataset.get(*wherefrom)
+        if item is not None:
+            # add student utterance (if present)
+            line['dialog'][i][0]['text'] = item.get('text')
+            # add teacher utterance (if present)
+            teacher = item.get('eval_labels', [])
+            line['dialog'][i][0]['eval_labels'] = teacher
+            # add prompt for GPT-3
+            openai_response = line['dialog'][i][1].get(
+                'openai_response')
+            if openai_response:
+                text = _add_prompt(openai_response)
+                openai_response['choices'][0]['text'] = text
+    return line
+
+
+def _fill_ability(line, dataset):
+    if line['id'] == 'Teacher':
+        item = dataset.get(*_get_wherefrom(line))
+        if item is not None:
+            line['text'] = item['eval_labels'][0]
+    return line
+
+
+def _fingerprint(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _read_fingerprints(path):
+    if not os.path.exists(path + FINGERPRINT_EXT):
+        return {}
+    with open(path + FINGERPRINT_EXT) as fh:
+        return json.load(fh)
+
+
+def _write_fingerprints(path, fingerprints):
+    with open(path + FINGERPRINT_EXT, 'w') as fh:
+        json.dump(fingerprints, fh)
+
+
+def _rewrite(path, fill, dataset):
+    # stream records through a temporary file in the same directory
+    # such that the file can be replaced atomically
+    sha = hashlib.sha256()
+    changed = False
+    tmp = tempfile.NamedTemporaryFile(
+        'w', dir=dirname(path), prefix='.', suffix='.tmp', delete=False)
+    try:
+        with open(path) as fh, tmp:
+            for line in fh:
+                record = fill(json.loads(line.strip()), dataset)
+                out = json.dumps(record) + '\n'
+                changed = changed or out.strip() != line.strip()
+                sha.update(out.encode('utf-8'))
+                tmp.write(out)
+        if changed:
+            # create backup (a hard link avoids copying the file)
+            if os.path.exists(path + '.bak'):
+                os.remove(path + '.bak')
+            try:
+                os.link(path, path + '.bak')
+            except OSError:
+                shutil.copyfile(path, path + '.bak')
+            shutil.copymode(path, tmp.name)
+            os.replace(tmp.name, path)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+    return changed, sha.hexdigest()
+
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def _repopulate(path, fill, task):
+    # skip files that were already filled in for this task
+    # (i.e., neither the file nor the dataset changed since the last run)
+    fingerprints = _read_fingerprints(path)
+    if fingerprints.get(task) == [_dataset.fingerprint, _fingerprint(path)]:
+        return path, False
+    changed, digest = _rewrite(path, fill, _dataset)
+    fingerprints[task] = [_dataset.fingerprint, digest]
+    _write_fingerprints(path, fingerprints)
+    return path, changed
+
+
 def main(args):
 
-    opt = dict(
-        task=args.task,
-        datapath=args.datapath,
-        datatype='valid')
-
-    agent = teachers.create_task_agent_from_taskname(opt).pop()
-
-    # read dataset into ParlAI messages
-    dataset = defaultdict(dict)
-    for __ in range(agent.num_examples()):
-        msg = agent.act()
-        filename, line_idx = _get_wherefrom(msg)
-        dataset[filename][line_idx] = msg
-
-    # iterate over files with generations
-    for world_log in map(lambda f: join(GENERATIONS_DIR, f),
-                         filter(lambda f: f.endswith('.jsonl'),
-                                os.listdir(GENERATIONS_DIR))):
-        # read world log and insert dataset
-        # create backup
-        with open(world_log) as fh, open(world_log + '.bak', 'w') as bak:
-            lines = []
-            for line in fh:
-                # write to backup
-                bak.write(line)
-                line = json.loads(line.strip())
-                # add missing text
-                for i in range(len(line['dialog'])):
-                    # find where in the dataset this utterance is from
-                    wherefrom = _get_wherefrom(line['dialog'][i][0])
-                    filename, line_idx = wherefrom
-                    # only consider dialogs that come from the current dataset
-                    if filename in dataset and line_idx in dataset[filename]:
-                        item = dataset[filename][line_idx]
-                        # add student utterance (if present)
-                        line['dialog'][i][0]['text'] = item.get('text')
-                        # add teacher utterance (if present)
-                        teacher = item.get('eval_labels', [])
-                        line['dialog'][i][0]['eval_labels'] = teacher
-                        # add prompt for GPT-3
-                        openai_response = line['dialog'][i][1].get(
-                            'openai_response')
-                        if openai_response:
-                            text = _add_prompt(openai_response)
-                            openai_response['choices'][0]['text'] = text
-                lines.append(line)
-
-        # write lines to file
-        if len(lines):
-            with open(world_log, 'w') as fh:
-                for line in lines:
-                    fh.write(json.dumps(line) + '\n')
-
-    # iterate over files with abilities
-    for filename in glob(f"{ABILITIES_DIR}/*.jsonl"):
-        # read world log and insert dataset
-        # create backup
-        with open(filename) as fh, open(filename + '.bak', 'w') as bak:
-            lines = []
-            for line in fh:
-                # write to backup
-                bak.write(line)
-                line = json.loads(line.strip())
-                if line['id'] == 'Teacher':
-                    filename, line_idx = _get_wherefrom(line)
-                    if filename in dataset and line_idx in dataset[filename]:
-                        line['text'] = dataset[filename][line_idx]['eval_labels'][0]
-                lines.append(line)
-
-        # write lines to file
-        if len(lines):
-            with open(filename, 'w') as fh:
-                for line in lines:
-                    fh.write(json.dumps(line) + '\n')
+    # index dataset texts by (filename, line_idx)
+    # the index is memory-mapped and shared with the worker processes
+    dataset = TextIndex.load(args.task, args.datapath)
+
+    # files with generations
+    jobs = [(world_log, _fill_generation)
+            for world_log in map(lambda f: join(GENERATIONS_DIR, f),
+                                 filter(lambda f: f.endswith('.jsonl'),
+                                        os.listdir(GENERATIONS_DIR)))]
+    # files with abilities
+    jobs += [(filename, _fill_ability)
+             for filename in glob(f"{ABILITIES_DIR}/*.jsonl")]
+
+    # read each file and insert dataset (one file per process)
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=_init_worker,
+                             initargs=(dataset,)) as executor:
+        futures = [executor.submit(_repopulate, path, fill, args.task)
+                   for path, fill in jobs]
+        for future in as_completed(futures):
+            path, changed = future.result()
+            status = "Done" if changed else "Skipped"
+            sys.stderr.write(f"[{status}] {path}\n")
 
 
 def args_parser():
     parser = ap.ArgumentParser()
     parser.add_argument('-t', '--task', required=True)
     parser.add_argument('-d', '--datapath', required=True)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of files processed in parallel "
+                             "(default: number of processors)")
     return parser
 
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import csv
+import math
+import random
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# synthetic data mimicking the shape of the real datasets
+# (no copyrighted text and no network access needed)
+
+WORDS = ["the", "a", "student", "teacher", "word", "sentence", "grammar",
+         "verb", "tense", "past", "present", "question", "answer", "yes",
+         "no", "maybe", "good", "very", "well", "done", "example", "write",
+         "read", "book", "novel", "story", "think", "know", "why", "how",
+         "what", "when", "correct", "wrong", "try", "again", "let's", "see"]
+
+PLAYERS = ['GPT-3 Davinci', 'Teacher', 'blender_9B']
+
+ATTRIBUTES = ['more likely said by a teacher',
+              'understanding the student more',
+              'helping the student more']
+
+TSCC_HEADER = ['timestamp', 'user.id', 'role', 'turn.number', 'anonymised',
+               'edited', 'responding.to', 'sequence', 'seq.type', 'focus',
+               'resource', 'assessment']
+
+UPTAKE_HEADER = ['obs_id', 'exchange_idx', 'student_text', 'teacher_text',
+                 'student_on_task', 'student_on_task_num_agree',
+                 'student_on_task_majority', 'student_on_task_zscore',
+                 'teacher_on_task', 'teacher_on_task_num_agree',
+                 'teacher_on_task_majority', 'teacher_on_task_zscore',
+                 'uptake', 'uptake_num_agree', 'uptake_majority',
+                 'uptake_zscore']
+
+
+def make_sentence(rng, min_len=3, max_len=20):
+    return ' '.join(rng.choice(WORDS)
+                    for __ in range(rng.randint(min_len, max_len)))
+
+
+def make_history(n, seed=0):
+    # history is a list of ParlAI messages from recent to old turns
+    rng = random.Random(seed)
+    return [dict(text=make_sentence(rng),
+                 eval_labels=[make_sentence(rng)],
+                 episode_done=False)
+            for __ in range(n)]
+
+
+def write_tscc_tsv(filename, n_turns, seed=0):
+    rng = random.Random(seed)
+    with open(filename, 'w', newline='') as fh:
+        writer = csv.writer(fh, delimiter='\t')
+        writer.writerow(TSCC_HEADER)
+        role = 'teacher'
+        for n in range(n_turns):
+            # consecutive turns are often spoken by the same role
+            if rng.random() < .6:
+                role = 'student' if role == 'teacher' else 'teacher'
+            text = make_sentence(rng)
+            writer.writerow([f'00:{n // 60:02d}:{n % 60:02d}',
+                             '1' if role == 'teacher' else '2',
+                             role, n + 1, text, 'NA', 'NA', 'NA',
+                             'NA', 'NA', 'NA', 'NA'])
+
+
+def write_uptake_csv(filename, n_pairs, seed=0):
+    rng = random.Random(seed)
+    with open(filename, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(UPTAKE_HEADER)
+        for n in range(n_pairs):
+            writer.writerow([f'{n // 50:05d}', n % 50,
+                             make_sentence(rng), make_sentence(rng),
+                             *(rng.choice(['0', '1']) for __ in range(12))])
+
+
+def make_items(n_items,
+               n_raters=22,
+               n_pool=66,
+               players=PLAYERS,
+               attributes=ATTRIBUTES,
+               abilities=None,
+               home_advantage=0.,
+               tie_rate=.05,
+               seed=0):
+    """Make comparison items in the shape of ``items.jsonl``.
+
+    Judgments are drawn from a Bradley-Terry model with the given
+    ``abilities`` (one dict per item and attribute, mapping players
+    to their true ability). Random abilities are drawn if none are given.
+    Each item is rated by ``n_raters`` drawn from a pool of ``n_pool``.
+    """
+    rng = random.Random(seed)
+    pool = [f'R_{seed:04d}{r:06d}' for r in range(max(n_pool, n_raters))]
+    pairs = [(a, b) for a in players for b in players if a < b]
+    items = []
+    for n in range(n_items):
+        raters = rng.sample(pool, n_raters)
+        timing = make_timing(rng, raters)
+        attrs = {}
+        for attr in attributes:
+            if abilities is not None:
+                alpha = abilities[n][attr]
+            else:
+                alpha = {p: rng.gauss(0, 1) for p in players}
+            responses = {}
+            for rater in raters:
+                a, b = rng.choice(pairs)
+                if rng.random() < .5:
+                    a, b = b, a
+                if rng.random() < tie_rate:
+                    a_gt_b = None
+                else:
+                    logit = home_advantage + alpha[a] - alpha[b]
+                    a_gt_b = rng.random() < 1 / (1 + math.exp(-logit))
+                responses[rater] = [a, b, a_gt_b]
+            attrs[attr] = responses
+        items.append(dict(filename=f'synthetic{n:05d}.tsv',
+                          line_idx=[3 * n, 3 * n + 1, 3 * n + 2],
+                          task='TSCC',
+                          comparisons=dict(timing=timing,
+                                           attributes=attrs,
+                                           input=dict(text={}))))
+    return items
+
+
+def make_timing(rng, raters):
+    timing = dict(FIRST_CLICK={}, LAST_CLICK={},
+                  PAGE_SUBMIT={}, CLICK_COUNT={})
+    for rater in raters:
+        first = round(rng.expovariate(1 / 20), 3)
+        last = round(first + rng.expovariate(1 / 10), 3)
+        timing['FIRST_CLICK'][rater] = first
+        timing['LAST_CLICK'][rater] = last
+        timing['PAGE_SUBMIT'][rater] = round(last + rng.expovariate(1), 3)
+        timing['CLICK_COUNT'][rater] = float(rng.randint(3, 8))
+    return timing
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import hashlib
+import json
+import os
+import sys
+from os.path import basename, join
+
+# local
+from ..parlai.teachers import tscc, uptake
+from .offsets import JsonlReader, OffsetTable, make_key
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+def _tscc_datafiles(datapath):
+    return sorted(join(datapath, f)
+                  for f in os.listdir(datapath) if f.endswith('.tsv'))
+
+
+def _uptake_datafiles(datapath):
+    return [join(datapath, 'uptake_data.csv')]
+
+
+# how to read the messages of a task
+# (the same messages as the ParlAI teachers, without the episode machinery)
+SOURCES = {
+    tscc.TASK: (_tscc_datafiles, tscc.iter_messages),
+    uptake.TASK: (_uptake_datafiles, uptake.iter_messages),
+}
+
+
+def iter_records(task, datapath):
+    list_datafiles, iter_messages = SOURCES[task]
+    for datafile in list_datafiles(datapath):
+        for msg, __ in iter_messages(datafile):
+            # labels are evaluation labels in the 'valid' datatype
+            if 'labels' in msg:
+                labels = msg['labels']
+            elif 'label' in msg:
+                labels = [msg['label']]
+            else:
+                labels = []
+            yield dict(filename=msg['wherefrom']['filename'],
+                       line_idx=msg['wherefrom']['line_idx'],
+                       text=msg.get('text'),
+                       eval_labels=labels)
+
+
+def _sources(task, datapath):
+    list_datafiles, __ = SOURCES[task]
+    return {basename(f): [os.stat(f).st_size, os.stat(f).st_mtime_ns]
+            for f in list_datafiles(datapath)}
+
+
+class TextIndex(object):
+    """Persistent index from (filename, line_idx) to dataset texts.
+
+    Records are stored in a JSONL file and found through a memory-mapped
+    key->offset table, such that lookups do not load the whole dataset
+    (and worker processes share the same pages).
+    """
+
+    def __init__(self, prefix) -> None:
+        super().__init__()
+        self.prefix = prefix
+        self.table = OffsetTable(prefix + '.idx')
+        self.reader = JsonlReader(prefix + '.jsonl')
+
+    @staticmethod
+    def default_prefix(task, datapath):
+        return join(datapath, f'{task}.text_index')
+
+    @classmethod
+    def build(cls, task, datapath, prefix=None):
+        prefix = prefix or cls.default_prefix(task, datapath)
+        entries = []
+        offset = 0
+        with open(prefix + '.jsonl.tmp', 'wb') as fh:
+            for record in iter_records(task, datapath):
+                line = (json.dumps(record) + '\n').encode('utf-8')
+                entries.append((make_key(record['filename'],
+                                         record['line_idx']),
+                                offset, len(line), 0))
+                fh.write(line)
+                offset += len(line)
+        os.replace(prefix + '.jsonl.tmp', prefix + '.jsonl')
+        OffsetTable.write(prefix + '.idx', entries)
+
+        with open(prefix + '.json', 'w') as fh:
+            json.dump(dict(task=task, sources=_sources(task, datapath)), fh)
+
+        return cls(prefix)
+
+    @classmethod
+    def load(cls, task, datapath, prefix=None, rebuild=False):
+        # (re)build the index if the dataset has changed
+        prefix = prefix or cls.default_prefix(task, datapath)
+        if not rebuild and os.path.exists(prefix + '.json'):
+            with open(prefix + '.json') as fh:
+                meta = json.load(fh)
+            if meta['sources'] == _sources(task, datapath):
+                return cls(prefix)
+        return cls.build(task, datapath, prefix=prefix)
+
+    @property
+    def fingerprint(self):
+        with open(self.prefix + '.json', 'rb') as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+
+    def get(self, filename, line_idx, default=None):
+        line_idx = list(line_idx) if isinstance(line_idx, tuple) \
+            else line_idx
+        for offset, length, __ in self.table.lookup(
+                make_key(filename, line_idx)):
+            record = self.reader.read(offset, length)
+            if record['filename'] == filename \
+                    and record['line_idx'] == line_idx:
+                return record
+        return default
+
+    def __contains__(self, wherefrom):
+        return self.get(*wherefrom) is not None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        for offset, length, __ in self.table:
+            yield self.reader.read(offset, length)
+
+
+def main(args):
+    index = TextIndex.load(args.task, args.datapath, prefix=args.prefix,
+                           rebuild=args.rebuild)
+    sys.stderr.write(f"[Done] {len(index)} records in {index.prefix}\n")
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('-t', '--task', required=True,
+                        choices=sorted(SOURCES))
+    parser.add_argument('-d', '--datapath', required=True)
+    parser.add_argument('-p', '--prefix')
+    parser.add_argument('--rebuild', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)
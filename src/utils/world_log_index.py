@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# standard
+import argparse as ap
+import hashlib
+import json
+import os
+import sys
+from glob import glob
+from os.path import basename, isdir, join, splitext
+
+# local
+from ..constants import GENERATIONS_DIR
+from .offsets import JsonlReader, OffsetTable, iter_lines, make_key
+
+
+__author__ = "Anaïs Tack"
+__credits__ = ["Anaïs Tack", "Chris Piech"]
+__copyright__ = "Copyright 2022, Anaïs Tack"
+__license__ = "CC BY NC-SA 4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs Tack"
+__email__ = "atack@cs.stanford.edu"
+
+
+# sidecar index of a world log (one episode per line)
+# from the (filename, line_idx) of every turn to the byte offset of its
+# episode and the position of the turn in the episode
+# e.g. data/1_generations/TSCC_GPT3Ada.jsonl
+# --> data/1_generations/TSCC_GPT3Ada.jsonl.idx (offset table)
+# --> data/1_generations/TSCC_GPT3Ada.jsonl.idx.json (indexed bytes)
+# the index grows with the world log: only appended lines are read
+
+EXT = '.idx'
+META_EXT = '.idx.json'
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_entries(path, start=0):
+    """(key, offset, length, turn) of every turn of the complete lines.
+
+    Also returns the end of the last line read, with its offset, length
+    and digest (to check later that the file was only appended to).
+    """
+    entries, end, last = [], start, None
+    for offset, length, line in iter_lines(path, start=start):
+        for turn, exchange in enumerate(json.loads(line)['dialog']):
+            wherefrom = exchange[0].get('wherefrom')
+            if wherefrom:
+                entries.append((make_key(wherefrom['filename'],
+                                         wherefrom['line_idx']),
+                                offset, length, turn))
+        end, last = offset + length, [offset, length, _digest(line)]
+    return entries, end, last
+
+
+class WorldLogIndex(object):
+    """Random access to the episodes and turns of a world log.
+
+    Episodes are read from a memory map of the world log at the offset
+    found in the index (only that line is parsed).
+    """
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        self.path = path
+        self.table = OffsetTable(path + EXT)
+        self.reader = JsonlReader(path)
+
+    def __getstate__(self):
+        return dict(path=self.path)
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @staticmethod
+    def _meta(path):
+        if not os.path.exists(path + META_EXT) or \
+                not os.path.exists(path + EXT):
+            return None
+        with open(path + META_EXT) as fh:
+            return json.load(fh)
+
+    @staticmethod
+    def _is_prefix(path, meta):
+        # the indexed bytes are unchanged (the file was only appended to)
+        stat = os.stat(path)
+        if stat.st_ino != meta['inode'] or stat.st_size < meta['size']:
+            return False
+        if meta['last'] is None:
+            return True
+        offset, length, digest = meta['last']
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            return _digest(fh.read(length)) == digest
+
+    @staticmethod
+    def _write_meta(path, size, last, n_entries):
+        meta = dict(inode=os.stat(path).st_ino, size=size, last=last,
+                    entries=n_entries)
+        with open(path + META_EXT + '.tmp', 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(path + META_EXT + '.tmp', path + META_EXT)
+
+    @classmethod
+    def build(cls, path):
+        entries, end, last = read_entries(path)
+        OffsetTable.write(path + EXT, entries)
+        cls._write_meta(path, end, last, len(entries))
+        return cls(path)
+
+    @classmethod
+    def load(cls, path, rebuild=False):
+        """Index of a world log, updated with the lines appended since."""
+        meta = cls._meta(path)
+        if rebuild or meta is None or not cls._is_prefix(path, meta):
+            return cls.build(path)
+        if os.stat(path).st_size > meta['size']:
+            entries, end, last = read_entries(path, start=meta['size'])
+            if end > meta['size']:
+                OffsetTable.extend(path + EXT, entries)
+                cls._write_meta(path, end, last,
+                                meta['entries'] + len(entries))
+        return cls(path)
+
+    def _lookup(self, filename, line_idx):
+        line_idx = list(line_idx) if isinstance(line_idx, tuple) \
+            else line_idx
+        for offset, length, turn in self.table.lookup(
+                make_key(filename, line_idx)):
+            episode = self.reader.read(offset, length)
+            wherefrom = episode['dialog'][turn][0].get('wherefrom', {})
+            if wherefrom.get('filename') == filename \
+                    and wherefrom.get('line_idx') == line_idx:
+                return episode, turn
+        return None, None
+
+    def episode(self, filename, line_idx, default=None):
+        """The episode (a line of the world log) with the turn."""
+        episode, __ = self._lookup(filename, line_idx)
+        return default if episode is None else episode
+
+    def get(self, filename, line_idx, default=None):
+        """The turn: [observation, response] (or more agents)."""
+        episode, turn = self._lookup(filename, line_idx)
+        return default if episode is None else episode['dialog'][turn]
+
+    def __contains__(self, wherefrom):
+        return self._lookup(*wherefrom)[0] is not None
+
+    def __len__(self):
+        return len(self.table)
+
+    def close(self):
+        self.table.close()
+        self.reader.close()
+
+
+class WorldLogs(object):
+    """The indexes of all world logs in a directory (e.g., one per model).
+
+    World logs are named after their task and model,
+    e.g. TSCC_GPT3Ada.jsonl.
+    """
+
+    def __init__(self, world_logs_dir=GENERATIONS_DIR, rebuild=False) -> None:
+        super().__init__()
+        self.indexes = {splitext(basename(path))[0]:
+                        WorldLogIndex.load(path, rebuild=rebuild)
+                        for path in sorted(glob(join(world_logs_dir,
+                                                     '*.jsonl')))}
+
+    def get(self, filename, line_idx):
+        # {world log: turn} of the world logs that have the turn
+        turns = {}
+        for name, index in self.indexes.items():
+            turn = index.get(filename, line_idx)
+            if turn is not None:
+                turns[name] = turn
+        return turns
+
+    def episodes(self, filename, line_idx):
+        episodes = {}
+        for name, index in self.indexes.items():
+            episode = index.episode(filename, line_idx)
+            if episode is not None:
+                episodes[name] = episode
+        return episodes
+
+
+def main(args):
+    paths = [p for path in args.world_logs
+             for p in (sorted(glob(join(path, '*.jsonl')))
+                       if isdir(path) else [path])]
+    indexes = {path: WorldLogIndex.load(path, rebuild=args.rebuild)
+               for path in paths}
+    if args.filename is None:
+        for path, index in indexes.items():
+            sys.stderr.write(f"[Done] {len(index)} turns in {path}{EXT}\n")
+        return
+    line_idx = json.loads(args.line_idx)
+    for path, index in indexes.items():
+        found = index.episode(args.filename, line_idx) if args.episode \
+            else index.get(args.filename, line_idx)
+        if found is not None:
+            sys.stdout.write(json.dumps(dict(world_log=basename(path),
+                                             found=found)) + '\n')
+
+
+def args_parser():
+    parser = ap.ArgumentParser()
+    parser.add_argument('world_logs', nargs='*', default=[GENERATIONS_DIR],
+                        help="world logs (or directories of world logs)")
+    parser.add_argument('-f', '--filename',
+                        help="get the turn of this file "
+                             "(e.g., teacherstudentchat00052.tsv)")
+    parser.add_argument('-l', '--line-idx', default='null',
+                        help="and these lines (JSON, e.g., [0, 1, 2] or 5)")
+    parser.add_argument('--episode', action='store_true',
+                        help="get the whole episode")
+    parser.add_argument('--rebuild', action='store_true')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = args_parser()
+    args = parser.parse_args()
+    main(args)